@@ -0,0 +1,115 @@
+"""
+Benchmark the time saved per tile by reusing the prepared statements of the tile queries.
+
+The tile queries pass the tile coordinates as bind parameters, so asyncpg reuses the prepared statement
+of a collection and branch. This compares running the queries of random tiles of a layer as they are
+(reused statements) with forcing a new statement per tile, as when the coordinates were part of the SQL.
+
+Usage:
+    python scripts/benchmark_tile_planning.py user_data.<layer_id> --zoom 14 --tiles 200
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from buildpg import asyncpg
+from morecantile import tms as morecantile_tms
+from tipg.settings import PostgresSettings
+
+
+class RecordingPool:
+    """Pool wrapper recording the queries run by get_tile."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.queries = []
+
+    def acquire(self):
+        recording_pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                self.ctx = recording_pool.pool.acquire()
+                conn = await self.ctx.__aenter__()
+                return RecordingConnection(conn, recording_pool.queries)
+
+            async def __aexit__(self, *exc):
+                return await self.ctx.__aexit__(*exc)
+
+        return Acquire()
+
+
+class RecordingConnection:
+    def __init__(self, conn, queries):
+        self.conn = conn
+        self.queries = queries
+
+    def __getattr__(self, name):
+        method = getattr(self.conn, name)
+
+        async def record(q, *p, **kwargs):
+            self.queries.append((q, p))
+            return await method(q, *p, **kwargs)
+
+        return record
+
+
+async def run_queries(pool, queries, unique: bool) -> float:
+    start = time.perf_counter()
+    async with pool.acquire() as conn:
+        for i, (q, p) in enumerate(queries):
+            if unique:
+                # A comment makes the SQL text unique, so the statement is parsed and planned again
+                q = f"{q} /* benchmark {i} {time.time_ns()} */"
+            await conn.fetch(q, *p)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+async def main(args):
+    # Importing the app applies the patches of the tipg Collection (get_tile...)
+    import src.main  # noqa: F401
+    from src.catalog import LayerCatalog
+
+    pool = await asyncpg.create_pool_b(
+        str(PostgresSettings().database_url), min_size=1, max_size=1
+    )
+    try:
+        async with pool.acquire() as conn:
+            collection = await LayerCatalog().get_collection(args.collection, conn)
+        if collection is None:
+            raise SystemExit(f"Layer {args.collection} not found.")
+
+        tms = morecantile_tms.get("WebMercatorQuad")
+        tiles = list(tms.tiles(*collection.bounds, [args.zoom]))
+        tiles = random.sample(tiles, min(args.tiles, len(tiles)))
+
+        # Record the queries of each tile
+        recording_pool = RecordingPool(pool)
+        for tile in tiles:
+            await collection.get_tile(pool=recording_pool, tms=tms, tile=tile)
+        queries = recording_pool.queries
+
+        async with pool.acquire() as conn:
+            q, p = queries[-1]
+            plan = await conn.fetchval(f"EXPLAIN (SUMMARY ON, FORMAT JSON) {q}", *p)
+        planning_time = json.loads(plan)[0]["Planning Time"]
+
+        unique = await run_queries(pool, queries, unique=True)
+        reused = await run_queries(pool, queries, unique=False)
+        print(f"Tiles: {len(tiles)} at zoom {args.zoom}, queries: {len(queries)}")
+        print(f"Planning time of a tile query: {planning_time} ms")
+        print(f"New statement per query:    {unique:.2f} ms per query")
+        print(f"Reused prepared statements: {reused:.2f} ms per query")
+        print(f"Saved: {unique - reused:.2f} ms per query")
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("collection", help="Collection id, e.g. user_data.<layer_id>")
+    parser.add_argument("--zoom", type=int, default=14)
+    parser.add_argument("--tiles", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,154 @@
+import asyncio
+from typing import List, Optional
+
+import asyncpg
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from morecantile import tms as morecantile_tms
+from tipg.collections import Collection
+from typing_extensions import Annotated
+
+from src.catalog import LayerCatalog
+from src.exts import CollectionParams
+from src.indexes import create_indexes, index_report
+from src.metrics import metrics
+from src.seed import TileCacheSink, TileSeeder
+from src.settings import geoapi_settings
+
+
+def verify_admin_token(
+    token: Annotated[Optional[str], Header(alias="X-Admin-Token")] = None,
+):
+    """Check the admin token. The admin endpoints are disabled if no token is configured."""
+    if not geoapi_settings.admin_token:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled.")
+    if token != geoapi_settings.admin_token:
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+
+router = APIRouter(
+    prefix="/admin", tags=["Admin"], dependencies=[Depends(verify_admin_token)]
+)
+
+
+def seed_status(seeder: TileSeeder) -> dict:
+    return {
+        "collection": seeder.collection.id,
+        "minzoom": seeder.minzoom,
+        "maxzoom": seeder.maxzoom,
+        "done": seeder.done,
+        **seeder.stats,
+    }
+
+
+@router.post(
+    "/collections/{collectionId}/seed",
+    description="Pre-render the tiles of a layer over a zoom range into the tile cache.",
+    summary="Warm the tile cache of a layer.",
+    operation_id="seedTileCache",
+    status_code=202,
+)
+async def seed_tile_cache(
+    request: Request,
+    collection: Annotated[Collection, Depends(CollectionParams)],
+    maxzoom: Annotated[int, Query(ge=0, le=24)],
+    minzoom: Annotated[int, Query(ge=0, le=24)] = 0,
+    tileMatrixSetId: Annotated[str, Query()] = "WebMercatorQuad",
+    concurrency: Annotated[int, Query(ge=1, le=16)] = 2,
+):
+    """Start seeding the tile cache of a layer in the background."""
+    cache = getattr(request.app.state, "tile_cache", None)
+    if cache is None:
+        raise HTTPException(status_code=409, detail="The tile cache is disabled.")
+
+    seed_tasks = request.app.state.seed_tasks
+    if collection.id in seed_tasks and not seed_tasks[collection.id][0].done():
+        raise HTTPException(status_code=409, detail="The layer is already seeding.")
+
+    tms = morecantile_tms.get(tileMatrixSetId)
+    seeder = TileSeeder(
+        request.app.state.pool, collection, tms, minzoom, maxzoom, concurrency
+    )
+    task = asyncio.create_task(seeder.run(TileCacheSink(cache, collection, tms)))
+    seed_tasks[collection.id] = (task, seeder)
+    return seed_status(seeder)
+
+
+@router.get(
+    "/collections/{collectionId}/seed",
+    description="Progress of the seeding of a layer.",
+    summary="Seeding progress.",
+    operation_id="getSeedStatus",
+)
+async def get_seed_status(request: Request, collectionId: str):
+    """Return the progress of the last seeding of a layer."""
+    if collectionId not in request.app.state.seed_tasks:
+        raise HTTPException(status_code=404, detail="The layer was not seeded.")
+    return seed_status(request.app.state.seed_tasks[collectionId][1])
+
+
+async def build_indexes(request: Request) -> dict:
+    """Build the index report of the tables of the catalog layers."""
+    async with request.app.state.pool.acquire() as conn:
+        layers = await request.app.state.layer_catalog.get(conn=conn)
+        return await index_report(
+            conn,
+            layers,
+            metrics.hot_layers(geoapi_settings.index_advisor_hot_layers),
+            geoapi_settings.index_advisor_min_layer_rows,
+        )
+
+
+@router.get(
+    "/indexes",
+    description="Indexes of the user_data tables of the layers, with the missing indexes and the partial "
+    "indexes proposed for the largest of the most requested layers.",
+    summary="Index health of the layer tables.",
+    operation_id="getIndexReport",
+)
+async def get_index_report(request: Request):
+    """Return the index report and the state of the index builds."""
+    report = await build_indexes(request)
+    report["builds"] = request.app.state.index_builds
+    return report
+
+
+@router.post(
+    "/indexes",
+    description="Create the proposed indexes (all of them or the given ones) concurrently in the background.",
+    summary="Create the proposed indexes.",
+    operation_id="createIndexes",
+    status_code=202,
+)
+async def create_proposed_indexes(
+    request: Request,
+    name: Annotated[Optional[List[str]], Query()] = None,
+):
+    """Start creating the proposed indexes on a connection of their own."""
+    task = request.app.state.index_task
+    if task is not None and not task.done():
+        raise HTTPException(status_code=409, detail="Indexes are already created.")
+
+    proposals = (await build_indexes(request))["proposals"]
+    if name:
+        unknown = set(name) - {p["name"] for p in proposals}
+        if unknown:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No proposed index named {', '.join(sorted(unknown))}.",
+            )
+        proposals = [p for p in proposals if p["name"] in name]
+
+    builds = request.app.state.index_builds
+    for index in proposals:
+        builds[index["name"]] = "pending"
+
+    async def run():
+        # A direct connection: the builds take long and must not hold a connection of the pool
+        conn = await asyncpg.connect(LayerCatalog.listener_database_url())
+        try:
+            await create_indexes(conn, proposals, builds)
+        finally:
+            await conn.close()
+
+    request.app.state.index_task = asyncio.create_task(run())
+    return {index["name"]: builds[index["name"]] for index in proposals}
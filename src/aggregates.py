@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from buildpg import V, render
+from tipg.collections import Column
+
+# Aggregates of the attributes by the type of their column (the prefix of the attribute_mapping keys)
+NUMERIC_TYPES = {"integer", "bigint", "smallint", "numeric", "double precision"}
+NUMERIC_AGGREGATES = {"minmax", "quantiles", "histogram", "distinct"}
+TYPE_AGGREGATES = {
+    **{t: NUMERIC_AGGREGATES for t in NUMERIC_TYPES},
+    "timestamp": {"minmax", "quantiles", "distinct"},
+    "date": {"minmax", "quantiles", "distinct"},
+    "text": {"distinct"},
+    "boolean": {"distinct"},
+}
+
+
+def valid_aggregates(column: Column) -> set:
+    """Return the aggregates which can be computed for a column."""
+    return TYPE_AGGREGATES.get(column.type, set())
+
+
+def aggregate_query(
+    operation: str,
+    from_clause,
+    where_clause,
+    column: Optional[Column] = None,
+    breaks: int = 5,
+    limit: int = 100,
+    bounds: Optional[Tuple[Any, Any]] = None,
+) -> Tuple[str, List[Any]]:
+    """Build the query of an aggregate over the features selected by the from and where clauses.
+
+    The histogram needs the bounds (min, max) of the column, from the `minmax` aggregate.
+    """
+    params = {"from_clause": from_clause, "where_clause": where_clause}
+    if column is not None:
+        params["c"] = V(column.description)
+
+    if operation == "count":
+        sql = "SELECT COUNT(*) AS count :from_clause :where_clause"
+    elif operation == "minmax":
+        sql = "SELECT MIN(:c) AS min, MAX(:c) AS max, COUNT(:c) AS count :from_clause :where_clause"
+    elif operation == "quantiles":
+        sql = """
+            SELECT PERCENTILE_DISC(:fractions::double precision[]) WITHIN GROUP (ORDER BY :c) AS breaks
+            :from_clause :where_clause
+        """
+        params["fractions"] = [i / breaks for i in range(breaks + 1)]
+    elif operation == "histogram":
+        # The maximum falls into the bucket after the last one (breaks + 1) and is counted in the last
+        sql = """
+            SELECT LEAST(
+                WIDTH_BUCKET(:c::double precision, :min::double precision, :max::double precision, :breaks),
+                :breaks
+            ) AS bucket, COUNT(*) AS count
+            :from_clause :where_clause AND :c IS NOT NULL
+            GROUP BY 1 ORDER BY 1
+        """
+        params.update(min=bounds[0], max=bounds[1], breaks=breaks)
+    elif operation == "distinct":
+        sql = """
+            SELECT :c AS value, COUNT(*) AS count
+            :from_clause :where_clause
+            GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT :limit
+        """
+        params["limit"] = limit
+    else:
+        raise ValueError(f"Unknown aggregate {operation}")
+
+    return render(sql, **params)
+
+
+def histogram_bins(
+    rows: List[Dict[str, Any]], bounds: Tuple[float, float], breaks: int
+) -> List[Dict[str, Any]]:
+    """Return the bins of a histogram with their bounds, including the empty ones."""
+    counts = {row["bucket"]: row["count"] for row in rows}
+    minimum, maximum = bounds
+    width = (maximum - minimum) / breaks
+    return [
+        {
+            "min": minimum + i * width,
+            "max": maximum if i == breaks - 1 else minimum + (i + 1) * width,
+            "count": counts.get(i + 1, 0),
+        }
+        for i in range(breaks)
+    ]
+
+
+class AggregateCache:
+    """Results of the aggregates of the layers, kept for the current generation of each layer."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[str, str, str], Any]" = OrderedDict()
+
+    def get(self, collection_id: str, generation: str, query: str) -> Optional[Any]:
+        key = (collection_id, generation, query)
+        result = self.entries.get(key)
+        if result is not None:
+            self.entries.move_to_end(key)
+        return result
+
+    def put(self, collection_id: str, generation: str, query: str, result: Any):
+        self.entries[(collection_id, generation, query)] = result
+        self.entries.move_to_end((collection_id, generation, query))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, collection_id: str):
+        """Remove the results of a layer."""
+        for key in [k for k in self.entries if k[0] == collection_id]:
+            del self.entries[key]
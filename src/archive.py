@@ -0,0 +1,138 @@
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
+
+import cramjam
+from tipg.collections import Collection
+
+from src.metrics import metrics
+
+
+def archive_fingerprint(collection: Collection, change: Optional[str] = None) -> str:
+    """Return the fingerprint of the state of a layer, stored in the archives seeded from it.
+
+    It is built from durable data of the layer: its fingerprint (which includes its updated_at) and
+    the feature change the archive was seeded after (see outdated_path).
+    """
+    state = f"{getattr(collection, 'fingerprint', None)}:{change or ''}"
+    return hashlib.md5(state.encode()).hexdigest()
+
+
+def outdated_path(path: str) -> str:
+    """Return the path of the marker of an archive seeded before a change of its layer's features.
+
+    The marker holds the change marker of the notification. It is written by the instances next to
+    the archive, so it outlives their restarts, and removed by the seeder once it seeded the change.
+    """
+    return f"{path}.outdated"
+
+
+def read_outdated(path: str) -> Optional[str]:
+    """Return the change of the outdated marker of an archive, None if it is not outdated."""
+    try:
+        with open(outdated_path(path)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class MBTilesArchive:
+    """Read-only access to an MBTiles archive written by the seeder, using memory-mapped reads."""
+
+    def __init__(self, path: str, mmap_size: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.conn = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self.conn.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+        self.metadata: Dict[str, str] = dict(
+            self.conn.execute("SELECT name, value FROM metadata").fetchall()
+        )
+
+    @property
+    def fingerprint(self) -> Optional[str]:
+        return self.metadata.get("goat_fingerprint")
+
+    def get(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """Return the tile (empty if the tile was rendered without features) or None if it was not seeded."""
+        row = self.conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (1 << z) - 1 - y),
+        ).fetchone()
+        if row is not None:
+            return bytes(cramjam.gzip.decompress(row[0]))
+
+        rendered = self.conn.execute(
+            "SELECT 1 FROM goat_tile_state WHERE z = ? AND x = ? AND y = ?",
+            (z, x, y),
+        ).fetchone()
+        return b"" if rendered else None
+
+    def close(self):
+        self.conn.close()
+
+
+class TileArchives:
+    """MBTiles archives of a directory, named after the collection id (e.g. user_data.<layer_id>.mbtiles).
+
+    When an archive is opened (at the first request or after it was written again), its fingerprint
+    is compared with the current state of the layer, and archives seeded before feature changes of
+    the layer are marked as outdated on disk, so that they are not served, also after a restart.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # Opened archives with their modification time and whether they match the state of their layer
+        self.archives: Dict[str, Tuple[float, MBTilesArchive, bool]] = {}
+        # Modification time of the archives seeded before a change of their layer's features, for
+        # those whose outdated marker could not be written.
+        self.outdated: Dict[str, float] = {}
+
+    def invalidate(self, collection_id: str, change: Optional[str] = None):
+        """Stop serving the archive of a collection until it is seeded again."""
+        path = os.path.join(self.directory, f"{collection_id}.mbtiles")
+        if not os.path.exists(path):
+            return
+        try:
+            with open(outdated_path(path), "w") as f:
+                # Without change marker the seeder still needs a new value to render the tiles again
+                f.write(change or f"local{time.time_ns()}")
+        except OSError as e:
+            print(f"Could not mark tile archive {path} as outdated: {e}")
+            self.outdated[collection_id] = os.path.getmtime(path)
+
+    def get(self, collection: Collection) -> Optional[MBTilesArchive]:
+        """Return the archive of a collection if it was seeded for the current state of the layer."""
+        path = os.path.join(self.directory, f"{collection.id}.mbtiles")
+        if not os.path.exists(path):
+            return None
+
+        mtime = os.path.getmtime(path)
+        if self.outdated.get(collection.id) == mtime or os.path.exists(
+            outdated_path(path)
+        ):
+            metrics.inc("tile_archive_outdated")
+            return None
+
+        opened = self.archives.get(collection.id)
+        if opened is None or opened[0] != mtime:
+            if opened is not None:
+                opened[1].close()
+                del self.archives[collection.id]
+            try:
+                archive = MBTilesArchive(path)
+            except sqlite3.Error as e:
+                print(f"Could not open tile archive {path}: {e}")
+                return None
+            current = archive.fingerprint == archive_fingerprint(
+                collection, archive.metadata.get("goat_change")
+            )
+            opened = (mtime, archive, current)
+            self.archives[collection.id] = opened
+
+        if not opened[2]:
+            metrics.inc("tile_archive_outdated")
+            return None
+        return opened[1]
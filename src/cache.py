@@ -0,0 +1,270 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import cramjam
+from morecantile import tms as morecantile_tms
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import QueryParams
+
+from src.metrics import metrics
+
+# Compression backends and levels used to precompress the tiles.
+COMPRESSION_BACKENDS = {
+    "gzip": (cramjam.gzip, 6),
+    "br": (cramjam.brotli, 8),
+    "zstd": (cramjam.zstd, 3),
+}
+
+ACCEPT_ENCODING_PATTERN = re.compile(r"^(?P<name>[a-z]+|\*)(;q=(?P<q>[\d.]+))?$")
+
+TileKey = Tuple[str, str, int, int, int, str]
+BBox = Tuple[float, float, float, float]
+
+
+@dataclass
+class CachedTile:
+    """A rendered tile with its body for every encoding (compressed so far)."""
+
+    content: Dict[str, bytes]
+    created: float = field(default_factory=time.time)
+    # Time the tile was invalidated at while it is kept to be served stale
+    stale_since: Optional[float] = None
+    # Rendered by the prefetcher and not requested yet
+    prefetched: bool = False
+
+    @property
+    def size(self) -> int:
+        return sum(len(body) for body in self.content.values())
+
+
+def compress_tile(
+    data: bytes, encodings: List[str], minimum_size: int
+) -> Dict[str, bytes]:
+    """Encode a tile with all the given encodings. Small tiles are only stored uncompressed."""
+    content = {"identity": data}
+    if len(data) < minimum_size:
+        return content
+
+    for encoding in encodings:
+        backend, level = COMPRESSION_BACKENDS[encoding]
+        content[encoding] = bytes(backend.compress(data, level=level))
+    return content
+
+
+def preferred_encoding(accept_encoding: str, encodings: List[str]) -> str:
+    """Return the best of the encodings for the Accept-Encoding header."""
+    accepted = {}
+    for value in accept_encoding.replace(" ", "").lower().split(","):
+        matched = ACCEPT_ENCODING_PATTERN.match(value)
+        if matched:
+            try:
+                accepted[matched.group("name")] = float(matched.group("q") or 1)
+            except ValueError:
+                continue
+
+    best, best_q = "identity", 0.0
+    for encoding in encodings:
+        q = accepted.get(encoding, accepted.get("*", 0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def select_encoding(
+    tile: CachedTile, accept_encoding: str, encodings: List[str]
+) -> str:
+    """Return the best encoding of the cached tile for the Accept-Encoding header."""
+    return preferred_encoding(
+        accept_encoding, [e for e in encodings if e in tile.content]
+    )
+
+
+class TileCache:
+    """In-memory LRU cache of rendered tiles, stored precompressed so hits are served without compressing."""
+
+    def __init__(
+        self,
+        max_size: int,
+        encodings: Optional[List[str]] = None,
+        minimum_size: int = 500,
+        stale_max_age: Optional[Callable[[int], float]] = None,
+    ):
+        self.max_size = max_size
+        self.encodings = encodings if encodings is not None else ["br", "zstd", "gzip"]
+        self.minimum_size = minimum_size
+        # Maximum age in seconds of stale tiles by zoom level (stale-while-revalidate)
+        self.stale_max_age = stale_max_age
+        self.size = 0
+        self.tiles: "OrderedDict[TileKey, CachedTile]" = OrderedDict()
+        # Keys of the cached tiles by collection, tile matrix set and zoom level, then by tile.
+        self.index: Dict[Tuple[str, str, int], Dict[Tuple[int, int], Set[TileKey]]] = {}
+        # Version of each collection, increased on invalidation, and of the whole cache, increased
+        # when it is cleared. Tiles rendered against an older version are not stored.
+        self.versions: Dict[str, int] = {}
+        self.epoch = 0
+        # Background compressions of the other encodings of the cached tiles
+        self.compressing: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def key(
+        collection_id: str, tms_id: str, z: int, x: int, y: int, query: str = ""
+    ) -> TileKey:
+        """Build the cache key of a tile. The query string is normalised by sorting its parameters."""
+        query = str(QueryParams(sorted(QueryParams(query).multi_items())))
+        return (collection_id, tms_id, z, x, y, query)
+
+    def version(self, collection_id: str) -> Tuple[int, int]:
+        """Return the current version of a collection."""
+        return (self.epoch, self.versions.get(collection_id, 0))
+
+    def get(self, key: TileKey) -> Optional[CachedTile]:
+        """Return the cached tile or None. The tile can be stale (see `stale_since`)."""
+        tile = self.tiles.get(key)
+        if tile is not None and tile.stale_since is not None:
+            if time.time() - tile.stale_since > self.stale_max_age(key[2]):
+                self.remove(key)
+                metrics.inc("tile_cache_stale_expired")
+                tile = None
+        if tile is None:
+            metrics.inc("tile_cache_misses")
+            return None
+        self.tiles.move_to_end(key)
+        metrics.inc("tile_cache_hits")
+        if tile.prefetched:
+            tile.prefetched = False
+            metrics.inc("tile_prefetch_hits")
+        return tile
+
+    async def put(
+        self,
+        key: TileKey,
+        data: bytes,
+        version: Optional[Tuple[int, int]] = None,
+        prefetched: bool = False,
+        encoding: Optional[str] = None,
+    ) -> CachedTile:
+        """Store a tile, unless the collection changed meanwhile.
+
+        Only the encoding of the request (if any) is compressed before the tile is returned, in the
+        thread pool. The other encodings are added in the background.
+        """
+        first = [encoding] if encoding in self.encodings else []
+        content = await run_in_threadpool(compress_tile, data, first, self.minimum_size)
+        tile = CachedTile(content=content, prefetched=prefetched)
+        if version is not None and version != self.version(key[0]):
+            return tile
+
+        self.remove(key)
+        if tile.size > self.max_size:
+            return tile
+        self.tiles[key] = tile
+        self.size += tile.size
+        self.index.setdefault(key[:3], {}).setdefault(key[3:5], set()).add(key)
+        self.evict()
+        if len(data) >= self.minimum_size and len(first) < len(self.encodings):
+            task = asyncio.create_task(self.compress(key, tile, data))
+            self.compressing.add(task)
+            task.add_done_callback(self.compressing.discard)
+        return tile
+
+    async def compress(self, key: TileKey, tile: CachedTile, data: bytes):
+        """Add the missing encodings to a cached tile."""
+        missing = [e for e in self.encodings if e not in tile.content]
+        content = await run_in_threadpool(
+            compress_tile, data, missing, self.minimum_size
+        )
+        # The tile may have been replaced or removed meanwhile
+        if self.tiles.get(key) is not tile:
+            return
+        for encoding in missing:
+            tile.content[encoding] = content[encoding]
+            self.size += len(content[encoding])
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used tiles until the cache fits into its size."""
+        while self.size > self.max_size:
+            self.remove(next(iter(self.tiles)))
+            metrics.inc("tile_cache_evictions")
+
+    def remove(self, key: TileKey):
+        """Remove a tile from the cache."""
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            return
+        self.size -= tile.size
+        if tile.prefetched:
+            metrics.inc("tile_prefetch_wasted")
+        zoom_index = self.index[key[:3]]
+        keys = zoom_index[key[3:5]]
+        keys.discard(key)
+        if not keys:
+            del zoom_index[key[3:5]]
+            if not zoom_index:
+                del self.index[key[:3]]
+
+    def expire(self, key: TileKey):
+        """Remove an invalidated tile, or mark it stale if it can be served while it is rendered again."""
+        tile = self.tiles.get(key)
+        if tile is None or tile.stale_since is not None:
+            return
+        if self.stale_max_age is not None and self.stale_max_age(key[2]) > 0:
+            tile.stale_since = time.time()
+        else:
+            self.remove(key)
+
+    def invalidate(self, collection_id: str):
+        """Remove (or mark stale) all cached tiles of a collection."""
+        self.versions[collection_id] = self.versions.get(collection_id, 0) + 1
+        for key in [k for k in self.tiles if k[0] == collection_id]:
+            self.expire(key)
+        metrics.inc("tile_cache_invalidations")
+
+    def invalidate_bbox(self, collection_id: str, bbox: BBox, buffer: int = 1):
+        """Remove (or mark stale) the cached tiles of a collection intersecting a bounding box (in EPSG:4326).
+
+        The tile range of every zoom level is extended by `buffer` tiles, as features are rendered
+        into the buffer of the neighbouring tiles and clustered points can move to a neighbour.
+        """
+        self.versions[collection_id] = self.versions.get(collection_id, 0) + 1
+        west, south, east, north = bbox
+        removed = 0
+        for (cid, tms_id, z), zoom_index in list(self.index.items()):
+            if cid != collection_id:
+                continue
+            tms = morecantile_tms.get(tms_id)
+            ul = tms.tile(west, north, z, truncate=True)
+            lr = tms.tile(east, south, z, truncate=True)
+            minx, maxx = min(ul.x, lr.x) - buffer, max(ul.x, lr.x) + buffer
+            miny, maxy = min(ul.y, lr.y) - buffer, max(ul.y, lr.y) + buffer
+            # Iterate over the smaller of the tile range and the cached tiles of the zoom level
+            if (maxx - minx + 1) * (maxy - miny + 1) < len(zoom_index):
+                tiles = [
+                    (x, y)
+                    for x in range(minx, maxx + 1)
+                    for y in range(miny, maxy + 1)
+                    if (x, y) in zoom_index
+                ]
+            else:
+                tiles = [
+                    (x, y)
+                    for x, y in zoom_index
+                    if minx <= x <= maxx and miny <= y <= maxy
+                ]
+            for tile in tiles:
+                for key in list(zoom_index.get(tile, ())):
+                    self.expire(key)
+                    removed += 1
+        metrics.inc("tile_cache_bbox_invalidations")
+        metrics.inc("tile_cache_bbox_invalidated_tiles", removed)
+
+    def clear(self):
+        """Remove all cached tiles."""
+        self.epoch += 1
+        self.tiles.clear()
+        self.index.clear()
+        self.size = 0
@@ -1,6 +1,9 @@
 import asyncio
+import hashlib
 import json
-from typing import List
+import random
+import time
+from typing import Dict, List, Optional, Tuple
 from uuid import UUID
 
 import asyncpg
@@ -8,54 +11,122 @@ from fastapi import FastAPI
 from tipg.collections import Catalog, Collection, Column
 from tipg.settings import PostgresSettings
 
+from src.metrics import metrics
+from src.settings import ClusteringPolicy, geoapi_settings
+
+
 class Collection(Collection):
     distributed: bool = False
+    # Hash of the layer object the collection was built from (changes with the extent, attributes...).
+    fingerprint: Optional[str] = None
+    # Shards of a distributed layer as (shard id, min hash, max hash) ordered by min hash.
+    shards: List[Tuple[int, int, int]] = []
+    # Clustering policy of a point layer, resolved from the settings when the catalog is built.
+    clustering: Optional[ClusteringPolicy] = None
+    # updated_at of the layer in microseconds when the collection was built (see LayerCatalog.generation).
+    version: Optional[str] = None
+
 
 # TODO: Check if we can reuse the connection of TIPG. At the moment it was considered easier to just open a new connection.
 class LayerCatalog:
     def __init__(self, app: FastAPI = None):
         self.listener_task = None
         self.app = app
+        # Last change of the features of each collection, as the marker carried by the notifications
+        # (see split_change), None after a notification without marker. Together with the version of
+        # the collection it makes the generation.
+        self.changes: Dict[str, Optional[str]] = {}
+        # State of the listener and time the catalog was last read or updated, reported by /readyz
+        self.listener_state = "starting"
+        self.listener_connected_since: Optional[float] = None
+        self.listener_disconnected_since: Optional[float] = time.time()
+        self.listener_error: Optional[str] = None
+        self.catalog_read_at: Optional[float] = None
+        self.catalog_updated_at: Optional[float] = None
+        # Set once the catalog has been read for the first time
+        self.ready = asyncio.Event()
 
     @staticmethod
+    def listener_database_url() -> str:
+        """Return the database URL of the listener, which needs a session (LISTEN) of its own.
+
+        Behind PgBouncer in transaction pooling, the listener must connect to Postgres directly.
+        """
+        if geoapi_settings.listener_database_url:
+            return geoapi_settings.listener_database_url
+        if geoapi_settings.pgbouncer:
+            print(
+                "GEOAPI_LISTENER_DATABASE_URL is not set: the catalog listener connects through PgBouncer"
+                " and misses the notifications in transaction pooling"
+            )
+        return str(PostgresSettings().database_url)
+
     async def asyncpg_listen(
+        self,
         channel,
         notification_handler,
         reconnect_handler=None,
         *,
         conn_check_interval=60,
         conn_check_timeout=5,
-        reconnect_delay=0,
+        min_reconnect_delay=0.5,
+        max_reconnect_delay=30,
     ):
-        """Listen to a PostgreSQL channel using asyncpg."""
+        """Listen to a PostgreSQL channel using asyncpg.
+
+        A lost connection is noticed by the termination listener of asyncpg (or by the periodic check
+        if the connection hangs) and reopened with an exponential backoff with jitter.
+        """
+        attempt = 0
         while True:
+            conn = None
+            lost = asyncio.Event()
             try:
-                conn = await asyncpg.connect(str(PostgresSettings().database_url))
+                conn = await asyncpg.connect(self.listener_database_url())
+                conn.add_termination_listener(lambda _, lost=lost: lost.set())
                 await conn.add_listener(channel, notification_handler)
 
                 if reconnect_handler is not None:
                     await reconnect_handler(conn)
+                self.listener_state = "connected"
+                self.listener_connected_since = time.time()
+                self.listener_disconnected_since = None
+                attempt = 0
 
-                while True:
-                    await asyncio.sleep(conn_check_interval)
-                    await conn.execute("select 1", timeout=conn_check_timeout)
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), timeout=conn_check_interval)
+                    except asyncio.TimeoutError:
+                        await conn.execute("select 1", timeout=conn_check_timeout)
+                print(f"Listener connection on channel {channel} was lost")
 
             except asyncio.CancelledError:
                 print("Listener task was cancelled")
-                if conn:
+                self.listener_state = "stopped"
+                if conn is not None:
                     print("Closing connection")
                     await conn.close()
                 raise
 
-            except:  # noqa: E722
-                # Probably lost connection
-                pass
+            except Exception as e:
+                print(f"Listener on channel {channel} failed: {e!r}")
+                self.listener_error = repr(e)
+
+            self.listener_state = "reconnecting"
+            self.listener_connected_since = None
+            self.listener_disconnected_since = (
+                self.listener_disconnected_since or time.time()
+            )
+            metrics.inc("catalog_listener_reconnects")
+            if conn is not None:
+                conn.terminate()
 
-            if reconnect_delay > 0:
-                await asyncio.sleep(reconnect_delay)
+            delay = min(max_reconnect_delay, min_reconnect_delay * 2**attempt)
+            attempt += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
 
     async def start(self):
-        """Listen to the layer_changes channel."""
+        """Listen to the layer_changes and layer_feature_changes channels."""
         print("Starting catalog listener.")
         self.listener_task = asyncio.create_task(
             self.asyncpg_listen(
@@ -63,32 +134,154 @@ class LayerCatalog:
             )
         )
 
+    @staticmethod
+    def parse_bbox(bbox: Optional[str]) -> Optional[Tuple[float, float, float, float]]:
+        """Parse the bbox (xmin,ymin,xmax,ymax in EPSG:4326) of a notification payload."""
+        if not bbox:
+            return None
+        try:
+            xmin, ymin, xmax, ymax = map(float, bbox.split(","))
+        except ValueError:
+            print(f"Ignoring invalid bbox in notification: {bbox}")
+            return None
+        return (xmin, ymin, xmax, ymax)
+
+    @staticmethod
+    def split_change(payload: str) -> Tuple[str, Optional[str]]:
+        """Split the change marker from a notification payload ending with `@<change>`.
+
+        The marker is a value of the database identifying the change (e.g. txid_current() of the
+        trigger), the same for all instances receiving the notification.
+        """
+        payload, _, change = payload.partition("@")
+        return payload, change or None
+
+    def invalidate_tiles(
+        self, layer_id: str, bbox: Optional[str] = None, change: Optional[str] = None
+    ):
+        """Invalidate the cached tiles (only those intersecting the bbox if one is given) and aggregates of a layer."""
+        collection_id = self.collection_key(layer_id)
+        self.record_change(layer_id, change)
+        tile_archives = getattr(self.app.state, "tile_archives", None)
+        if tile_archives is not None:
+            tile_archives.invalidate(collection_id, change)
+        aggregate_cache = getattr(self.app.state, "aggregate_cache", None)
+        if aggregate_cache is not None:
+            aggregate_cache.invalidate(collection_id)
+        tile_cache = getattr(self.app.state, "tile_cache", None)
+        if tile_cache is None:
+            return
+        bbox = self.parse_bbox(bbox)
+        if bbox is not None:
+            tile_cache.invalidate_bbox(collection_id, bbox)
+        else:
+            tile_cache.invalidate(collection_id)
+
     async def listener_handler(self, conn, pid, channel, payload):
-        """Handle layer changes"""
-        operation, layer_id = payload.split(":", 1)
+        """Handle layer changes
+
+        The payload is `<operation>:<layer_id>`, optionally followed by `:<xmin>,<ymin>,<xmax>,<ymax>`,
+        the bbox of the changed features (old and new positions) for an UPDATE, and by `@<change>`.
+        The generation of the layer changes once the collection was replaced, so that the requests
+        seeing the new generation are rendered with the new collection.
+        """
+        payload, change = self.split_change(payload)
+        operation, layer_id, *bbox = payload.split(":", 2)
         print(
             f"Received notification on channel {channel}: {operation} on layer {layer_id}"
         )
-        new_conn = await asyncpg.connect(str(PostgresSettings().database_url))
-        try:
+        async with self.app.state.pool.acquire() as new_conn:
             if operation == "UPDATE":
                 await self.update_insert(layer_id, new_conn)
             elif operation == "DELETE":
                 await self.delete(layer_id)
             elif operation == "INSERT":
                 await self.update_insert(layer_id, new_conn)
-        finally:
-            await new_conn.close()
+        self.catalog_updated_at = time.time()
+        self.invalidate_tiles(
+            layer_id, bbox[0] if bbox and operation == "UPDATE" else None, change
+        )
+
+    async def feature_listener_handler(self, conn, pid, channel, payload):
+        """Handle feature changes of a layer which do not change the layer itself
+
+        The payload is `<layer_id>`, optionally followed by `:<xmin>,<ymin>,<xmax>,<ymax>` and by
+        `@<change>`. Only the cached tiles are invalidated, the collection is not read again.
+        """
+        payload, change = self.split_change(payload)
+        layer_id, *bbox = payload.split(":", 1)
+        self.invalidate_tiles(layer_id, bbox[0] if bbox else None, change)
 
     async def listener_reconnect_handler(self, conn):
         """Reconnect handler"""
+        await conn.add_listener("layer_feature_changes", self.feature_listener_handler)
         print("Reading catalog data")
+        start = time.perf_counter()
         self.app.state.collection_catalog = await self.read_catalog(conn)
+        metrics.observe("catalog_read_seconds", time.perf_counter() - start)
+        self.catalog_read_at = self.catalog_updated_at = time.time()
+        self.changes = {}
+        tile_cache = getattr(self.app.state, "tile_cache", None)
+        if tile_cache is not None:
+            tile_cache.clear()
+        self.ready.set()
 
     async def stop(self):
         """Unlisten to the layer_changes channel."""
         self.listener_task.cancel()
 
+    def health(self) -> dict:
+        """Return the state of the listener and the freshness of the catalog."""
+        now = time.time()
+        return {
+            "listener": self.listener_state,
+            "listener_connected_for": now - self.listener_connected_since
+            if self.listener_connected_since
+            else None,
+            "listener_disconnected_for": now - self.listener_disconnected_since
+            if self.listener_disconnected_since
+            else None,
+            "listener_error": self.listener_error,
+            "catalog_loaded": getattr(self.app.state, "collection_catalog", None)
+            is not None,
+            "catalog_age": now - self.catalog_read_at if self.catalog_read_at else None,
+            "catalog_updated_ago": now - self.catalog_updated_at
+            if self.catalog_updated_at
+            else None,
+        }
+
+    @staticmethod
+    def collection_key(layer_id: str) -> str:
+        """Return the collection id of a layer."""
+        return "user_data." + str(layer_id).replace("-", "")
+
+    def record_change(self, layer_id: str, change: Optional[str] = None):
+        """Mark a layer as changed.
+
+        The change marker of the notifications is required for the ETags of the layer: without it the
+        generation of the layer is unknown until the next notification with a marker or catalog read.
+        """
+        key = self.collection_key(layer_id)
+        if change is None:
+            print(f"Notification without change marker for layer {layer_id}")
+        self.changes[key] = change
+
+    def generation(self, collection_id: str) -> Optional[str]:
+        """Return the change generation of a collection or None if it is not in the catalog or unknown.
+
+        The generation only depends on durable data of the database: the updated_at of the layer and
+        the marker of its last notified feature change, so the instances give the same ETags for the
+        same content.
+        """
+        catalog = getattr(self.app.state, "collection_catalog", None)
+        if not catalog or collection_id not in catalog["collections"]:
+            return None
+        change = self.changes.get(collection_id, "0")
+        if change is None:
+            return None
+        version = getattr(catalog["collections"][collection_id], "version", None)
+        return f"{version}-{change}"
+
     async def get(self, layer_id: UUID = None, conn=None) -> List[dict]:
         """Get all layers when passing now layer_id or get the layer with the given layer_id."""
 
@@ -100,6 +293,7 @@ class LayerCatalog:
                 WITH with_bounds AS (
                 SELECT
                     l.*,
+                    (EXTRACT(EPOCH FROM l.updated_at) * 1000000)::bigint AS updated_at_us,
                     ST_XMin(e.e) AS xmin,
                     ST_YMin(e.e) AS ymin,
                     ST_XMax(e.e) AS xmax,
@@ -127,10 +321,17 @@ class LayerCatalog:
                         WHERE pg_class.relname = table_name
                         AND pg_class.relnamespace = 'user_data'::regnamespace
                     ) j ON TRUE
+                    -- Hash ranges of the shards, to route the tile queries of a distributed layer by shard
+                    LEFT JOIN LATERAL
+                    (
+                        SELECT jsonb_agg(jsonb_build_array(shardid, shardminvalue::int, shardmaxvalue::int) ORDER BY shardminvalue::int) AS shards
+                        FROM pg_dist_shard
+                        WHERE logicalrelid = j.table_name_distributed
+                    ) s ON TRUE
                 )
                 SELECT jsonb_build_object('type', "type", 'layer_id', id, 'user_id', replace(user_id::text, '-', ''), 'id', replace(id::text, '-', ''), 'name', name,
                         'bounds', COALESCE(array[xmin, ymin, xmax, ymax], ARRAY[-180, -90, 180, 90]),
-                        'attribute_mapping', attribute_mapping, 'feature_layer_type', feature_layer_type, 'geom_type', feature_layer_geometry_type, 'table_name', table_name, 'distributed', distributed)
+                        'attribute_mapping', attribute_mapping, 'feature_layer_type', feature_layer_type, 'geom_type', feature_layer_geometry_type, 'table_name', table_name, 'distributed', distributed, 'shards', shards, 'updated_at', updated_at_us)
                 FROM checked_distributed;
             """
         rows = await conn.fetch(sql)
@@ -196,7 +397,24 @@ class LayerCatalog:
                 table_columns=columns,
                 properties=columns,
                 distributed=obj["distributed"],
+                shards=[tuple(shard) for shard in obj.get("shards") or []],
+                clustering=geoapi_settings.clustering_policy("user_data." + obj["id"]),
+                version=str(obj.get("updated_at")),
+                fingerprint=hashlib.md5(
+                    json.dumps(obj, sort_keys=True).encode()
+                ).hexdigest(),
             )
+            # The clusters fall back to their first point without the attribute of their representative
+            policy = collection.clustering
+            if policy.representative == "max_attribute" and not any(
+                c.name == policy.representative_attribute for c in columns
+            ):
+                print(
+                    f"Clustering of {collection.id}: representative attribute "
+                    f"{policy.representative_attribute} is not an attribute of the layer, "
+                    "the first point of the clusters is used"
+                )
+
             # Append collection to collection object
             collections["user_data." + obj["id"]] = collection
 
@@ -204,9 +422,7 @@ class LayerCatalog:
 
     async def delete(self, layer_id):
         """Remove the corresponding collection for the given ID"""
-        collection_key = (
-            "user_data." + layer_id
-        )  # Assuming the ID corresponds directly to the collection key.
+        collection_key = self.collection_key(layer_id)
         if collection_key in self.app.state.collection_catalog["collections"]:
             del self.app.state.collection_catalog["collections"][collection_key]
 
@@ -218,6 +434,11 @@ class LayerCatalog:
             # Insert the new collection into the catalog
             self.app.state.collection_catalog["collections"].update(collections)
 
+    async def get_collection(self, collection_id: str, conn) -> Optional[Collection]:
+        """Build the collection of a single layer, e.g. for the command line tools."""
+        layer_objs = await self.get(collection_id.split(".")[1], conn)
+        return self.build_collection(layer_objs).get(collection_id)
+
     async def read_catalog(self, conn):
         """Initialize the catalog. It will load all feature layers from the database and build a collection object."""
         layer_objs = await self.get(conn=conn)
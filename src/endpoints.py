@@ -0,0 +1,627 @@
+import struct
+from typing import List, Literal, Optional, Tuple, get_args
+from uuid import UUID
+
+import orjson
+from asyncpg import PostgresError
+from buildpg import clauses, render
+from fastapi import APIRouter, Body, Depends, HTTPException, Path, Query, Request
+from morecantile import Tile
+from morecantile import tms as morecantile_tms
+from pydantic import BaseModel, Field
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Match
+from starlette.types import Scope
+from tipg import model
+from tipg.collections import Collection, ItemList
+from tipg.dependencies import (
+    ItemsResponseType,
+    accept_media_type,
+    bbox_query,
+    datetime_query,
+    function_parameters_query,
+    ids_query,
+    properties_query,
+    sortby_query,
+)
+from tipg.errors import (
+    InvalidDatetimeColumnName,
+    InvalidGeometryColumnName,
+    InvalidLimit,
+)
+from tipg.resources.enums import MediaType
+from tipg.settings import FeaturesSettings
+from typing_extensions import Annotated
+
+from src.aggregates import aggregate_query, histogram_bins, valid_aggregates
+from src.exts import (
+    CollectionParams,
+    filter_query,
+    layer_filter,
+    properties_filter_query,
+)
+from src.metrics import metrics
+from src.settings import geoapi_settings
+
+router = APIRouter()
+features_settings = FeaturesSettings()
+
+TILE_BATCH_MEDIA_TYPE = "application/vnd.goat.mvt-batch"
+# Query parameters of the batch endpoint selecting the tiles (not part of the tile cache key)
+TILE_BATCH_QUERY_PARAMS = {"tiles", "minx", "maxx", "miny", "maxy"}
+# Number of rows fetched at once from the cursor of a bulk request
+ITEMS_BULK_PREFETCH = 1000
+
+
+class GeoJSONItemsRoute(APIRoute):
+    """Route only matching the requests of GeoJSON output, the others are handled by the tipg route."""
+
+    def matches(self, scope: Scope) -> Tuple[Match, Scope]:
+        match, child_scope = super().matches(scope)
+        if match != Match.FULL:
+            return match, child_scope
+        if not geoapi_settings.items_geojson_from_database:
+            return Match.NONE, {}
+
+        # Same output type as the tipg route (`f` or the Accept header, GeoJSON by default)
+        output_type = QueryParams(scope["query_string"]).get("f")
+        if output_type is None:
+            media = accept_media_type(
+                Headers(scope=scope).get("accept", ""),
+                [MediaType[v] for v in get_args(ItemsResponseType)],
+            )
+            output_type = media.name if media is not None else "geojson"
+        if output_type != "geojson":
+            return Match.NONE, {}
+        return match, child_scope
+
+
+class BulkItemsRequest(BaseModel):
+    """Body of a bulk items request."""
+
+    ids: List[UUID] = Field(..., min_length=1, description="Ids of the features.")
+    properties: Optional[List[str]] = Field(
+        None, description="Properties to return. All properties by default."
+    )
+    geometry: bool = Field(True, description="Return the geometries.")
+
+
+def tiles_query(
+    z: int,
+    tiles: Optional[str] = None,
+    minx: Optional[int] = None,
+    maxx: Optional[int] = None,
+    miny: Optional[int] = None,
+    maxy: Optional[int] = None,
+    max_tiles: int = 64,
+) -> List[Tile]:
+    """Parse the tiles of a batch from a list (`x,y;x,y`) or a tile range of at most `max_tiles` tiles."""
+    too_many = HTTPException(
+        status_code=400,
+        detail=f"A batch can not contain more than {max_tiles} tiles.",
+    )
+    if tiles:
+        try:
+            coords = [tuple(map(int, t.split(","))) for t in tiles.split(";") if t]
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f"Invalid tiles: {tiles}")
+        if any(len(c) != 2 for c in coords):
+            raise HTTPException(status_code=422, detail=f"Invalid tiles: {tiles}")
+        tile_list = list(dict.fromkeys(Tile(x, y, z) for x, y in coords))
+        if len(tile_list) > max_tiles:
+            raise too_many
+        return tile_list
+
+    if None in (minx, maxx, miny, maxy):
+        raise HTTPException(
+            status_code=422,
+            detail="Either `tiles` or `minx`, `maxx`, `miny` and `maxy` must be set.",
+        )
+    if maxx < minx or maxy < miny:
+        raise HTTPException(
+            status_code=422,
+            detail="`maxx` and `maxy` must not be lower than `minx` and `miny`.",
+        )
+    # Checked before the tiles are listed: the range can be arbitrarily large
+    if (maxx - minx + 1) * (maxy - miny + 1) > max_tiles:
+        raise too_many
+    return [Tile(x, y, z) for x in range(minx, maxx + 1) for y in range(miny, maxy + 1)]
+
+
+@router.get(
+    "/collections/{collectionId}/tiles/{tileMatrixSetId}/{z}/batch",
+    response_class=StreamingResponse,
+    responses={200: {"content": {TILE_BATCH_MEDIA_TYPE: {}}}},
+    operation_id=".collection.vector.getTileBatch",
+    summary="Return several Vector Tiles of a zoom level in one response.",
+    tags=["OGC Tiles API"],
+)
+async def collection_get_tile_batch(
+    request: Request,
+    collection: Annotated[Collection, Depends(CollectionParams)],
+    tileMatrixSetId: Annotated[
+        Literal[tuple(morecantile_tms.list())],
+        Path(description="Identifier selecting one of the TileMatrixSetId supported."),
+    ],
+    z: Annotated[int, Path(ge=0, le=30, description="Zoom level of the tiles.")],
+    tiles: Annotated[
+        Optional[str], Query(description="Tiles to return, e.g. `x,y;x,y`.")
+    ] = None,
+    minx: Annotated[Optional[int], Query(ge=0)] = None,
+    maxx: Annotated[Optional[int], Query(ge=0)] = None,
+    miny: Annotated[Optional[int], Query(ge=0)] = None,
+    maxy: Annotated[Optional[int], Query(ge=0)] = None,
+    ids_filter: Annotated[Optional[List[str]], Depends(ids_query)] = None,
+    bbox_filter: Annotated[Optional[List[float]], Depends(bbox_query)] = None,
+    datetime_filter: Annotated[Optional[List[str]], Depends(datetime_query)] = None,
+    properties: Annotated[Optional[List[str]], Depends(properties_query)] = None,
+    cql_filter=Depends(filter_query),
+    geom_column: Annotated[
+        Optional[str],
+        Query(description="Select geometry column.", alias="geom-column"),
+    ] = None,
+    datetime_column: Annotated[
+        Optional[str],
+        Query(description="Select datetime column.", alias="datetime-column"),
+    ] = None,
+    limit: Annotated[
+        Optional[int],
+        Query(description="Limits the number of features in each tile."),
+    ] = None,
+):
+    """Return Vector Tiles of one zoom level as a stream of length-prefixed tiles.
+
+    Each tile is preceded by a header of four big-endian unsigned 32-bit integers: z, x, y and the
+    length of the tile in bytes. The tiles are written in the order they are ready.
+    """
+    tms = morecantile_tms.get(tileMatrixSetId)
+    tile_list = tiles_query(
+        z, tiles, minx, maxx, miny, maxy, geoapi_settings.tile_batch_max_tiles
+    )
+    if z < tms.minzoom or z > tms.maxzoom:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Invalid zoom level {z} for {tileMatrixSetId} ({tms.minzoom} to {tms.maxzoom}).",
+        )
+    matrix = tms.matrix(z)
+    for tile in tile_list:
+        if not (0 <= tile.x < matrix.matrixWidth and 0 <= tile.y < matrix.matrixHeight):
+            raise HTTPException(status_code=422, detail=f"Invalid tile: {tile}.")
+
+    # Checked before the response starts, errors in the stream would truncate a 200 response
+    if limit is not None and limit > geoapi_settings.max_features_per_tile:
+        raise InvalidLimit(
+            f"Limit can not be set higher than the `tipg_max_features_per_tile` setting of {geoapi_settings.max_features_per_tile}"
+        )
+    geometry_column = collection.get_geometry_column(geom_column)
+    if not geometry_column:
+        raise InvalidGeometryColumnName(f"Invalid Geometry Column Name {geom_column}")
+    if datetime_filter and not collection.get_datetime_column(datetime_column):
+        raise InvalidDatetimeColumnName(f"Invalid Datetime Column: {datetime_column}.")
+
+    # Serve the tiles which are already cached and render the others together
+    cache = getattr(request.app.state, "tile_cache", None)
+    query = str(
+        QueryParams(
+            [
+                (k, v)
+                for k, v in request.query_params.multi_items()
+                if k not in TILE_BATCH_QUERY_PARAMS
+            ]
+        )
+    )
+    cached = {}
+    if cache is not None:
+        for tile in tile_list:
+            key = cache.key(collection.id, tms.id, tile.z, tile.x, tile.y, query)
+            # Stale tiles are rendered again with the others
+            cached_tile = cache.get(key)
+            if cached_tile is not None and cached_tile.stale_since is None:
+                cached[tile] = cached_tile.content["identity"]
+    version = cache.version(collection.id) if cache is not None else None
+
+    def encode(tile: Tile, data: bytes) -> bytes:
+        return struct.pack(">IIII", tile.z, tile.x, tile.y, len(data)) + data
+
+    async def stream():
+        for tile, data in cached.items():
+            yield encode(tile, data)
+
+        missing = [tile for tile in tile_list if tile not in cached]
+        if not missing:
+            return
+        async for tile, data in collection.get_tiles(
+            pool=request.app.state.pool,
+            tms=tms,
+            tiles=missing,
+            concurrency=geoapi_settings.tile_batch_concurrency,
+            ids_filter=ids_filter,
+            bbox_filter=bbox_filter,
+            datetime_filter=datetime_filter,
+            properties_filter=properties_filter_query(request, collection),
+            cql_filter=cql_filter,
+            properties=properties,
+            geom=geometry_column.name,
+            dt=datetime_column,
+            limit=limit,
+        ):
+            if cache is not None:
+                key = cache.key(collection.id, tms.id, tile.z, tile.x, tile.y, query)
+                await cache.put(key, data, version)
+            yield encode(tile, data)
+
+    return StreamingResponse(stream(), media_type=TILE_BATCH_MEDIA_TYPE)
+
+
+@router.post(
+    "/collections/{collectionId}/items/bulk",
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {"application/geo+json": {}, "application/x-ndjson": {}}}
+    },
+    operation_id=".collection.getItemsBulk",
+    summary="Return the features of a list of ids.",
+    tags=["OGC Features API"],
+)
+async def collection_get_items_bulk(
+    request: Request,
+    collection: Annotated[Collection, Depends(CollectionParams)],
+    body: Annotated[BulkItemsRequest, Body()],
+    output_type: Annotated[
+        Literal["geojson", "ndjson"],
+        Query(alias="f", description="Response MediaType."),
+    ] = "geojson",
+):
+    """Stream the features of a list of ids, selected with one `= ANY(<ids>::uuid[])` condition.
+
+    The features are read with a server-side cursor and written as they are fetched, either as a
+    GeoJSON FeatureCollection or as newline delimited GeoJSON features. A query failing once the
+    response has started ends it with an error: an `error` member of the FeatureCollection or a last
+    line of type `Error`.
+    """
+    if len(body.ids) > geoapi_settings.items_bulk_max_ids:
+        raise HTTPException(
+            status_code=422,
+            detail=f"A bulk request can not contain more than {geoapi_settings.items_bulk_max_ids} ids.",
+        )
+
+    c = clauses.Clauses(
+        collection._select(
+            properties=body.properties,
+            geometry_column=collection.get_geometry_column() if body.geometry else None,
+            bbox_only=None,
+            simplify=None,
+        ),
+        collection._from(None),
+        collection._where(
+            ids=[str(feature_id) for feature_id in body.ids],
+            cql=layer_filter(collection.id, collection),
+        ),
+    )
+    q, p = render(":c", c=c)
+
+    def encode(row) -> bytes:
+        props = dict(row)
+        return orjson.dumps(
+            {
+                "type": "Feature",
+                "id": props.pop("tipg_id"),
+                "geometry": props.pop("tipg_geom"),
+                "properties": props,
+            },
+            default=str,
+        )
+
+    async def stream():
+        if output_type == "geojson":
+            yield b'{"type":"FeatureCollection","features":['
+        first = True
+        try:
+            async with request.app.state.pool.acquire() as conn:
+                async with conn.transaction():
+                    timeout = int(geoapi_settings.items_bulk_statement_timeout * 1000)
+                    await conn.execute(f"SET LOCAL statement_timeout = {timeout}")
+                    async for row in conn.cursor(q, *p, prefetch=ITEMS_BULK_PREFETCH):
+                        if output_type == "ndjson":
+                            yield encode(row) + b"\n"
+                        else:
+                            yield encode(row) if first else b"," + encode(row)
+                        first = False
+        except PostgresError as e:
+            print(f"Bulk items of {collection.id} failed: {e!r}")
+            metrics.inc("items_bulk_failed")
+            error = {"code": type(e).__name__, "description": str(e)}
+            if output_type == "ndjson":
+                yield orjson.dumps({"type": "Error", **error}) + b"\n"
+            else:
+                yield b'],"error":' + orjson.dumps(error) + b"}"
+            return
+        if output_type == "geojson":
+            yield b"]}"
+
+    return StreamingResponse(
+        stream(),
+        media_type="application/geo+json"
+        if output_type == "geojson"
+        else "application/x-ndjson",
+    )
+
+
+@router.get(
+    "/collections/{collectionId}/aggregate",
+    operation_id=".collection.getAggregate",
+    summary="Return an aggregate of the features or of one of their attributes.",
+    tags=["OGC Features API"],
+)
+async def collection_get_aggregate(
+    request: Request,
+    collection: Annotated[Collection, Depends(CollectionParams)],
+    aggregate: Annotated[
+        Literal["count", "minmax", "quantiles", "histogram", "distinct"],
+        Query(description="Aggregate to compute."),
+    ] = "count",
+    column: Annotated[
+        Optional[str],
+        Query(description="Attribute to aggregate (all aggregates but `count`)."),
+    ] = None,
+    breaks: Annotated[
+        int,
+        Query(ge=1, le=100, description="Number of quantiles or histogram bins."),
+    ] = 5,
+    limit: Annotated[
+        int, Query(ge=1, le=10000, description="Maximum number of distinct values.")
+    ] = 100,
+    bbox_filter: Annotated[Optional[List[float]], Depends(bbox_query)] = None,
+    cql_filter=Depends(filter_query),
+):
+    """Aggregate the features of a layer of the catalog matching the filters.
+
+    - `count`: number of features
+    - `minmax`: minimum, maximum and number of values of the attribute
+    - `quantiles`: `breaks` + 1 values of the attribute splitting the features into `breaks` classes of equal size
+    - `histogram`: `breaks` bins of equal width between the minimum and maximum with their number of features
+    - `distinct`: most frequent values of the attribute with their number of features
+
+    The aggregates available for an attribute depend on its type. The results are cached until the
+    layer changes.
+    """
+    layer_catalog = getattr(request.app.state, "layer_catalog", None)
+    generation = (
+        layer_catalog.generation(collection.id) if layer_catalog is not None else None
+    )
+    if generation is None or not collection.id.startswith("user_data."):
+        raise HTTPException(
+            status_code=404,
+            detail=f"Aggregates are not available for {collection.id}.",
+        )
+
+    attribute = None
+    if aggregate != "count":
+        attribute = next(
+            (
+                c
+                for c in collection.properties
+                if c.name == column and not c.is_geometry
+            ),
+            None,
+        )
+        if attribute is None:
+            raise HTTPException(
+                status_code=422,
+                detail=f"The `{aggregate}` aggregate needs the `column` of an attribute of the layer.",
+            )
+        if aggregate not in valid_aggregates(attribute):
+            raise HTTPException(
+                status_code=422,
+                detail=f"The `{aggregate}` aggregate is not available for the {attribute.type} attribute {column}.",
+            )
+
+    cache = getattr(request.app.state, "aggregate_cache", None)
+    query = "&".join(sorted(request.url.query.split("&")))
+    if cache is not None:
+        result = cache.get(collection.id, generation, query)
+        if result is not None:
+            return result
+
+    from_clause = collection._from(None)
+    where_clause = collection._where(
+        bbox=bbox_filter,
+        properties=properties_filter_query(request, collection),
+        cql=cql_filter,
+    )
+
+    def build(operation: str, **kwargs):
+        return aggregate_query(
+            operation,
+            from_clause,
+            where_clause,
+            column=attribute,
+            breaks=breaks,
+            limit=limit,
+            **kwargs,
+        )
+
+    result = {"collection": collection.id, "aggregate": aggregate, "column": column}
+    async with request.app.state.pool.acquire() as conn:
+        if aggregate == "histogram":
+            bounds = await conn.fetchrow(*build("minmax"))
+            if not bounds["count"]:
+                result["bins"] = []
+            elif bounds["min"] == bounds["max"]:
+                result["bins"] = [
+                    {
+                        "min": bounds["min"],
+                        "max": bounds["max"],
+                        "count": bounds["count"],
+                    }
+                ]
+            else:
+                bounds = (float(bounds["min"]), float(bounds["max"]))
+                rows = await conn.fetch(*build("histogram", bounds=bounds))
+                result["bins"] = histogram_bins(rows, bounds, breaks)
+        elif aggregate == "distinct":
+            rows = await conn.fetch(*build("distinct"))
+            result["values"] = [dict(row) for row in rows]
+        else:
+            row = await conn.fetchrow(*build(aggregate))
+            result.update(dict(row))
+
+    if cache is not None:
+        cache.put(collection.id, generation, query, result)
+    return result
+
+
+def items_links(
+    request: Request, collection: Collection, item_list: ItemList
+) -> List[model.Link]:
+    """Return the links of an items response: collection, self and the pages of the item list."""
+    items_href = str(request.url_for("items", collectionId=collection.id))
+    links = [
+        model.Link(
+            title="Collection",
+            href=str(request.url_for("collection", collectionId=collection.id)),
+            rel="collection",
+            type=MediaType.json,
+        ),
+        model.Link(
+            title="Items",
+            href=items_href
+            + ("?" + str(request.query_params) if request.query_params else ""),
+            rel="self",
+            type=MediaType.geojson,
+        ),
+    ]
+    if item_list["next"]:
+        query_params = QueryParams(
+            {**request.query_params, "offset": item_list["next"]}
+        )
+        links.append(
+            model.Link(
+                title="Next page",
+                href=f"{items_href}?{query_params}",
+                rel="next",
+                type=MediaType.geojson,
+            )
+        )
+    if item_list["prev"] is not None:
+        qp = dict(request.query_params)
+        qp.pop("offset", None)
+        query_params = QueryParams({**qp, "offset": item_list["prev"]})
+        links.append(
+            model.Link(
+                title="Previous page",
+                href=f"{items_href}?{query_params}",
+                rel="prev",
+                type=MediaType.geojson,
+            )
+        )
+    return links
+
+
+async def collection_get_items_geojson(
+    request: Request,
+    collection: Annotated[Collection, Depends(CollectionParams)],
+    ids_filter: Annotated[Optional[List[str]], Depends(ids_query)],
+    bbox_filter: Annotated[Optional[List[float]], Depends(bbox_query)],
+    datetime_filter: Annotated[Optional[List[str]], Depends(datetime_query)],
+    properties: Annotated[Optional[List[str]], Depends(properties_query)],
+    cql_filter=Depends(filter_query),
+    sortby: Annotated[Optional[str], Depends(sortby_query)] = None,
+    geom_column: Annotated[
+        Optional[str],
+        Query(description="Select geometry column.", alias="geom-column"),
+    ] = None,
+    datetime_column: Annotated[
+        Optional[str],
+        Query(description="Select datetime column.", alias="datetime-column"),
+    ] = None,
+    limit: Annotated[
+        int,
+        Query(
+            ge=0,
+            le=features_settings.max_features_per_query,
+            description="Limits the number of features in the response.",
+        ),
+    ] = features_settings.default_features_limit,
+    offset: Annotated[
+        Optional[int], Query(ge=0, description="Starts the response at an offset.")
+    ] = None,
+    bbox_only: Annotated[
+        Optional[bool],
+        Query(
+            description="Only return the bounding box of the feature.",
+            alias="bbox-only",
+        ),
+    ] = None,
+    simplify: Annotated[
+        Optional[float],
+        Query(
+            description="Simplify the output geometry to given threshold in decimal degrees."
+        ),
+    ] = None,
+    output_type: Annotated[
+        Optional[Literal["geojson"]],
+        Query(alias="f", description="Response MediaType."),
+    ] = None,
+):
+    """Return the features as a GeoJSON FeatureCollection with the features built by Postgres.
+
+    Each feature is returned as json text by the query (see features_geojson) and only joined into
+    the envelope, which is the one of the tipg items endpoint.
+    """
+    item_list = await collection.features_geojson(
+        request.app.state.pool,
+        collection_href=str(request.url_for("collection", collectionId=collection.id)),
+        item_href=str(
+            request.url_for("item", collectionId=collection.id, itemId="{itemId}")
+        ).replace("%7BitemId%7D", "{itemId}"),
+        ids_filter=ids_filter,
+        bbox_filter=bbox_filter,
+        datetime_filter=datetime_filter,
+        properties_filter=properties_filter_query(request, collection),
+        function_parameters=function_parameters_query(request, collection),
+        cql_filter=cql_filter,
+        sortby=sortby,
+        properties=properties,
+        limit=limit,
+        offset=offset,
+        geom=geom_column,
+        dt=datetime_column,
+        bbox_only=bbox_only,
+        simplify=simplify,
+    )
+
+    envelope = orjson.dumps(
+        {
+            "type": "FeatureCollection",
+            "id": collection.id,
+            "title": collection.title or collection.id,
+            "description": collection.description or collection.title or collection.id,
+            "numberMatched": item_list["matched"],
+            "numberReturned": len(item_list["items"]),
+            "links": [
+                link.model_dump(exclude_none=True, mode="json")
+                for link in items_links(request, collection, item_list)
+            ],
+        }
+    )
+    features = ",".join(item_list["items"]).encode()
+    content = envelope[:-1] + b',"features":[' + features + b"]}"
+    return Response(content, media_type=MediaType.geojson.value)
+
+
+# Added after the other routes with a route class only matching the GeoJSON requests
+router.add_api_route(
+    "/collections/{collectionId}/items",
+    collection_get_items_geojson,
+    methods=["GET"],
+    response_class=Response,
+    responses={200: {"content": {MediaType.geojson.value: {}}}},
+    operation_id=".collection.getItemsGeoJSON",
+    summary="Return the features of a collection as GeoJSON built by the database.",
+    tags=["OGC Features API"],
+    include_in_schema=False,
+    route_class_override=GeoJSONItemsRoute,
+)
@@ -7,10 +7,22 @@ The original code/repository is licensed under MIT License.
 ---------------------------------------------------------------------------------
 """
 
-from typing import Dict, Optional, List, Tuple, Callable, Any
+import asyncio
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, List, Tuple, Callable, Any
+from fastapi import HTTPException, Path
 from buildpg import clauses, funcs as pg_funcs, RawDangerous as raw, logic
-from tipg.collections import Column, geojson_schema, debug_query
-from tipg.dependencies import Query
+from tipg.collections import (
+    Collection,
+    Column,
+    ItemList,
+    geojson_schema,
+    debug_query,
+)
+from tipg.dependencies import CollectionParams as TipgCollectionParams, Query
 from pygeofilter.parsers.cql2_json import parse as cql2_json_parser
 from typing_extensions import Annotated
 from pygeofilter.ast import AstType
@@ -26,10 +38,9 @@ from tipg.errors import (
 from tipg.filter.evaluate import to_filter
 from tipg.filter.filters import bbox_to_wkt
 from inspect import signature
-from buildpg.funcs import any
 from buildpg.logic import Func
 from buildpg import logic, render
-from tipg.settings import MVTSettings
+from tipg.settings import FeaturesSettings, MVTSettings
 from tipg.errors import (
     InvalidGeometryColumnName,
     InvalidLimit,
@@ -37,6 +48,9 @@ from tipg.errors import (
 
 
 from buildpg import V, S, render
+from src.metrics import metrics
+from src.mvt import MVT_TYPES, encode_tile, get_encoder_pool, merge_tiles
+from src.settings import ClusteringPolicy, geoapi_settings
 
 
 def show(component):
@@ -67,19 +81,98 @@ def _from(self, function_parameters: Optional[Dict[str, str]]):
 
 
 mvt_settings = MVTSettings()
+mvt_settings.max_features_per_tile = geoapi_settings.max_features_per_tile
+features_settings = FeaturesSettings()
+
+
+# SQL texts of the recently run tile queries. As the tile coordinates are bind parameters, the text only
+# depends on the collection and branch, so asyncpg can reuse its prepared statements.
+recent_statements: "OrderedDict[int, None]" = OrderedDict()
+max_recent_statements = 1000
+
+
+def track_statement(q: str, branch: str):
+    """Count whether the SQL text of a tile query was already run (prepared statement reuse)."""
+    key = hash(q)
+    if key in recent_statements:
+        recent_statements.move_to_end(key)
+        metrics.inc("tile_statements_reused")
+        metrics.inc(f"tile_statements_reused.{branch}")
+        return
+
+    recent_statements[key] = None
+    if len(recent_statements) > max_recent_statements:
+        recent_statements.popitem(last=False)
+    metrics.inc("tile_statements_new")
+    metrics.inc(f"tile_statements_new.{branch}")
+
+
+class TileConnection:
+    """Pool handing out one connection, acquired on first use and reused by all the queries of a tile.
+
+    The queries of a tile (cluster columns, feature count, h3_3 grids and the tile itself) run one
+    after the other: they share a connection instead of queueing for the pool before each of them.
+    """
 
+    def __init__(self, pool: asyncpg.BuildPgPool):
+        self.pool = pool
+        self.stack = AsyncExitStack()
+        self.conn = None
 
-def real_columns(properties: Optional[List[str]]) -> List[str]:
-    """Return table columns optionally filtered to only include columns from properties."""
+    @asynccontextmanager
+    async def acquire(self):
+        if self.conn is None:
+            self.conn = await self.stack.enter_async_context(self.pool.acquire())
+        yield self.conn
+
+    async def release(self):
+        """Give the connection back to the pool."""
+        self.conn = None
+        await self.stack.aclose()
+
+
+async def fetch_tile_query(
+    pool: asyncpg.BuildPgPool,
+    q: str,
+    p: list,
+    *,
+    tile: Tile,
+    branch: str,
+    method: str = "fetchval",
+):
+    """Run a tile query with the statement timeout of its branch and count cancelled queries."""
+    timeout = geoapi_settings.tile_statement_timeout(branch, tile.z)
+    debug_query(q, *p)
+    track_statement(q, branch)
+    try:
+        async with pool.acquire() as conn:
+            return await getattr(conn, method)(q, *p, timeout=timeout)
+    except asyncio.CancelledError:
+        # asyncpg cancels the running statement on the server before releasing the connection.
+        metrics.inc("tile_queries_cancelled")
+        metrics.inc(f"tile_queries_cancelled.{branch}")
+        raise
+    except asyncio.TimeoutError:
+        metrics.inc("tile_queries_timed_out")
+        metrics.inc(f"tile_queries_timed_out.{branch}")
+        raise HTTPException(
+            status_code=504,
+            detail=f"Tile query exceeded the statement timeout of {timeout} seconds.",
+        )
+
+
+def projected_columns(self, properties: Optional[List[str]]) -> List[Column]:
+    """Return the non-geometry columns optionally filtered to only include columns from properties."""
     if properties in [[], [""]]:
         return []
 
-    cols = [
-        c.description for c in properties if c.type not in ["geometry", "geography"]
+    return [
+        c
+        for c in self.properties
+        if c.type not in ["geometry", "geography"]
+        and (properties is None or c.name in properties)
     ]
 
-    return cols
-
 
 def get_column(self, property_name: str) -> Optional[Column]:
     """Return column info."""
@@ -94,18 +187,24 @@ def _select_no_geo(self, properties: Optional[List[str]], addid: bool = True):
     """Construct a SELECT statement for the table."""
 
     nocomma = False
-    columns = self.columns(properties)
-    old_columns = real_columns(self.properties)
+    columns = projected_columns(self, properties)
     if columns:
         select_query = "SELECT "
-        for i, column in enumerate(columns):
+        for column in columns:
             # Check if the column is a jsonb column and cast it to text
-            if "jsonb" in old_columns[i]:
+            if "jsonb" in column.description:
                 select_query = (
-                    select_query + old_columns[i] + "::text" + ' AS "' + column + '", '
+                    select_query
+                    + column.description
+                    + "::text"
+                    + ' AS "'
+                    + column.name
+                    + '", '
                 )
             else:
-                select_query = select_query + old_columns[i] + ' AS "' + column + '", '
+                select_query = (
+                    select_query + column.description + ' AS "' + column.name + '", '
+                )
         select_query = select_query[:-2]
         sel = logic.as_sql_block(raw(select_query))
     else:
@@ -125,6 +224,220 @@ def _select_no_geo(self, properties: Optional[List[str]], addid: bool = True):
     return logic.as_sql_block(sel)
 
 
+def _select_geojson(
+    self,
+    properties: Optional[List[str]],
+    geometry_column: Optional[Column],
+    bbox_only: Optional[bool],
+    simplify: Optional[float],
+):
+    """Construct a SELECT statement of the id, the GeoJSON geometry and the properties of the features.
+
+    The properties are built as one json object by Postgres, the jsonb columns are cast to text like
+    in the other output formats (see _select_no_geo).
+    """
+    columns = projected_columns(self, properties)
+    if columns:
+        select_properties = ", ".join(
+            "{}{} AS {}".format(
+                c.description,
+                "::text" if "jsonb" in c.description else "",
+                '"' + c.name.replace('"', '""') + '"',
+            )
+            for c in columns
+        )
+        properties_clause = raw(
+            f"(SELECT to_json(p) FROM (SELECT {select_properties}) p) AS tipg_properties"
+        )
+    else:
+        properties_clause = raw("'{}'::json AS tipg_properties")
+
+    geom = self._geom(geometry_column, bbox_only, simplify)
+    if geom:
+        geom_clause = pg_funcs.cast(logic.Func("ST_AsGeoJSON", geom), "json")
+    else:
+        geom_clause = pg_funcs.cast(None, "json")
+
+    if self.id_column:
+        id_clause = logic.V(self.id_column.name).as_("tipg_id")
+    else:
+        id_clause = raw(" ROW_NUMBER () OVER () AS tipg_id ")
+
+    sel = logic.as_sql_block(
+        clauses.Clauses(logic.as_sql_block(raw("SELECT ")), id_clause)
+    )
+    return sel.comma(geom_clause.as_("tipg_geom")).comma(properties_clause)
+
+
+async def features_geojson(
+    self,
+    pool: asyncpg.BuildPgPool,
+    *,
+    collection_href: str,
+    item_href: str,
+    ids_filter: Optional[List[str]] = None,
+    bbox_filter: Optional[List[float]] = None,
+    datetime_filter: Optional[List[str]] = None,
+    properties_filter: Optional[List[Tuple[str, str]]] = None,
+    cql_filter: Optional[AstType] = None,
+    sortby: Optional[str] = None,
+    properties: Optional[List[str]] = None,
+    geom: Optional[str] = None,
+    dt: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: Optional[int] = None,
+    bbox_only: Optional[bool] = None,
+    simplify: Optional[float] = None,
+    function_parameters: Optional[Dict[str, str]] = None,
+) -> ItemList:
+    """Run the features query of Collection.features with the GeoJSON features built by Postgres.
+
+    The items are the features as json text, with the links of the tipg items endpoint (`item_href`
+    contains `{itemId}`). The validation and paging are the ones of Collection.features.
+    """
+    limit = limit or features_settings.default_features_limit
+    offset = offset or 0
+    function_parameters = function_parameters or {}
+
+    if geom and geom.lower() != "none" and not self.get_geometry_column(geom):
+        raise InvalidGeometryColumnName(f"Invalid Geometry Column: {geom}.")
+
+    if limit and limit > features_settings.max_features_per_query:
+        raise InvalidLimit(
+            f"Limit can not be set higher than the `tipg_max_features_per_query` setting of {features_settings.max_features_per_query}"
+        )
+
+    matched = await self._features_count_query(
+        pool=pool,
+        ids_filter=ids_filter,
+        datetime_filter=datetime_filter,
+        bbox_filter=bbox_filter,
+        properties_filter=properties_filter,
+        function_parameters=function_parameters,
+        cql_filter=cql_filter,
+        geom=geom,
+        dt=dt,
+    )
+
+    c = clauses.Clauses(
+        self._select_geojson(
+            properties=properties,
+            geometry_column=self.get_geometry_column(geom),
+            bbox_only=bbox_only,
+            simplify=simplify,
+        ),
+        self._from(function_parameters),
+        self._where(
+            ids=ids_filter,
+            datetime=datetime_filter,
+            bbox=bbox_filter,
+            properties=properties_filter,
+            cql=cql_filter,
+            geom=geom,
+            dt=dt,
+        ),
+        self._sortby(sortby),
+        clauses.Limit(limit),
+        clauses.Offset(offset),
+    )
+    q, p = render(
+        """
+        SELECT json_build_object(
+            'type', 'Feature',
+            'id', f.tipg_id,
+            'geometry', f.tipg_geom,
+            'properties', f.tipg_properties,
+            'links', json_build_array(
+                json_build_object(
+                    'title', 'Collection', 'href', :collection_href,
+                    'rel', 'collection', 'type', 'application/json'
+                ),
+                json_build_object(
+                    'title', 'Item', 'href', replace(:item_href, :item_id, f.tipg_id::text),
+                    'rel', 'item', 'type', 'application/geo+json'
+                )
+            )
+        )::text
+        FROM (:c) f
+        """,
+        c=c,
+        collection_href=collection_href,
+        item_href=item_href,
+        item_id="{itemId}",
+    )
+    debug_query(q, *p)
+    async with pool.acquire() as conn:
+        features = [row[0] for row in await conn.fetch(q, *p)]
+    returned = len(features)
+
+    return ItemList(
+        items=features,
+        matched=matched,
+        next=offset + returned if matched - returned > offset else None,
+        prev=max(offset - limit, 0) if offset else None,
+    )
+
+
+def _select_mvt(
+    self,
+    properties: Optional[List[str]],
+    geometry_column: Column,
+    tms: TileMatrixSet,
+    tile: Tile,
+):
+    """Create MVT from intersecting geometries. Geometry-only tiles (`properties=[]`) select only the geometry."""
+    geom = pg_funcs.cast(logic.V(geometry_column.name), "geometry")
+
+    # make sure the geometries do not overflow the TMS bbox
+    if not tms.is_valid(tile):
+        geom = logic.Func(
+            "ST_Intersection",
+            logic.Func("ST_MakeEnvelope", *tms.bbox, 4326),
+            logic.Func("ST_Transform", geom, pg_funcs.cast(4326, "int")),
+        )
+
+    # Transform the geometries to TMS CRS using EPSG code or PROJ String
+    if tms_srid := tms.crs.to_epsg():
+        transform_logic = logic.Func(
+            "ST_Transform", geom, pg_funcs.cast(tms_srid, "int")
+        )
+    else:
+        transform_logic = logic.Func(
+            "ST_Transform", geom, pg_funcs.cast(tms.crs.to_proj4(), "text")
+        )
+
+    bbox = tms.xy_bounds(tile)
+    mvt_geom = logic.Func(
+        "ST_AsMVTGeom",
+        transform_logic,
+        logic.Func(
+            "ST_Segmentize",
+            logic.Func("ST_MakeEnvelope", bbox.left, bbox.bottom, bbox.right, bbox.top),
+            bbox.right - bbox.left,
+        ),
+        mvt_settings.tile_resolution,
+        mvt_settings.tile_buffer,
+        mvt_settings.tile_clip,
+    ).as_("geom")
+
+    if not projected_columns(self, properties):
+        return logic.as_sql_block(
+            clauses.Clauses(logic.as_sql_block(raw("SELECT ")), mvt_geom)
+        )
+    return self._select_no_geo(properties, addid=False).comma(mvt_geom)
+
+
+def any_array(values: List[Any], type: str):
+    """Match a list of values with `ANY($1::<type>[])`, binding them as one typed array."""
+    # Other types are parsed by Postgres from the text representation of the values
+    array = raw(f"{type}[]" if type in ["uuid", "text"] else f"text[]::{type}[]")
+    return pg_funcs.any(
+        logic.as_sql_block(logic.S([str(v) for v in values])).operate(
+            logic.Operator.cast, array
+        )
+    )
+
+
 def _where(  # noqa: C901
     self,
     ids: Optional[List[str]] = None,
@@ -143,35 +456,30 @@ def _where(  # noqa: C901
 
     # `ids` filter
     if ids is not None:
-        if len(ids) == 1:
-            wheres.append(
-                logic.V(self.id_column)
-                == pg_funcs.cast(
-                    pg_funcs.cast(ids[0], "text"), self.id_column_info.type
-                )
-            )
-        else:
-            w = [
-                logic.V(self.id_column)
-                == logic.S(
-                    pg_funcs.cast(pg_funcs.cast(i, "text"), self.id_column_info.type)
-                )
-                for i in ids
-            ]
-            wheres.append(pg_funcs.OR(*w))
+        wheres.append(
+            logic.V(self.id_column.name) == any_array(ids, self.id_column.type)
+        )
 
     # `properties filter
     if properties is not None:
-        w = []
+        values: Dict[str, List[Any]] = {}
         for prop, val in properties:
-            col = self.get_column(prop)
+            values.setdefault(prop, []).append(val)
+
+        w = []
+        for prop, vals in values.items():
+            # The properties filter uses the attribute names, the table the mapped columns
+            col = next((c for c in self.properties if c.name == prop), None)
             if not col:
                 raise InvalidPropertyName(f"Invalid property name: {prop}")
 
-            w.append(
-                logic.V(col.name)
-                == logic.S(pg_funcs.cast(pg_funcs.cast(val, "text"), col.type))
-            )
+            if len(vals) == 1:
+                w.append(
+                    logic.V(col.description)
+                    == logic.S(pg_funcs.cast(pg_funcs.cast(vals[0], "text"), col.type))
+                )
+            else:
+                w.append(logic.V(col.description) == any_array(vals, col.type))
 
         if w:
             wheres.append(pg_funcs.AND(*w))
@@ -259,25 +567,14 @@ def format_to_uuid(hex_string):
     return f"{hex_string[:8]}-{hex_string[8:12]}-{hex_string[12:16]}-{hex_string[16:20]}-{hex_string[20:]}"
 
 
-def filter_query(
-    request: Request,
-    query: Annotated[
-        Optional[str], Query(description="CQL2 Filter", alias="filter")
-    ] = None,
-) -> Optional[AstType]:
-    """Parse Filter Query."""
-
-    # Get layer_id from collectionId
-    collectionId = request.path_params["collectionId"].split(".")[1]
+def layer_filter(collection_id: str, layer=None, query: Optional[str] = None):
+    """Build the CQL2 filter of a layer, optionally combined with a CQL2 JSON query using the layer property names."""
     filter_layer_id = {
         "op": "=",
-        "args": [{"property": "layer_id"}, format_to_uuid(collectionId)],
+        "args": [{"property": "layer_id"}, format_to_uuid(collection_id.split(".")[1])],
     }
 
     if query is not None:
-        layer = request.app.state.collection_catalog["collections"].get(
-            request.path_params["collectionId"]
-        )
         column_mapping = {}
         for column in layer.properties:
             column_mapping[column.name] = column.description
@@ -287,15 +584,80 @@ def filter_query(
 
         # Add layer_id filter
         cql_dict = {"op": "and", "args": [cql_dict, filter_layer_id]}
-
-        data = cql2_json_parser(json.dumps(cql_dict))
-        return data
     else:
         cql_dict = filter_layer_id
 
     return cql2_json_parser(json.dumps(cql_dict))
 
 
+def filter_query(
+    request: Request,
+    query: Annotated[
+        Optional[str], Query(description="CQL2 Filter", alias="filter")
+    ] = None,
+) -> Optional[AstType]:
+    """Parse Filter Query."""
+    collection_id = request.path_params["collectionId"]
+    layer = None
+    if query is not None:
+        layer = request.app.state.collection_catalog["collections"].get(collection_id)
+
+    return layer_filter(collection_id, layer, query)
+
+
+def properties_filter_query(
+    request: Request,
+    collection: Collection,
+) -> List[Tuple[str, str]]:
+    """Get properties to filter on excluding reserved keys, with all the values of a repeated property."""
+    exclude = [
+        "f",
+        "ids",
+        "datetime",
+        "bbox",
+        "properties",
+        "filter",
+        "filter-lang",
+        "geom-column",
+        "datetime-column",
+        "limit",
+        "offset",
+        "bbox-only",
+        "simplify",
+        "sortby",
+    ]
+    table_property = [prop.name for prop in collection.properties]
+    return [
+        (key, value)
+        for (key, value) in request.query_params.multi_items()
+        if key.lower() not in exclude and key.lower() in table_property
+    ]
+
+
+async def CollectionParams(
+    request: Request,
+    collectionId: Annotated[str, Path(description="Collection identifier")],
+) -> Collection:
+    """Return the collection, waiting for the catalog if it has not been loaded yet."""
+    catalog = getattr(request.app.state, "collection_catalog", None)
+    layer_catalog = getattr(request.app.state, "layer_catalog", None)
+    if (
+        not catalog or collectionId not in catalog["collections"]
+    ) and layer_catalog is not None:
+        try:
+            await asyncio.wait_for(
+                layer_catalog.ready.wait(), geoapi_settings.catalog_wait_timeout
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=503,
+                detail="The catalog is loading.",
+                headers={"Retry-After": "1"},
+            )
+
+    return TipgCollectionParams(request, collectionId)
+
+
 def single_select_h3(
     self,
     properties: Optional[List[str]] = None,
@@ -303,6 +665,7 @@ def single_select_h3(
     ids: Optional[List[str]] = None,
     datetime: Optional[List[str]] = None,
     bbox: Optional[List[float]] = None,
+    properties_filter: Optional[List[Tuple[str, Any]]] = None,
     cql: Optional[AstType] = None,
     geom: Optional[str] = None,
     dt: Optional[str] = None,
@@ -324,7 +687,7 @@ def single_select_h3(
         ids=ids,
         datetime=datetime,
         bbox=bbox,
-        properties=properties,
+        properties=properties_filter,
         cql=cql,
         geom=geom,
         dt=dt,
@@ -347,7 +710,7 @@ def get_mvt_point(
     ids: Optional[List[str]] = None,
     datetime: Optional[List[str]] = None,
     bbox: Optional[List[float]] = None,
-    properties: Optional[List[Tuple[str, Any]]] = None,
+    properties_filter: Optional[List[Tuple[str, Any]]] = None,
     cql: Optional[AstType] = None,
     geom: Optional[str] = None,
     dt: Optional[str] = None,
@@ -355,8 +718,12 @@ def get_mvt_point(
     tms: Optional[TileMatrixSet] = None,
     geometry_column: Optional[str] = None,
     limit: Optional[int] = None,
+    properties: Optional[List[str]] = None,
 ):
-    """Construct a FROM statement for the table using a clustering logic build using h3."""
+    """Construct a FROM statement for the table using a clustering logic build using h3.
+
+    Only the columns of the `properties` projection are aggregated per cluster.
+    """
     select_clause = self._select_mvt(
         properties=properties,
         geometry_column=geometry_column,
@@ -370,7 +737,7 @@ def get_mvt_point(
         ids=ids,
         datetime=datetime,
         bbox=bbox,
-        properties=properties,
+        properties=properties_filter,
         cql=cql,
         geom=geom,
         dt=dt,
@@ -379,63 +746,305 @@ def get_mvt_point(
     )
     limit_clause = clauses.Limit(limit)
 
-    # Build the custom column selection query
+    # Representative of each cluster: the first point, the point with the largest value of an
+    # attribute (its other attributes are taken from the same point) or the centroid of the points
+    policy = clustering_policy(self)
+    order_by = ""
+    if policy.representative == "max_attribute":
+        attribute = next(
+            (c for c in self.properties if c.name == policy.representative_attribute),
+            None,
+        )
+        if attribute is not None:
+            order_by = f" ORDER BY {attribute.description} DESC NULLS LAST"
     select_unique_values = ""
-    for column in self.table_columns:
-        if column.name not in ["geom", "id", "layer_id", "h3_3"]:
-            select_unique_values += (
-                f"(ARRAY_AGG({column.description}))[1] AS {column.description}, "
-            )
-    select_unique_values = select_unique_values[:-2]
-
-    # Get the h3 resolution based on the zoom level
-    mapping_zoom_h3_resolution = {
-        11: 8,
-        10: 8,
-        9: 7,
-        8: 7,
-        7: 6,
-        6: 6,
-        5: 5,
-        4: 5,
-        3: 4,
-        2: 4,
-        1: 3,
-        0: 3,
-    }
-    h3_resolution = mapping_zoom_h3_resolution[tile.z]
+    for column in projected_columns(self, properties):
+        select_unique_values += (
+            f"(ARRAY_AGG({column.description}{order_by}))[1] AS {column.description}, "
+        )
+    if policy.representative == "centroid":
+        select_unique_values += "ST_Centroid(ST_Collect(geom)) AS geom"
+    else:
+        select_unique_values += f"(ARRAY_AGG(geom{order_by}))[1] AS geom"
+
+    h3_resolution = policy.h3_resolution(tile.z)
 
     q, p = render(
         f"""
         WITH clustered_points AS (
-            SELECT (ARRAY_AGG(layer_id))[1] AS layer_id, {select_unique_values}, (ARRAY_AGG(id))[1] AS id, (ARRAY_AGG(h3_3))[1] AS h3_3, (ARRAY_AGG(geom))[1] AS geom
+            SELECT {select_unique_values}
             :from_clause
             :where_clause
             AND cluster_keep = TRUE
-            AND ST_Intersects(geom, ST_Transform(ST_TileEnvelope({tile.z}, {tile.x}, {tile.y}), 4326))
-            GROUP BY h3_cell_to_parent(h3_group, {h3_resolution})
+            AND ST_Intersects(geom, ST_Transform(ST_TileEnvelope(:z, :x, :y), 4326))
+            GROUP BY h3_cell_to_parent(h3_group, :h3_resolution)
         ),
         selected AS (
             :select_clause
             FROM clustered_points
             :limit_clause
         )
-        SELECT ST_AsMVT(t.*, :layer_name) FROM selected t
+        {mvt_output(self, properties)} FROM selected t
         """,
         from_clause=from_clause,
         where_clause=where_clause,
         select_clause=select_clause,
         limit_clause=limit_clause,
-        layer_name=self.table if mvt_settings.set_mvt_layername is True else "default",
+        l=self.table if mvt_settings.set_mvt_layername is True else "default",
+        z=tile.z,
+        x=tile.x,
+        y=tile.y,
+        h3_resolution=h3_resolution,
     )
 
     return q, p
 
 
-async def get_tile(
+# Citus hash (hashint4) of the h3_3 grids, the distribution key of the distributed layers
+h3_3_hashes: Dict[int, int] = {}
+
+
+def clustering_policy(self) -> ClusteringPolicy:
+    """Return the clustering policy of the layer (the default policy for collections not built by the catalog)."""
+    return getattr(self, "clustering", None) or geoapi_settings.clustering
+
+
+def use_clustering(self, geometry_column: Column, tile: Tile) -> bool:
+    """Check if the tile of a point layer is at a zoom level where clustering can be used."""
+    policy = clustering_policy(self)
+    return (
+        geometry_column.geometry_type == "point"
+        and policy.enabled
+        and tile.z < policy.min_zoom
+    )
+
+
+async def has_cluster_columns(self, pool: asyncpg.BuildPgPool, tile: Tile) -> bool:
+    """Check if column h3_group and cluster_keep exists."""
+    q, p = render(
+        """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name = :table
+        AND column_name IN ('cluster_keep', 'h3_group')
+        """,
+        schema=self.dbschema,
+        table=self.table,
+    )
+    columns = await fetch_tile_query(
+        pool, q, p, tile=tile, branch="cluster", method="fetch"
+    )
+    return len(columns) == 2
+
+
+async def count_tile_features(
     self,
     *,
     pool: asyncpg.BuildPgPool,
+    tiles: List[Tile],
+    function_parameters: Optional[Dict[str, str]] = None,
+    max_count: int,
+) -> Dict[Tile, int]:
+    """Count the features of the layer (up to max_count) in each tile of a zoom level with one query."""
+    # Check the total feature count of the layer and therefore adapt the where query to only layer_id
+    filter_by_layer_id = {
+        "op": "=",
+        "args": [
+            {"property": "layer_id"},
+            format_to_uuid(self.id.split(".")[1]),
+        ],
+    }
+    filter_by_layer_id = cql2_json_parser(json.dumps(filter_by_layer_id))
+    filter_by_layer_id = to_filter(
+        filter_by_layer_id, [p.description for p in self.properties]
+    )
+    where_cnt = clauses.Where(filter_by_layer_id)
+    q, p = render(
+        """
+        SELECT t.x, t.y, (
+            SELECT COUNT(*) FROM (
+                SELECT id
+                :from_limit
+                :where_limit
+                AND ST_Intersects(geom, ST_Transform(ST_TileEnvelope(:z, t.x, t.y), 4326))
+                :limit
+            ) features_to_count
+        ) AS count
+        FROM unnest(:xs::int[], :ys::int[]) AS t(x, y)
+        """,
+        from_limit=self._from(function_parameters),
+        where_limit=where_cnt,
+        limit=clauses.Limit(max_count),
+        z=tiles[0].z,
+        xs=[tile.x for tile in tiles],
+        ys=[tile.y for tile in tiles],
+    )
+    rows = await fetch_tile_query(
+        pool, q, p, tile=tiles[0], branch="cluster", method="fetch"
+    )
+    return {Tile(row["x"], row["y"], tiles[0].z): row["count"] for row in rows}
+
+
+async def get_h3_3_grids(
+    self, pool: asyncpg.BuildPgPool, tiles: List[Tile]
+) -> Dict[Tile, List[int]]:
+    """Get the h3_3 grids intersecting each tile of a zoom level with one query."""
+    q, p = render(
+        """
+        SELECT DISTINCT t.x, t.y, h.h3_3, hashint4(h.h3_3::int) AS h3_3_hash
+        FROM unnest(:xs::int[], :ys::int[]) AS t(x, y)
+        JOIN basic.h3_3 h
+        ON ST_Intersects(h.geom, ST_Transform(ST_TileEnvelope(:z, t.x, t.y), 4326))
+        """,
+        z=tiles[0].z,
+        xs=[tile.x for tile in tiles],
+        ys=[tile.y for tile in tiles],
+    )
+    rows = await fetch_tile_query(
+        pool, q, p, tile=tiles[0], branch="distributed", method="fetch"
+    )
+    h3_3_grids: Dict[Tile, List[int]] = {tile: [] for tile in tiles}
+    for row in rows:
+        h3_3_grids[Tile(row["x"], row["y"], tiles[0].z)].append(row["h3_3"])
+        h3_3_hashes[row["h3_3"]] = row["h3_3_hash"]
+    return h3_3_grids
+
+
+def group_h3_3_by_shard(self, h3_3_grids: List[int]) -> Optional[Dict[int, List[int]]]:
+    """Group h3_3 grids by the shard of the layer they are stored in (None if it is not known)."""
+    if not self.shards or not all(h in h3_3_hashes for h in h3_3_grids):
+        return None
+
+    min_hashes = [shard[1] for shard in self.shards]
+    groups: Dict[int, List[int]] = {}
+    for h3_3_grid in h3_3_grids:
+        shard_id, _, max_hash = self.shards[
+            bisect_right(min_hashes, h3_3_hashes[h3_3_grid]) - 1
+        ]
+        if h3_3_hashes[h3_3_grid] > max_hash:
+            return None
+        groups.setdefault(shard_id, []).append(h3_3_grid)
+    return groups
+
+
+def mvt_output(self, properties: Optional[List[str]], alias: str = "t") -> str:
+    """Return the final SELECT of a tile query over the features `alias`.
+
+    The tile is encoded by ST_AsMVT, or with the python encoder the geometries are returned as WKB
+    with their properties (see encode_tile_rows). The properties ST_AsMVT encodes as strings are cast
+    to text, so that they are formatted by Postgres (timestamps, numerics...).
+    """
+    if geoapi_settings.tile_encoder != "python":
+        return f"SELECT ST_AsMVT({alias}.*, :l)"
+    columns = "".join(
+        ", {}.{}{}".format(
+            alias,
+            '"' + c.name.replace('"', '""') + '"',
+            "" if c.type in MVT_TYPES else "::text",
+        )
+        for c in projected_columns(self, properties)
+    )
+    return f"SELECT ST_AsBinary({alias}.geom) AS geom{columns}"
+
+
+async def encode_tile_rows(
+    self, properties: Optional[List[str]], rows: List[asyncpg.Record]
+) -> bytes:
+    """Encode the rows of a tile query into a vector tile in the encoder process pool."""
+    columns = projected_columns(self, properties)
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    data = await loop.run_in_executor(
+        get_encoder_pool(),
+        encode_tile,
+        self.table if mvt_settings.set_mvt_layername is True else "default",
+        [c.name for c in columns],
+        [(row[0], tuple(row)[1:]) for row in rows],
+        mvt_settings.tile_resolution,
+        [c.type for c in columns],
+    )
+    metrics.observe("tile_encoding_seconds", time.perf_counter() - start)
+    return data
+
+
+async def fetch_tile(
+    self,
+    pool: asyncpg.BuildPgPool,
+    q: str,
+    p: List[Any],
+    *,
+    tile: Tile,
+    branch: str,
+    properties: Optional[List[str]],
+) -> bytes:
+    """Run a tile query and return the tile, encoded by Postgres or by the python encoder."""
+    if geoapi_settings.tile_encoder != "python":
+        return await fetch_tile_query(pool, q, p, tile=tile, branch=branch)
+    rows = await fetch_tile_query(pool, q, p, tile=tile, branch=branch, method="fetch")
+    if isinstance(pool, TileConnection):
+        # No need to hold the connection while the tile is encoded
+        await pool.release()
+    return await encode_tile_rows(self, properties, rows)
+
+
+def distributed_tile_query(
+    self, h3_3_grids: List[int], order_by: str, **kwargs
+) -> Tuple[str, List[Any]]:
+    """Build the tile query of a distributed layer with one select per h3_3 grid merged with union all."""
+    selects = []
+    query_values = {}
+    for h3_3_grid in h3_3_grids:
+        h3_3_grid_string = str(h3_3_grid)
+        query = self.single_select_h3(h3_3=h3_3_grid, **kwargs)
+        selects.append(
+            f"""
+            (
+                :select_clause_{h3_3_grid_string}
+                :from_clause_{h3_3_grid_string}
+                :where_clause_{h3_3_grid_string}
+                {order_by}
+                :limit_clause_{h3_3_grid_string}
+            )
+            """
+        )
+        query_values.update(
+            {
+                f"select_clause_{h3_3_grid_string}": query["select_clause"],
+                f"from_clause_{h3_3_grid_string}": query["from_clause"],
+                f"where_clause_{h3_3_grid_string}": query["where_clause"],
+                f"limit_clause_{h3_3_grid_string}": query["limit_clause"],
+            }
+        )
+
+    union_query = "UNION ALL".join(selects)
+    return render(
+        f"""
+        WITH
+        t AS (
+            {union_query}
+        )
+        {mvt_output(self, kwargs.get("properties"))} FROM t
+        """,
+        **query_values,
+        l=self.table if mvt_settings.set_mvt_layername is True else "default",
+    )
+
+
+async def get_tile(self, *, pool: asyncpg.BuildPgPool, **kwargs):
+    """Build query to get Vector Tile, running the queries of the tile on one connection."""
+    tile_connection = TileConnection(pool)
+    start = time.perf_counter()
+    try:
+        return await _get_tile(self, pool=tile_connection, **kwargs)
+    finally:
+        await tile_connection.release()
+        metrics.observe_layer(self.id, time.perf_counter() - start)
+
+
+async def _get_tile(
+    self,
+    *,
+    pool: TileConnection,
     tms: TileMatrixSet,
     tile: Tile,
     ids_filter: Optional[List[str]] = None,
@@ -449,13 +1058,14 @@ async def get_tile(
     geom: Optional[str] = None,
     dt: Optional[str] = None,
     limit: Optional[int] = None,
+    clustering: Optional[bool] = None,
+    h3_3_grids: Optional[List[int]] = None,
 ):
-    """Build query to get Vector Tile."""
+    """Build query to get Vector Tile.
 
-    # TODO: Define this in the .env. For now changes where not taken effect from .env. Fix this.
-    mvt_settings.max_features_per_tile = 15000
-    min_zoom_clustering = 11
-    min_feature_cnt_clustering = 50000
+    The clustering decision and the h3_3 grids of distributed layers can be passed when they were
+    already computed for several tiles at once (see get_tiles).
+    """
 
     limit = limit or mvt_settings.max_features_per_tile
     geometry_column = self.get_geometry_column(geom)
@@ -467,10 +1077,6 @@ async def get_tile(
             f"Limit can not be set higher than the `tipg_max_features_per_tile` setting of {mvt_settings.max_features_per_tile}"
         )
 
-    # Build sql query to count the number of points in the tile
-    select_limit = self._select
-    from_limit = self._from(function_parameters)
-
     # Get order by geomtry size or length depending on the geometry type
     if geometry_column.geometry_type == "point":
         order_by = ""
@@ -479,137 +1085,95 @@ async def get_tile(
     elif geometry_column.geometry_type == "polygon":
         order_by = "ORDER BY ST_AREA(geom) DESC"
 
-    # If the layer is a point layer and the zoom level is less than 11, use clustering
-    if geometry_column.geometry_type == "point" and tile.z < min_zoom_clustering:
-        # Check if column h3_group and cluster_keep exists
-        q, p = render(
-            """
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_schema = :schema AND table_name = :table
-            AND column_name IN ('cluster_keep', 'h3_group')
-            """,
-            schema=self.dbschema,
-            table=self.table,
-        )
-        debug_query(q, *p)
-        async with pool.acquire() as conn:
-            columns = await conn.fetch(q, *p)
-
-        if len(columns) == 2:
-            # Check the total feature count of the layer and therefore adapt the where query to only layer_id
-            filter_by_layer_id = {
-                "op": "=",
-                "args": [
-                    {"property": "layer_id"},
-                    format_to_uuid(self.id.split(".")[1]),
-                ],
-            }
-            filter_by_layer_id = cql2_json_parser(json.dumps(filter_by_layer_id))
-            filter_by_layer_id = to_filter(
-                filter_by_layer_id, [p.description for p in self.properties]
+    # If the layer is a point layer below the minimum zoom of its clustering policy, use clustering
+    if clustering is None:
+        clustering = False
+        if self.use_clustering(
+            geometry_column, tile
+        ) and await self.has_cluster_columns(pool, tile):
+            # Counting stops at the threshold, which is all the decision needs
+            threshold = clustering_policy(self).min_feature_count or limit
+            counts = await self.count_tile_features(
+                pool=pool,
+                tiles=[tile],
+                function_parameters=function_parameters,
+                max_count=threshold,
             )
-            where_cnt = clauses.Where(filter_by_layer_id)
-            q, p = render(
-                f"""WITH features_to_count AS (
-                    SELECT id
-                    :from_limit
-                    :where_limit
-                    AND ST_Intersects(geom, ST_Transform(ST_TileEnvelope({tile.z}, {tile.x}, {tile.y}), 4326))
-                    :limit
-                )
-                SELECT COUNT(*) FROM features_to_count
-                """,
-                select_limit=select_limit,
-                from_limit=from_limit,
-                where_limit=where_cnt,
-                limit=clauses.Limit(min_feature_cnt_clustering),
-            )
-            async with pool.acquire() as conn:
-                count = await conn.fetchval(q, *p)
-
-            if count >= limit:
-                q, p = self.get_mvt_point(
-                    function_parameters=function_parameters,
-                    ids=ids_filter,
-                    datetime=datetime_filter,
-                    bbox=bbox_filter,
-                    properties=properties,
-                    cql=cql_filter,
-                    geom=geom,
-                    dt=dt,
-                    tile=tile,
-                    tms=tms,
-                    geometry_column=geometry_column,
-                    limit=limit,
-                )
-                async with pool.acquire() as conn:
-                    return await conn.fetchval(q, *p)
+            clustering = counts[tile] >= threshold
+
+    if clustering:
+        q, p = self.get_mvt_point(
+            function_parameters=function_parameters,
+            ids=ids_filter,
+            datetime=datetime_filter,
+            bbox=bbox_filter,
+            properties_filter=properties_filter,
+            cql=cql_filter,
+            geom=geom,
+            dt=dt,
+            tile=tile,
+            tms=tms,
+            geometry_column=geometry_column,
+            limit=limit,
+            properties=properties,
+        )
+        return await fetch_tile(
+            self, pool, q, p, tile=tile, branch="cluster", properties=properties
+        )
 
     # Check if distributed table to get relevant h3_3_grids
     if self.distributed is True:
-        q, p = render(
-            f"""
-            SELECT DISTINCT h3_3
-            FROM basic.h3_3
-            WHERE ST_Intersects(geom, ST_Transform(ST_TileEnvelope({tile.z}, {tile.x}, {tile.y}), 4326))
-            """
+        if h3_3_grids is None:
+            h3_3_grids = (await self.get_h3_3_grids(pool, [tile]))[tile]
+        if not h3_3_grids:
+            return b""
+
+        query_kwargs = {
+            "properties": properties,
+            "geometry_column": geometry_column,
+            "ids": ids_filter,
+            "datetime": datetime_filter,
+            "bbox": bbox_filter,
+            "properties_filter": properties_filter,
+            "cql": cql_filter,
+            "geom": geom,
+            "dt": dt,
+            "tile": tile,
+            "tms": tms,
+            "limit": limit,
+        }
+
+        # Issue one statement per shard, which Citus can route to the worker holding the shard
+        shard_groups = (
+            self.group_h3_3_by_shard(h3_3_grids)
+            if geoapi_settings.citus_shard_routing
+            else None
         )
-        debug_query(q, *p)
-        async with pool.acquire() as conn:
-            h3_3_grids = await conn.fetch(q, *p)
-            h3_3_grids = [row["h3_3"] for row in h3_3_grids]
-
-        # Build query for each h3_3_grid and merge with union all
-        union_query = ""
-        query_values = {}
-        for h3_3_grid in h3_3_grids:
-            h3_3_grid_string = str(h3_3_grid)
-            query = self.single_select_h3(
-                properties=properties,
-                geometry_column=geometry_column,
-                ids=ids_filter,
-                datetime=datetime_filter,
-                bbox=bbox_filter,
-                cql=cql_filter,
-                geom=geom,
-                dt=dt,
-                tile=tile,
-                tms=tms,
-                limit=limit,
-                h3_3=h3_3_grid,
-            )
-            union_query += f"""
-                (
-                    :select_clause_{h3_3_grid_string}
-                    :from_clause_{h3_3_grid_string}
-                    :where_clause_{h3_3_grid_string}
-                    {order_by}
-                    :limit_clause_{h3_3_grid_string}
+        if shard_groups is not None and len(shard_groups) > 1:
+            queries = [
+                distributed_tile_query(self, h3_3_cells, order_by, **query_kwargs)
+                for h3_3_cells in shard_groups.values()
+            ]
+            metrics.inc("tile_shard_routed_queries", len(queries))
+            method = "fetch" if geoapi_settings.tile_encoder == "python" else "fetchval"
+            # The shard queries run concurrently on connections of their own
+            await pool.release()
+            results = await asyncio.gather(
+                *(
+                    fetch_tile_query(
+                        pool.pool, q, p, tile=tile, branch="distributed", method=method
+                    )
+                    for q, p in queries
                 )
-                UNION ALL
-                """
-            query_values.update(
-                {
-                    f"select_clause_{h3_3_grid_string}": query["select_clause"],
-                    f"from_clause_{h3_3_grid_string}": query["from_clause"],
-                    f"where_clause_{h3_3_grid_string}": query["where_clause"],
-                    f"limit_clause_{h3_3_grid_string}": query["limit_clause"],
-                }
             )
+            if method == "fetch":
+                # The rows of all shards are encoded into one layer
+                return await encode_tile_rows(
+                    self, properties, [row for rows in results for row in rows]
+                )
+            return merge_tiles([bytes(t) for t in results if t])
 
-        union_query = union_query[:-26]
-        q, p = render(
-            f"""
-            WITH
-            t AS (
-                {union_query}
-            )
-            SELECT ST_AsMVT(t.*, :l) FROM t
-            """,
-            **query_values,
-            l=self.table if mvt_settings.set_mvt_layername is True else "default",
-        )
+        q, p = distributed_tile_query(self, h3_3_grids, order_by, **query_kwargs)
 
     else:
         q, p = render(
@@ -622,7 +1186,7 @@ async def get_tile(
                 {order_by}
                 :limit_clause
             )
-            SELECT ST_AsMVT(t.*, :l) FROM t
+            {mvt_output(self, properties)} FROM t
             """,
             select_clause=self._select_mvt(
                 properties=properties,
@@ -646,8 +1210,82 @@ async def get_tile(
             l=self.table if mvt_settings.set_mvt_layername is True else "default",
         )
 
-    async with pool.acquire() as conn:
-        return await conn.fetchval(q, *p)
+    return await fetch_tile(
+        self,
+        pool,
+        q,
+        p,
+        tile=tile,
+        branch="distributed" if self.distributed is True else "default",
+        properties=properties,
+    )
+
+
+async def get_tiles(
+    self,
+    *,
+    pool: asyncpg.BuildPgPool,
+    tms: TileMatrixSet,
+    tiles: List[Tile],
+    concurrency: int = 4,
+    function_parameters: Optional[Dict[str, str]] = None,
+    geom: Optional[str] = None,
+    limit: Optional[int] = None,
+    **kwargs,
+) -> AsyncIterator[Tuple[Tile, bytes]]:
+    """Render several tiles of one zoom level, yielding them as they are ready.
+
+    The clustering decision and the h3_3 grids are computed for all tiles at once and the tiles are
+    rendered on at most `concurrency` connections.
+    """
+    limit = limit or mvt_settings.max_features_per_tile
+    geometry_column = self.get_geometry_column(geom)
+    if not geometry_column:
+        raise InvalidGeometryColumnName(f"Invalid Geometry Column Name {geom}")
+
+    clustering = {tile: False for tile in tiles}
+    if self.use_clustering(
+        geometry_column, tiles[0]
+    ) and await self.has_cluster_columns(pool, tiles[0]):
+        threshold = clustering_policy(self).min_feature_count or limit
+        counts = await self.count_tile_features(
+            pool=pool,
+            tiles=tiles,
+            function_parameters=function_parameters,
+            max_count=threshold,
+        )
+        clustering = {tile: counts[tile] >= threshold for tile in tiles}
+
+    h3_3_grids = {}
+    if self.distributed is True and not all(clustering.values()):
+        h3_3_grids = await self.get_h3_3_grids(
+            pool, [tile for tile in tiles if not clustering[tile]]
+        )
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def render_tile(tile: Tile):
+        async with semaphore:
+            data = await self.get_tile(
+                pool=pool,
+                tms=tms,
+                tile=tile,
+                function_parameters=function_parameters,
+                geom=geom,
+                limit=limit,
+                clustering=clustering[tile],
+                h3_3_grids=h3_3_grids.get(tile),
+                **kwargs,
+            )
+            return tile, bytes(data) if data is not None else b""
+
+    tasks = [asyncio.ensure_future(render_tile(tile)) for tile in tiles]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 @property
@@ -693,8 +1331,8 @@ class Operator:
         "like": lambda f, a: f.like(a),
         "ilike": lambda f, a: f.ilike(a),
         "not_ilike": lambda f, a: ~f.ilike(a),
-        "in": lambda f, a: f == any(a),
-        "not_in": lambda f, a: ~f == any(a),
+        "in": lambda f, a: f == pg_funcs.any(a),
+        "not_in": lambda f, a: ~(f == pg_funcs.any(a)),
         "any": lambda f, a: f.any(a),
         "not_any": lambda f, a: f.not_(f.any(a)),
         "INTERSECTS": lambda f, a: Func(
@@ -0,0 +1,271 @@
+"""
+Index advisor for the user_data tables of the layers.
+
+All the layers of a user share one table per geometry type, so every tile query filters by `layer_id` and
+intersects the geometry: the tables need an index on layer_id, a GiST index on geom, an index on h3_3 when
+they are distributed and on h3_group when they are clustered. The largest of the most requested layers
+get a partial GiST index of their own, so that their tile scans do not read the rows of the other layers.
+"""
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg
+from buildpg import render
+
+SCHEMA = "user_data"
+MAX_IDENTIFIER_LENGTH = 63
+
+TABLES_QUERY = """
+    SELECT
+        c.relname AS table_name,
+        c.reltuples::bigint AS rows,
+        pg_total_relation_size(c.oid) AS size,
+        ARRAY(
+            SELECT a.attname::text FROM pg_attribute a
+            WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        ) AS columns
+    FROM pg_class c
+    WHERE c.relnamespace = :schema::regnamespace AND c.relname = ANY(:tables)
+"""
+
+INDEXES_QUERY = """
+    SELECT
+        c.relname AS table_name,
+        i.relname AS name,
+        am.amname AS method,
+        ARRAY(
+            SELECT a.attname::text
+            FROM unnest(x.indkey::int2[]) WITH ORDINALITY k(attnum, n)
+            JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = k.attnum
+            ORDER BY k.n
+        ) AS columns,
+        pg_get_expr(x.indpred, x.indrelid) AS predicate,
+        x.indisvalid AS valid,
+        pg_relation_size(i.oid) AS size
+    FROM pg_index x
+    JOIN pg_class c ON c.oid = x.indrelid
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_am am ON am.oid = i.relam
+    WHERE c.relnamespace = :schema::regnamespace AND c.relname = ANY(:tables)
+"""
+
+# Share of the rows of the most common layers of each table, from the statistics of the planner
+LAYER_ROWS_QUERY = """
+    SELECT tablename AS table_name, most_common_vals::text::text[] AS layer_ids, most_common_freqs AS freqs
+    FROM pg_stats
+    WHERE schemaname = :schema AND tablename = ANY(:tables) AND attname = 'layer_id'
+"""
+
+
+def index_name(table: str, suffix: str) -> str:
+    """Return the name of an index of a table, shortened with a hash to the length of the identifiers."""
+    name = f"{table}_{suffix}"
+    if len(name) > MAX_IDENTIFIER_LENGTH:
+        digest = hashlib.md5(table.encode()).hexdigest()[:8]
+        name = f"{table[:MAX_IDENTIFIER_LENGTH - len(suffix) - 10]}_{digest}_{suffix}"
+    return name
+
+
+def proposal(table: str, name: str, reason: str, definition: str) -> Dict[str, str]:
+    return {
+        "name": name,
+        "table": table,
+        "reason": reason,
+        "sql": f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON {SCHEMA}."{table}" {definition}',
+    }
+
+
+def missing_indexes(
+    table: Dict[str, Any], indexes: List[Dict[str, Any]], distributed: bool
+) -> List[Dict[str, str]]:
+    """Return the indexes a table needs for the tile queries and does not have."""
+    name = table["table_name"]
+    valid = [i for i in indexes if i["valid"] and i["predicate"] is None]
+    proposals = []
+
+    if not any(i["columns"][:1] == ["layer_id"] for i in valid):
+        proposals.append(
+            proposal(
+                name,
+                index_name(name, "layer_id_idx"),
+                "Every query filters by layer_id",
+                "(layer_id)",
+            )
+        )
+    if "geom" in table["columns"] and not any(
+        i["method"] == "gist" and "geom" in i["columns"] for i in valid
+    ):
+        proposals.append(
+            proposal(
+                name,
+                index_name(name, "geom_idx"),
+                "The tile queries intersect the geometry",
+                "USING gist (geom)",
+            )
+        )
+    if (
+        distributed
+        and "h3_3" in table["columns"]
+        and not any("h3_3" in i["columns"][:2] for i in valid)
+    ):
+        proposals.append(
+            proposal(
+                name,
+                index_name(name, "layer_id_h3_3_idx"),
+                "The tile queries of the distributed layers select the h3_3 grids of the tile",
+                "(layer_id, h3_3)",
+            )
+        )
+    if {"h3_group", "cluster_keep"} <= set(table["columns"]) and not any(
+        "h3_group" in i["columns"] for i in indexes if i["valid"]
+    ):
+        proposals.append(
+            proposal(
+                name,
+                index_name(name, "layer_id_h3_group_idx"),
+                "The clustered tiles group the kept points by h3_group",
+                "(layer_id, h3_group) WHERE cluster_keep",
+            )
+        )
+
+    # Indexes left invalid by a failed concurrent build slow down the writes without being used
+    for index in indexes:
+        if not index["valid"]:
+            proposals.append(
+                {
+                    "name": index["name"],
+                    "table": name,
+                    "reason": "The index is invalid (failed concurrent build)",
+                    "sql": f'REINDEX INDEX CONCURRENTLY {SCHEMA}."{index["name"]}"',
+                }
+            )
+    return proposals
+
+
+def layer_rows(
+    stats: Optional[Dict[str, Any]], rows: int, layer_id: str
+) -> Optional[int]:
+    """Estimate the number of rows of a layer in its table (None if it is not a most common value)."""
+    if stats is None or stats["layer_ids"] is None:
+        return None
+    if layer_id not in stats["layer_ids"]:
+        return None
+    return int(stats["freqs"][stats["layer_ids"].index(layer_id)] * rows)
+
+
+async def index_report(
+    conn: asyncpg.Connection,
+    layers: List[dict],
+    hot_layers: List[Tuple[str, Dict[str, float]]],
+    min_layer_rows: int,
+) -> dict:
+    """Report the indexes of the tables of the layers (from LayerCatalog.get) and the indexes to create.
+
+    The hot layers are the collections with their tile metrics, hottest first. A partial GiST index is
+    proposed for those with at least `min_layer_rows` rows, as estimated from the planner statistics
+    (not available for the distributed tables, which are sharded on the workers).
+    """
+    tables = sorted({layer["table_name"] for layer in layers})
+    distributed = {
+        layer["table_name"] for layer in layers if layer.get("distributed") is True
+    }
+
+    q, p = render(TABLES_QUERY, schema=SCHEMA, tables=tables)
+    table_rows = {row["table_name"]: dict(row) for row in await conn.fetch(q, *p)}
+    q, p = render(INDEXES_QUERY, schema=SCHEMA, tables=tables)
+    indexes: Dict[str, List[Dict[str, Any]]] = {}
+    for row in await conn.fetch(q, *p):
+        indexes.setdefault(row["table_name"], []).append(dict(row))
+    q, p = render(LAYER_ROWS_QUERY, schema=SCHEMA, tables=tables)
+    layer_stats = {row["table_name"]: dict(row) for row in await conn.fetch(q, *p)}
+
+    report_tables = []
+    proposals = []
+    for name in tables:
+        table = table_rows.get(name)
+        if table is None:
+            continue
+        missing = missing_indexes(table, indexes.get(name, []), name in distributed)
+        proposals += missing
+        report_tables.append(
+            {
+                "table": name,
+                "rows": table["rows"],
+                "size": table["size"],
+                "distributed": name in distributed,
+                "layers": sum(1 for layer in layers if layer["table_name"] == name),
+                "indexes": [
+                    {k: v for k, v in index.items() if k != "table_name"}
+                    for index in indexes.get(name, [])
+                ],
+                "missing": [m["name"] for m in missing],
+            }
+        )
+
+    layers_by_collection = {"user_data." + layer["id"]: layer for layer in layers}
+    report_hot_layers = []
+    for collection_id, stats in hot_layers:
+        layer = layers_by_collection.get(collection_id)
+        if layer is None or layer["table_name"] not in table_rows:
+            continue
+        table = layer["table_name"]
+        rows = layer_rows(
+            layer_stats.get(table), table_rows[table]["rows"], layer["layer_id"]
+        )
+        partial_index = next(
+            (
+                i["name"]
+                for i in indexes.get(table, [])
+                if i["valid"]
+                and i["method"] == "gist"
+                and layer["layer_id"] in (i["predicate"] or "")
+            ),
+            None,
+        )
+        report_hot_layers.append(
+            {
+                "collection": collection_id,
+                "table": table,
+                "tiles": stats["tiles"],
+                "seconds": stats["seconds"],
+                "rows": rows,
+                "partial_index": partial_index,
+            }
+        )
+        if (
+            partial_index is None
+            and rows is not None
+            and rows >= min_layer_rows
+            and "geom" in table_rows[table]["columns"]
+        ):
+            proposals.append(
+                proposal(
+                    table,
+                    f"layer_{layer['id']}_geom_idx",
+                    f"Hot layer with about {rows} of the {table_rows[table]['rows']} rows of its table",
+                    f"USING gist (geom) WHERE layer_id = '{layer['layer_id']}'",
+                )
+            )
+
+    return {
+        "tables": report_tables,
+        "hot_layers": report_hot_layers,
+        "proposals": proposals,
+    }
+
+
+async def create_indexes(
+    conn: asyncpg.Connection, proposals: List[Dict[str, str]], builds: Dict[str, str]
+):
+    """Create the proposed indexes one after the other, reporting their state in `builds`."""
+    # The concurrent builds of large tables take longer than any statement timeout of the role
+    await conn.execute("SET statement_timeout = 0")
+    for index in proposals:
+        builds[index["name"]] = "creating"
+        print(f"Creating index {index['name']} on {SCHEMA}.{index['table']}")
+        try:
+            await conn.execute(index["sql"])
+            builds[index["name"]] = "created"
+        except asyncpg.PostgresError as e:
+            print(f"Failed to create index {index['name']}: {e}")
+            builds[index["name"]] = f"failed: {e}"
@@ -6,29 +6,46 @@ https://github.com/developmentseed/tipg
 The original code/repository is licensed under MIT License.
 ---------------------------------------------------------------------------------
 """
-import sentry_sdk
+import asyncio
+import json
 import os
+import time
 
-from contextlib import asynccontextmanager
-from tipg import __version__ as tipg_version
-from tipg.collections import Collection
-from tipg import dependencies
-from src.exts import (
+# Start of the import of the app, from which the startup_import_seconds and startup_seconds timings are measured
+import_started = time.perf_counter()
+
+from contextlib import asynccontextmanager  # noqa: E402
+from tipg import __version__ as tipg_version  # noqa: E402
+from tipg.collections import Collection  # noqa: E402
+from tipg import dependencies  # noqa: E402
+from src.exts import (  # noqa: E402
     _from,
     get_mvt_point,
     _select_no_geo,
+    _select_mvt,
+    _select_geojson,
     get_column,
     filter_query,
+    properties_filter_query,
     _where,
     get_tile,
+    get_tiles,
+    features_geojson,
+    use_clustering,
+    has_cluster_columns,
+    count_tile_features,
+    get_h3_3_grids,
+    group_h3_3_by_shard,
     single_select_h3,
+    CollectionParams,
     Operator as OperatorPatch,
 )
 
 # Monkey patch filter query here because it needs to be patched before used by import down
 dependencies.filter_query = filter_query
+dependencies.properties_filter_query = properties_filter_query
 
-from tipg.database import close_db_connection, connect_to_db  # noqa: E402
+from tipg.database import close_db_connection  # noqa: E402
 from tipg.factory import Endpoints  # noqa: E402
 from tipg.middleware import CacheControlMiddleware  # noqa: E402
 from tipg.settings import (  # noqa: E402
@@ -37,22 +54,47 @@ from tipg.settings import (  # noqa: E402
     DatabaseSettings,
     PostgresSettings,
     MVTSettings,
+    TMSSettings,
 )
+from tipg.filter.evaluate import to_filter  # noqa: E402
 from tipg.filter.filters import Operator  # noqa: E402
-from fastapi import FastAPI  # noqa: E402
+from morecantile import Tile  # noqa: E402
+from morecantile import tms as morecantile_tms  # noqa: E402
+from pygeofilter.parsers.cql2_json import parse as cql2_json_parser  # noqa: E402
+from fastapi import FastAPI, Request  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
 from starlette.middleware.cors import CORSMiddleware  # noqa: E402
-from starlette_cramjam.middleware import CompressionMiddleware  # noqa: E402
 from src.catalog import LayerCatalog  # noqa: E402
+from src.admin import router as admin_router  # noqa: E402
+from src.aggregates import AggregateCache  # noqa: E402
+from src.archive import TileArchives  # noqa: E402
+from src.cache import TileCache  # noqa: E402
+from src.endpoints import router as endpoints_router  # noqa: E402
+from src.metrics import metrics  # noqa: E402
+from src.mvt import close_encoder_pool, start_encoder_pool  # noqa: E402
+from src.pool import connect, warm_up as warm_up_pool  # noqa: E402
+from src.prefetch import TilePrefetcher  # noqa: E402
+from src.middleware import (  # noqa: E402
+    CancelOnDisconnectMiddleware,
+    ETagMiddleware,
+    ThreadPoolCompressionMiddleware,
+    TileCacheMiddleware,
+    TILE_PATH_PATTERN,
+)
+from src.settings import geoapi_settings  # noqa: E402
 
 mvt_settings = MVTSettings()
-mvt_settings.max_features_per_tile = 20000
 settings = APISettings()
 postgres_settings = PostgresSettings()
 db_settings = DatabaseSettings()
 custom_sql_settings = CustomSQLSettings()
+tms_settings = TMSSettings()
 
 
 if os.getenv("SENTRY_DSN") and os.getenv("ENVIRONMENT"):
+    # Only imported when used as it is slow to import
+    import sentry_sdk
+
     sentry_sdk.init(
         dsn=os.getenv("SENTRY_DSN"),
         environment=os.getenv("ENVIRONMENT"),
@@ -66,24 +108,109 @@ Collection.get_mvt_point = get_mvt_point
 Collection.single_select_h3 = single_select_h3
 Collection._where = _where
 Collection._select_no_geo = _select_no_geo
+Collection._select_mvt = _select_mvt
+Collection._select_geojson = _select_geojson
 Collection.get_column = get_column
 Collection.get_tile = get_tile
+Collection.get_tiles = get_tiles
+Collection.features_geojson = features_geojson
+Collection.use_clustering = use_clustering
+Collection.has_cluster_columns = has_cluster_columns
+Collection.count_tile_features = count_tile_features
+Collection.get_h3_3_grids = get_h3_3_grids
+Collection.group_h3_3_by_shard = group_h3_3_by_shard
+
+
+def warm_up():
+    """Pay the first use costs of the default TMS and of the CQL2 filters (dateparser) before the first requests."""
+    tms = morecantile_tms.get(tms_settings.default_tms)
+    tms.xy_bounds(Tile(0, 0, 0))
+    cql = cql2_json_parser(
+        json.dumps(
+            {
+                "op": "t_after",
+                "args": [
+                    {"property": "date"},
+                    {"timestamp": "2020-01-01T00:00:00Z"},
+                ],
+            }
+        )
+    )
+    to_filter(cql, ["date"])
+
+
+async def warm_up_in_background():
+    with metrics.startup_phase("warm_up"):
+        try:
+            await asyncio.to_thread(warm_up)
+        except Exception as e:
+            print(f"Warm up failed: {e!r}")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """FastAPI Lifespan."""
+    """FastAPI Lifespan.
+
+    The catalog is read in the background by the catalog listener: the requests for collections arriving
+    before it is loaded wait for it (see CollectionParams).
+    """
     # Create Connection Pool
-    await connect_to_db(
-        app,
-        settings=postgres_settings,
-        schemas=db_settings.schemas,
-        user_sql_files=custom_sql_settings.sql_files,
-    )
+    with metrics.startup_phase("pool"):
+        await connect(
+            app,
+            settings=postgres_settings,
+            schemas=db_settings.schemas,
+            user_sql_files=custom_sql_settings.sql_files,
+        )
+    if geoapi_settings.db_pool_warm_up > 0:
+        with metrics.startup_phase("pool_warm_up"):
+            await warm_up_pool(app.state.pool, geoapi_settings.db_pool_warm_up)
+    with metrics.startup_phase("caches"):
+        # Init Tile Cache
+        if geoapi_settings.tile_cache_max_size > 0:
+            app.state.tile_cache = TileCache(
+                max_size=geoapi_settings.tile_cache_max_size,
+                encodings=geoapi_settings.tile_cache_encodings,
+                minimum_size=geoapi_settings.compression_minimum_size,
+                stale_max_age=geoapi_settings.tile_stale_max_age,
+            )
+            if geoapi_settings.tile_prefetch_concurrency > 0:
+                app.state.tile_prefetcher = TilePrefetcher(
+                    app.state.pool,
+                    app.state.tile_cache,
+                    concurrency=geoapi_settings.tile_prefetch_concurrency,
+                    queue_size=geoapi_settings.tile_prefetch_queue_size,
+                    max_zoom=geoapi_settings.tile_prefetch_max_zoom,
+                )
+                app.state.tile_prefetcher.start()
+        if geoapi_settings.aggregate_cache_max_entries > 0:
+            app.state.aggregate_cache = AggregateCache(
+                geoapi_settings.aggregate_cache_max_entries
+            )
+        if geoapi_settings.tile_archive_directory:
+            app.state.tile_archives = TileArchives(
+                geoapi_settings.tile_archive_directory
+            )
+    if geoapi_settings.tile_encoder == "python":
+        start_encoder_pool(geoapi_settings.tile_encoder_processes)
+    app.state.seed_tasks = {}
+    app.state.index_builds = {}
+    app.state.index_task = None
     # Init Layer Catalog
     layer_catalog = LayerCatalog(app=app)
+    app.state.layer_catalog = layer_catalog
     await layer_catalog.start()
+    warm_up_task = asyncio.create_task(warm_up_in_background())
+    metrics.observe("startup_seconds", time.perf_counter() - import_started)
     yield
+    warm_up_task.cancel()
+    for task, _ in app.state.seed_tasks.values():
+        task.cancel()
+    if app.state.index_task is not None:
+        app.state.index_task.cancel()
+    if getattr(app.state, "tile_prefetcher", None) is not None:
+        app.state.tile_prefetcher.stop()
+    close_encoder_pool()
     await layer_catalog.stop()
     await close_db_connection(app)
 
@@ -111,12 +238,32 @@ if settings.cors_origins:
 ogc_api = Endpoints(
     title=settings.name,
     with_tiles_viewer=settings.add_tiles_viewer,
+    collection_dependency=CollectionParams,
 )
 # Remove the list all collections endpoint
 ogc_api.router.routes = ogc_api.router.routes[1:]
+# The custom endpoints are included first so that their paths are not matched by the tipg routes
+app.include_router(endpoints_router)
 app.include_router(ogc_api.router)
+app.include_router(admin_router)
+app.add_middleware(
+    CancelOnDisconnectMiddleware,
+    include_path={r"^/collections/[^/]+/(tiles|items)"},
+)
+app.add_middleware(TileCacheMiddleware, default_tms=tms_settings.default_tms)
+app.add_middleware(ETagMiddleware, cachecontrol=geoapi_settings.etag_cachecontrol)
 app.add_middleware(CacheControlMiddleware, cachecontrol=settings.cachecontrol)
-app.add_middleware(CompressionMiddleware)
+# Tiles are compressed by the tile cache when it is enabled, the other responses in the thread pool
+app.add_middleware(
+    ThreadPoolCompressionMiddleware,
+    minimum_size=geoapi_settings.compression_minimum_size,
+    exclude_path=(
+        {TILE_PATH_PATTERN.pattern.strip("^$")}
+        if geoapi_settings.tile_cache_max_size > 0
+        else set()
+    ),
+)
+
 
 @app.get(
     "/healthz",
@@ -128,3 +275,63 @@ app.add_middleware(CompressionMiddleware)
 def ping():
     """Health check."""
     return {"ping": "pongpong!"}
+
+
+@app.get(
+    "/readyz",
+    description="Readiness check reporting the catalog freshness, the catalog listener and the pool saturation.",
+    summary="Readiness Check.",
+    operation_id="readinessCheck",
+    tags=["Health Check"],
+)
+def ready(request: Request):
+    """Readiness check. Responds with 503 when the instance should not receive traffic."""
+    health = request.app.state.layer_catalog.health()
+    pool = getattr(request.app.state, "pool", None)
+    if pool is not None:
+        busy = pool.get_size() - pool.get_idle_size()
+        health["pool"] = {
+            "size": pool.get_size(),
+            "busy": busy,
+            "max_size": pool.get_max_size(),
+            "limit": pool.limit,
+            "waiting": len(pool.waiters),
+            "saturation": max(busy / pool.get_max_size(), pool.in_use / pool.limit),
+        }
+
+    reasons = []
+    if not health["catalog_loaded"] and not geoapi_settings.serve_while_catalog_loads:
+        reasons.append("catalog not loaded")
+    if (
+        health["listener_disconnected_for"] is not None
+        and health["listener_disconnected_for"]
+        > geoapi_settings.readiness_listener_grace
+    ):
+        reasons.append("catalog listener disconnected")
+    if pool is None:
+        reasons.append("no database pool")
+    elif (
+        geoapi_settings.readiness_max_pool_saturation is not None
+        and health["pool"]["saturation"]
+        >= geoapi_settings.readiness_max_pool_saturation
+    ):
+        reasons.append("database pool saturated")
+
+    health["ready"] = not reasons
+    health["reasons"] = reasons
+    return JSONResponse(health, status_code=503 if reasons else 200)
+
+
+@app.get(
+    "/metrics",
+    description="Metrics.",
+    summary="Metrics.",
+    operation_id="metrics",
+    tags=["Health Check"],
+)
+def get_metrics():
+    """Return the in-process metrics."""
+    return metrics.snapshot()
+
+
+metrics.observe("startup_import_seconds", time.perf_counter() - import_started)
@@ -0,0 +1,85 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class Metrics:
+    """Simple in-process counters and timings exposed on the /metrics endpoint."""
+
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self.ratios: Dict[str, Tuple[str, str]] = {}
+        self.gauges: Dict[str, Callable[[], Optional[float]]] = {}
+        # Tiles rendered from the database and their time by collection
+        self.layers: Dict[str, Dict[str, float]] = {}
+
+    def inc(self, name: str, value: int = 1):
+        """Increase a counter."""
+        self.counters[name] += value
+
+    def observe(self, name: str, value: float):
+        """Record a timing (or any other measured value)."""
+        timing = self.timings.setdefault(
+            name, {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0}
+        )
+        timing["count"] += 1
+        timing["sum"] += value
+        timing["max"] = max(timing["max"], value)
+        timing["last"] = value
+
+    def observe_layer(self, collection_id: str, value: float):
+        """Record the time spent rendering a tile of a collection from the database."""
+        layer = self.layers.setdefault(collection_id, {"tiles": 0, "seconds": 0.0})
+        layer["tiles"] += 1
+        layer["seconds"] += value
+
+    def hot_layers(self, count: int = 10) -> List[Tuple[str, Dict[str, float]]]:
+        """Return the collections which took the most database time to render their tiles."""
+        return sorted(
+            self.layers.items(), key=lambda item: item[1]["seconds"], reverse=True
+        )[:count]
+
+    def register_ratio(self, name: str, hits: str, misses: str):
+        """Report the ratio hits / (hits + misses) of two counters."""
+        self.ratios[name] = (hits, misses)
+
+    def register_gauge(self, name: str, value: Callable[[], Optional[float]]):
+        """Report the current value returned by a function."""
+        self.gauges[name] = value
+
+    @contextmanager
+    def startup_phase(self, name: str):
+        """Measure a phase of the startup, reported as the `startup_<name>_seconds` timing."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(f"startup_{name}_seconds", duration)
+            print(f"Startup phase {name} took {duration:.3f}s")
+
+    def snapshot(self) -> dict:
+        """Return the current state of all metrics."""
+        ratios = {}
+        for name, (hits, misses) in self.ratios.items():
+            total = self.counters[hits] + self.counters[misses]
+            ratios[name] = self.counters[hits] / total if total else None
+        return {
+            "counters": dict(self.counters),
+            "timings": {name: dict(timing) for name, timing in self.timings.items()},
+            "ratios": ratios,
+            "gauges": {name: value() for name, value in self.gauges.items()},
+            "hot_layers": dict(self.hot_layers()),
+        }
+
+
+metrics = Metrics()
+metrics.register_ratio("tile_cache_hit_ratio", "tile_cache_hits", "tile_cache_misses")
+metrics.register_ratio(
+    "tile_statement_reuse_ratio", "tile_statements_reused", "tile_statements_new"
+)
+metrics.register_ratio(
+    "tile_prefetch_hit_ratio", "tile_prefetch_hits", "tile_prefetch_wasted"
+)
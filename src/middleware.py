@@ -0,0 +1,419 @@
+import asyncio
+import hashlib
+import re
+from typing import Dict, Optional, Set
+
+from morecantile import Tile
+from morecantile import tms as morecantile_tms
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from starlette_cramjam.middleware import (
+    CompressionMiddleware,
+    CompressionResponder,
+    get_compression_backend,
+)
+
+from src.cache import (
+    CachedTile,
+    TileCache,
+    TileKey,
+    preferred_encoding,
+    select_encoding,
+)
+from src.metrics import metrics
+from src.tiles import is_renderable, render_tile
+
+COLLECTION_PATH_PATTERN = re.compile(
+    r"^/collections/(?P<collectionId>[^/]+)/(tiles|items)"
+)
+TILE_PATH_PATTERN = re.compile(
+    r"^/collections/(?P<collectionId>[^/]+)/tiles/((?P<tileMatrixSetId>[^/]+)/)?(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)$"
+)
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+
+class CancelOnDisconnectMiddleware:
+    """Cancel the request handler (and therefore its running queries) when the client disconnects."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        include_path: Optional[Set[str]] = None,
+    ) -> None:
+        """Init Middleware.
+
+        Args:
+            app (ASGIApp): starlette/FastAPI application.
+            include_path (set): Set of regex expression of the paths to watch. Defaults to all paths.
+
+        """
+        self.app = app
+        self.include_path = {re.compile(p) for p in include_path or set()}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http" or (
+            self.include_path
+            and not any(p.match(scope["path"]) for p in self.include_path)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        # Forward the messages of the client to the app and watch for a disconnect at the same time.
+        # Cancelling the handler cancels the awaited asyncpg query, which sends a cancel request
+        # to Postgres and releases the connection back to the pool.
+        messages: asyncio.Queue[Message] = asyncio.Queue()
+        disconnected = False
+
+        async def watch_disconnect():
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    disconnected = True
+                    handler.cancel()
+                    return
+
+        handler = asyncio.ensure_future(self.app(scope, messages.get, send))
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+            metrics.inc("requests_cancelled_on_disconnect")
+        finally:
+            watcher.cancel()
+
+
+class ETagMiddleware:
+    """Add strong ETags to tiles and items based on the layer generation and answer conditional requests with 304."""
+
+    def __init__(self, app: ASGIApp, cachecontrol: Optional[str] = None) -> None:
+        """Init Middleware.
+
+        Args:
+            app (ASGIApp): starlette/FastAPI application.
+            cachecontrol (str): Cache-Control string to add to the responses with an ETag.
+
+        """
+        self.app = app
+        self.cachecontrol = cachecontrol
+
+    def etag(self, scope: Scope) -> Optional[str]:
+        """Build the ETag of a request or return None if the request is not cacheable."""
+        matched = COLLECTION_PATH_PATTERN.match(scope["path"])
+        layer_catalog = getattr(scope["app"].state, "layer_catalog", None)
+        if not matched or layer_catalog is None:
+            return None
+
+        collection_id = matched.group("collectionId")
+        generation = layer_catalog.generation(collection_id)
+        if generation is None:
+            return None
+
+        headers = Headers(scope=scope)
+        query = "&".join(sorted(scope["query_string"].decode().split("&")))
+        key = "|".join(
+            [
+                collection_id,
+                generation,
+                scope["path"],
+                query,
+                headers.get("Accept", ""),
+                headers.get("Accept-Encoding", ""),
+            ]
+        )
+        return '"' + hashlib.md5(key.encode()).hexdigest() + '"'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http" or scope["method"] not in ["HEAD", "GET"]:
+            await self.app(scope, receive, send)
+            return
+
+        etag = self.etag(scope)
+        if etag is None:
+            await self.app(scope, receive, send)
+            return
+
+        if_none_match = Headers(scope=scope).get("If-None-Match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or (
+            if_none_match.strip() == "*"
+        ):
+            metrics.inc("not_modified_responses")
+            headers = [(b"etag", etag.encode())]
+            if self.cachecontrol:
+                headers.append((b"cache-control", self.cachecontrol.encode()))
+            await send(
+                {"type": "http.response.start", "status": 304, "headers": headers}
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_wrapper(message: Message):
+            """Send Message."""
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                response_headers = MutableHeaders(scope=message)
+                # A stale tile does not match the current generation of the layer
+                if response_headers.get("x-tile-cache") == "stale":
+                    await send(message)
+                    return
+                response_headers["ETag"] = etag
+                if self.cachecontrol:
+                    response_headers["Cache-Control"] = self.cachecontrol
+
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+class TileCacheMiddleware:
+    """Serve tiles from the precompressed tile cache and store the tiles rendered on a miss."""
+
+    def __init__(self, app: ASGIApp, default_tms: str = "WebMercatorQuad") -> None:
+        """Init Middleware.
+
+        Args:
+            app (ASGIApp): starlette/FastAPI application.
+            default_tms (str): TileMatrixSet of the tile paths without tileMatrixSetId.
+
+        """
+        self.app = app
+        self.default_tms = default_tms
+        # Background renders of stale tiles
+        self.revalidating: Dict[TileKey, asyncio.Task] = {}
+
+    def revalidate(self, scope: Scope, cache: TileCache, key: TileKey) -> bool:
+        """Render a stale tile again in the background, once per tile.
+
+        Returns False if the tile can not be rendered outside of the request.
+        """
+        if key in self.revalidating:
+            return True
+
+        catalog = getattr(scope["app"].state, "collection_catalog", None) or {}
+        collection = catalog.get("collections", {}).get(key[0])
+        if collection is None:
+            cache.remove(key)
+            return False
+        if not is_renderable(key[5]):
+            return False
+
+        async def render():
+            try:
+                version = cache.version(key[0])
+                data = await render_tile(
+                    scope["app"].state.pool,
+                    collection,
+                    morecantile_tms.get(key[1]),
+                    Tile(key[3], key[4], key[2]),
+                    key[5],
+                )
+                await cache.put(key, data, version)
+                metrics.inc("tile_cache_revalidations")
+            except Exception as e:
+                print(f"Failed to render stale tile {key}: {e}")
+            finally:
+                self.revalidating.pop(key, None)
+
+        self.revalidating[key] = asyncio.create_task(render())
+        return True
+
+    def prefetch(self, scope: Scope, key: TileKey):
+        """Schedule the prefetching of the tiles around a served tile."""
+        prefetcher = getattr(scope["app"].state, "tile_prefetcher", None)
+        if prefetcher is None:
+            return
+        catalog = getattr(scope["app"].state, "collection_catalog", None) or {}
+        collection = catalog.get("collections", {}).get(key[0])
+        if collection is not None:
+            prefetcher.schedule(key, collection)
+
+    async def send_tile(
+        self,
+        send: Send,
+        cache: TileCache,
+        tile: CachedTile,
+        accept_encoding: str,
+        status: str,
+    ):
+        """Send a cached tile with the best matching encoding."""
+        encoding = select_encoding(tile, accept_encoding, cache.encodings)
+        body = tile.content[encoding]
+        headers = [
+            (b"content-type", MVT_MEDIA_TYPE.encode()),
+            (b"content-length", str(len(body)).encode()),
+            (b"vary", b"Accept-Encoding"),
+            (b"x-tile-cache", status.encode()),
+        ]
+        if status == "stale":
+            headers.append((b"cache-control", b"no-store"))
+        if encoding != "identity":
+            headers.append((b"content-encoding", encoding.encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        cache: Optional[TileCache] = None
+        matched = None
+        if scope["type"] == "http" and scope["method"] == "GET":
+            cache = getattr(scope["app"].state, "tile_cache", None)
+            matched = TILE_PATH_PATTERN.match(scope["path"])
+        if cache is None or matched is None:
+            await self.app(scope, receive, send)
+            return
+
+        collection_id = matched.group("collectionId")
+        key = cache.key(
+            collection_id,
+            matched.group("tileMatrixSetId") or self.default_tms,
+            int(matched.group("z")),
+            int(matched.group("x")),
+            int(matched.group("y")),
+            scope["query_string"].decode(),
+        )
+        headers = Headers(scope=scope)
+        accept_encoding = headers.get("Accept-Encoding", "")
+
+        # Stale tiles are served while they are rendered again, unless the client asks for a fresh one
+        tile = cache.get(key)
+        if tile is not None and tile.stale_since is not None:
+            no_cache = "no-cache" in headers.get("Cache-Control", "").lower()
+            if not no_cache and self.revalidate(scope, cache, key):
+                metrics.inc("tile_cache_stale_hits")
+                await self.send_tile(send, cache, tile, accept_encoding, "stale")
+                return
+            tile = None
+
+        if tile is not None:
+            await self.send_tile(send, cache, tile, accept_encoding, "hit")
+            self.prefetch(scope, key)
+            return
+
+        # Serve the tile from the seeded archive of the layer if there is one
+        version = cache.version(collection_id)
+        archives = getattr(scope["app"].state, "tile_archives", None)
+        if archives is not None and not key[5]:
+            catalog = getattr(scope["app"].state, "collection_catalog", None) or {}
+            collection = catalog.get("collections", {}).get(collection_id)
+            archive = archives.get(collection) if collection is not None else None
+            if archive is not None and archive.metadata.get("goat_tms") == key[1]:
+                data = archive.get(key[2], key[3], key[4])
+                if data is not None:
+                    metrics.inc("tile_archive_hits")
+                    tile = await cache.put(
+                        key,
+                        data,
+                        version,
+                        encoding=preferred_encoding(accept_encoding, cache.encodings),
+                    )
+                    await self.send_tile(send, cache, tile, accept_encoding, "archive")
+                    self.prefetch(scope, key)
+                    return
+
+        # Render the tile and keep the response to store it in the cache
+        start_message: Optional[Message] = None
+        body = []
+
+        async def capture(message: Message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+            elif message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+
+        prefetcher = getattr(scope["app"].state, "tile_prefetcher", None)
+        if prefetcher is not None:
+            with prefetcher.foreground():
+                await self.app(scope, receive, capture)
+        else:
+            await self.app(scope, receive, capture)
+        if start_message is None:
+            return
+
+        if start_message["status"] != 200:
+            await send(start_message)
+            await send({"type": "http.response.body", "body": b"".join(body)})
+            return
+
+        tile = await cache.put(
+            key,
+            b"".join(body),
+            version,
+            encoding=preferred_encoding(accept_encoding, cache.encodings),
+        )
+        await self.send_tile(send, cache, tile, accept_encoding, "miss")
+        self.prefetch(scope, key)
+
+
+class ThreadPoolCompressionResponder(CompressionResponder):
+    """Compress the response bodies in the thread pool instead of on the event loop."""
+
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        self.compressor.compress(body)
+        if more_body:
+            return bytes(self.compressor.flush())
+        return bytes(self.compressor.finish())
+
+    async def send_with_compression(self, message: Message) -> None:
+        if message["type"] != "http.response.body":
+            await super().send_with_compression(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            # Responses already encoded, e.g. the tiles of the tile cache, are sent as they are
+            if (
+                "Content-Encoding" in headers
+                or headers.get("Content-Type") in self.exclude_mediatype
+                or (len(body) < self.minimum_size and not more_body)
+            ):
+                self.compressor = None
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+
+            headers["Content-Encoding"] = self.encoding_name
+            headers.add_vary_header("Accept-Encoding")
+            message["body"] = await run_in_threadpool(self.compress, body, more_body)
+            if more_body:
+                # The length of a streamed response is not known in advance
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(message["body"]))
+            await self.send(self.initial_message)
+            await self.send(message)
+            return
+
+        if self.compressor is not None:
+            message["body"] = await run_in_threadpool(self.compress, body, more_body)
+        await self.send(message)
+
+
+class ThreadPoolCompressionMiddleware(CompressionMiddleware):
+    """Compression middleware of starlette_cramjam compressing in the thread pool."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            accepted_encoding = Headers(scope=scope).get("Accept-Encoding", "")
+            skip = any(x.fullmatch(scope["path"]) for x in self.exclude_path)
+            backend = get_compression_backend(accepted_encoding, self.compression)
+            if not skip and backend:
+                responder = ThreadPoolCompressionResponder(
+                    self.app,
+                    backend.compress.Compressor(),
+                    backend.name,
+                    self.minimum_size,
+                    self.exclude_mediatype,
+                )
+                await responder(scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
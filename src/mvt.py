@@ -0,0 +1,419 @@
+"""
+Minimal Mapbox Vector Tile (protobuf) helpers, see https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+"""
+import multiprocessing
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Field numbers of the Tile, Layer and Feature messages
+TILE_LAYERS = 3
+LAYER_NAME = 1
+LAYER_FEATURES = 2
+LAYER_KEYS = 3
+LAYER_VALUES = 4
+FEATURE_TAGS = 2
+
+LAYER_EXTENT = 5
+LAYER_VERSION = 15
+FEATURE_TYPE = 3
+FEATURE_GEOMETRY = 4
+
+# Geometry types of the features and commands of their geometry
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+# Types of the properties ST_AsMVT encodes as numbers and booleans, and jsonb of which it encodes the
+# members as properties of their own. The other types are encoded as strings with their text output,
+# so the queries of the python encoder cast them to text (see mvt_output in exts).
+FLOAT_TYPES = {"real", "float4"}
+MVT_TYPES = FLOAT_TYPES | {
+    "boolean",
+    "bool",
+    "smallint",
+    "int2",
+    "integer",
+    "int",
+    "int4",
+    "bigint",
+    "int8",
+    "double precision",
+    "float8",
+    "jsonb",
+}
+# FLT_EPSILON of C, ST_AsMVT encodes the jsonb numbers as integers when they are integral within it
+FLT_EPSILON = 1.1920929e-07
+
+# WKB geometry type (ISO codes modulo 1000) to MVT geometry type
+WKB_GEOMETRY_TYPES = {
+    1: POINT,
+    2: LINESTRING,
+    3: POLYGON,
+    4: POINT,
+    5: LINESTRING,
+    6: POLYGON,
+}
+
+
+def read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Read a varint and return it with the position after it."""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def write_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def read_fields(data: bytes) -> Iterator[Tuple[int, int, bytes, bytes]]:
+    """Iterate over the fields of a message as (field number, wire type, value, raw field bytes).
+
+    The value is the payload of length delimited fields and the encoded value otherwise.
+    """
+    pos = 0
+    while pos < len(data):
+        start = pos
+        key, pos = read_varint(data, pos)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == VARINT:
+            _, end = read_varint(data, pos)
+            value = data[pos:end]
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(data, pos)
+            end = pos + length
+            value = data[pos:end]
+        elif wire_type == FIXED64:
+            end = pos + 8
+            value = data[pos:end]
+        elif wire_type == FIXED32:
+            end = pos + 4
+            value = data[pos:end]
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        pos = end
+        yield number, wire_type, value, data[start:end]
+
+
+def field(number: int, payload: bytes) -> bytes:
+    """Encode a length delimited field."""
+    return (
+        write_varint(number << 3 | LENGTH_DELIMITED)
+        + write_varint(len(payload))
+        + payload
+    )
+
+
+def packed_varints(data: bytes) -> List[int]:
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def merge_layers(layers: List[bytes]) -> bytes:
+    """Merge layers with the same name into one, combining their keys and values dictionaries."""
+    header: List[bytes] = []
+    features: List[bytes] = []
+    keys: Dict[bytes, int] = {}
+    values: Dict[bytes, int] = {}
+
+    for i, layer in enumerate(layers):
+        layer_keys: List[bytes] = []
+        layer_values: List[bytes] = []
+        layer_features: List[bytes] = []
+        for number, _, value, raw in read_fields(layer):
+            if number == LAYER_KEYS:
+                layer_keys.append(value)
+            elif number == LAYER_VALUES:
+                layer_values.append(value)
+            elif number == LAYER_FEATURES:
+                layer_features.append(value)
+            elif i == 0:
+                # Name, extent and version of the first layer
+                header.append(raw)
+
+        key_index = [keys.setdefault(k, len(keys)) for k in layer_keys]
+        value_index = [values.setdefault(v, len(values)) for v in layer_values]
+        for feature in layer_features:
+            out = bytearray()
+            for number, _, value, raw in read_fields(feature):
+                if number == FEATURE_TAGS:
+                    tags = packed_varints(value)
+                    remapped = b"".join(
+                        write_varint(key_index[tag] if j % 2 == 0 else value_index[tag])
+                        for j, tag in enumerate(tags)
+                    )
+                    out += field(FEATURE_TAGS, remapped)
+                else:
+                    out += raw
+            features.append(bytes(out))
+
+    return b"".join(
+        header
+        + [field(LAYER_FEATURES, f) for f in features]
+        + [field(LAYER_KEYS, k) for k in keys]
+        + [field(LAYER_VALUES, v) for v in values]
+    )
+
+
+def merge_tiles(tiles: List[bytes]) -> bytes:
+    """Merge vector tiles, e.g. rendered by several queries, into one tile with unique layer names."""
+    layers: Dict[bytes, List[bytes]] = {}
+    for tile in tiles:
+        for number, _, value, _ in read_fields(tile or b""):
+            if number != TILE_LAYERS:
+                continue
+            name = next(
+                (v for n, _, v, _ in read_fields(value) if n == LAYER_NAME), b""
+            )
+            layers.setdefault(name, []).append(value)
+
+    return b"".join(
+        field(TILE_LAYERS, parts[0] if len(parts) == 1 else merge_layers(parts))
+        for parts in layers.values()
+    )
+
+
+def varint_field(number: int, value: int) -> bytes:
+    """Encode a varint field."""
+    return write_varint(number << 3 | VARINT) + write_varint(value)
+
+
+def zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def encode_value(value: Any, float32: bool = False) -> Optional[bytes]:
+    """Encode a property value as a Value message, with the same types as ST_AsMVT.
+
+    The values of the types ST_AsMVT encodes as strings are expected in their Postgres text form.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return varint_field(7, int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return varint_field(5, value)
+        return varint_field(6, zigzag(value))
+    if isinstance(value, float):
+        if float32:
+            return write_varint(2 << 3 | FIXED32) + struct.pack("<f", value)
+        return write_varint(3 << 3 | FIXED64) + struct.pack("<d", value)
+    return field(1, str(value).encode())
+
+
+def encode_json_value(value: Any) -> Optional[bytes]:
+    """Encode the value of a member of a jsonb object like ST_AsMVT, None for nulls, arrays and objects."""
+    if isinstance(value, (bool, str)):
+        return encode_value(value)
+    if isinstance(value, (int, float)):
+        if abs(value - int(value)) > FLT_EPSILON:
+            return encode_value(float(value))
+        return encode_value(int(value))
+    return None
+
+
+def encode_properties(
+    key: str, value: Any, pg_type: Optional[str] = None
+) -> Iterator[Tuple[str, bytes]]:
+    """Encode a property of a feature as (key, Value message), the members of a jsonb object as properties."""
+    if pg_type == "jsonb":
+        if isinstance(value, dict):
+            for member, member_value in value.items():
+                encoded = encode_json_value(member_value)
+                if encoded is not None:
+                    yield member, encoded
+        return
+    encoded = encode_value(value, float32=pg_type in FLOAT_TYPES)
+    if encoded is not None:
+        yield key, encoded
+
+
+def read_wkb(data: bytes, pos: int = 0) -> Tuple[int, List[List[Tuple[int, int]]], int]:
+    """Read a (multi) point, line or polygon from WKB.
+
+    Returns the WKB type, the parts (points, lines or rings, with the polygons of a multipolygon
+    following each other, their first ring being the exterior) and the position after the geometry.
+    """
+    byte_order = "<" if data[pos] == 1 else ">"
+    (wkb_type,) = struct.unpack_from(byte_order + "I", data, pos + 1)
+    pos += 5
+    wkb_type %= 1000
+    point = struct.Struct(byte_order + "dd")
+
+    def read_points(pos: int) -> Tuple[List[Tuple[int, int]], int]:
+        (count,) = struct.unpack_from(byte_order + "I", data, pos)
+        pos += 4
+        points = []
+        for _ in range(count):
+            x, y = point.unpack_from(data, pos)
+            points.append((round(x), round(y)))
+            pos += 16
+        return points, pos
+
+    if wkb_type == 1:
+        x, y = point.unpack_from(data, pos)
+        return wkb_type, [[(round(x), round(y))]], pos + 16
+    if wkb_type == 2:
+        points, pos = read_points(pos)
+        return wkb_type, [points], pos
+    if wkb_type == 3:
+        (count,) = struct.unpack_from(byte_order + "I", data, pos)
+        pos += 4
+        rings = []
+        for _ in range(count):
+            ring, pos = read_points(pos)
+            rings.append(ring)
+        return wkb_type, rings, pos
+    if wkb_type in (4, 5, 6):
+        (count,) = struct.unpack_from(byte_order + "I", data, pos)
+        pos += 4
+        parts = []
+        for _ in range(count):
+            _, sub_parts, pos = read_wkb(data, pos)
+            parts.extend(sub_parts)
+        return wkb_type, parts, pos
+    raise ValueError(f"Unsupported WKB geometry type {wkb_type}")
+
+
+def encode_geometry(wkb: bytes) -> Tuple[int, List[int]]:
+    """Encode a WKB geometry in tile coordinates (from ST_AsMVTGeom) as MVT geometry commands."""
+    wkb_type, parts, _ = read_wkb(wkb)
+    geometry_type = WKB_GEOMETRY_TYPES[wkb_type]
+    commands: List[int] = []
+    cx = cy = 0
+
+    if geometry_type == POINT:
+        points = [p for part in parts for p in part]
+        commands.append(MOVE_TO | len(points) << 3)
+        for x, y in points:
+            commands += [zigzag(x - cx), zigzag(y - cy)]
+            cx, cy = x, y
+        return geometry_type, commands
+
+    for part in parts:
+        # The closing point of the rings is replaced by the ClosePath command
+        if geometry_type == POLYGON:
+            part = part[:-1]
+        if len(part) < 2:
+            continue
+        x, y = part[0]
+        commands += [MOVE_TO | 1 << 3, zigzag(x - cx), zigzag(y - cy)]
+        cx, cy = x, y
+        commands.append(LINE_TO | (len(part) - 1) << 3)
+        for x, y in part[1:]:
+            commands += [zigzag(x - cx), zigzag(y - cy)]
+            cx, cy = x, y
+        if geometry_type == POLYGON:
+            commands.append(CLOSE_PATH | 1 << 3)
+    return geometry_type, commands
+
+
+def encode_tile(
+    layer_name: str,
+    keys: Sequence[str],
+    rows: Sequence[Tuple[bytes, Sequence[Any]]],
+    extent: int = 4096,
+    types: Optional[Sequence[str]] = None,
+) -> bytes:
+    """Encode rows of (WKB geometry in tile coordinates, property values) as a vector tile with one layer.
+
+    The keys and values are shared by the features of the layer. Like ST_AsMVT, the keys of all the
+    properties are written followed by the keys of the jsonb members, and features without geometry
+    and null values are skipped. `types` are the Postgres types of the properties.
+    """
+    key_index: Dict[str, int] = {key: i for i, key in enumerate(keys)}
+    value_index: Dict[bytes, int] = {}
+    features = []
+    for wkb, values in rows:
+        if not wkb:
+            continue
+        geometry_type, commands = encode_geometry(bytes(wkb))
+        if len(commands) < 3:
+            continue
+
+        tags = []
+        for i, value in enumerate(values):
+            for key, encoded in encode_properties(
+                keys[i], value, types[i] if types is not None else None
+            ):
+                tags.append(key_index.setdefault(key, len(key_index)))
+                tags.append(value_index.setdefault(encoded, len(value_index)))
+
+        feature = b""
+        if tags:
+            feature += field(FEATURE_TAGS, b"".join(write_varint(t) for t in tags))
+        feature += varint_field(FEATURE_TYPE, geometry_type)
+        feature += field(FEATURE_GEOMETRY, b"".join(write_varint(c) for c in commands))
+        features.append(feature)
+
+    if not features:
+        return b""
+
+    # Fields in the order of their number, like ST_AsMVT writes them
+    layer = b"".join(
+        [field(LAYER_NAME, layer_name.encode())]
+        + [field(LAYER_FEATURES, f) for f in features]
+        + [field(LAYER_KEYS, k.encode()) for k in key_index]
+        + [field(LAYER_VALUES, v) for v in value_index]
+        + [varint_field(LAYER_EXTENT, extent), varint_field(LAYER_VERSION, 2)]
+    )
+    return field(TILE_LAYERS, layer)
+
+
+encoder_pool: Optional[ProcessPoolExecutor] = None
+
+
+def start_encoder_pool(processes: Optional[int] = None) -> ProcessPoolExecutor:
+    """Start the process pool encoding the tiles, at the startup of the app.
+
+    The processes are spawned: forked from the running app they would inherit the connections of its
+    database pool and the state of its event loop.
+    """
+    global encoder_pool
+    if encoder_pool is None:
+        encoder_pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        )
+    return encoder_pool
+
+
+def get_encoder_pool() -> ProcessPoolExecutor:
+    """Return the process pool encoding the tiles, see start_encoder_pool."""
+    if encoder_pool is None:
+        raise RuntimeError("The tile encoder pool is not started.")
+    return encoder_pool
+
+
+def close_encoder_pool():
+    global encoder_pool
+    if encoder_pool is not None:
+        encoder_pool.shutdown(wait=False, cancel_futures=True)
+        encoder_pool = None
@@ -0,0 +1,188 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, List, Optional
+
+import orjson
+from buildpg import asyncpg
+from fastapi import FastAPI
+from tipg.database import connect_to_db
+from tipg.settings import PostgresSettings
+
+from src.metrics import metrics
+from src.settings import geoapi_settings
+
+
+class AdaptivePool:
+    """asyncpg pool limiting the connections in use at once to a limit adapted to the measured latencies.
+
+    Every `interval` seconds the limit is adjusted between `min_limit` and the size of the pool from the
+    latencies measured since the last adjustment: it is decreased when the connections are held longer
+    than `latency_tolerance` times the lowest hold latency seen (the database is saturated and more
+    concurrency only queues work in Postgres) and increased when the requests wait for a connection
+    longer than `target_acquire_wait` while the latency is normal. The connections above the limit stay
+    idle and are closed by the pool after their inactive lifetime.
+
+    The other attributes (get_size, close...) are the ones of the asyncpg pool.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.BuildPgPool,
+        adaptive: bool = False,
+        min_limit: int = 1,
+        target_acquire_wait: float = 0.01,
+        latency_tolerance: float = 2,
+        interval: float = 5,
+    ):
+        self.pool = pool
+        self.adaptive = adaptive
+        self.min_limit = min(min_limit, pool.get_max_size())
+        self.limit = pool.get_max_size()
+        self.target_acquire_wait = target_acquire_wait
+        self.latency_tolerance = latency_tolerance
+        self.interval = interval
+        self.in_use = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        # Latencies measured since the last adjustment and lowest hold latency seen
+        self.waits: List[float] = []
+        self.holds: List[float] = []
+        self.min_hold: Optional[float] = None
+        self.adjusted_at = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def wake(self):
+        """Wake the waiters which can get a connection under the current limit."""
+        available = self.limit - self.in_use
+        while self.waiters and available > 0:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                available -= 1
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        while self.in_use >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass the wake up on to the next waiter
+                if waiter.done() and not waiter.cancelled():
+                    self.wake()
+                raise
+        self.in_use += 1
+        try:
+            async with self.pool.acquire() as conn:
+                acquired = time.perf_counter()
+                self.waits.append(acquired - start)
+                metrics.observe("pool_acquire_wait_seconds", acquired - start)
+                try:
+                    yield conn
+                finally:
+                    hold = time.perf_counter() - acquired
+                    self.holds.append(hold)
+                    metrics.observe("pool_hold_seconds", hold)
+        finally:
+            self.in_use -= 1
+            self.adjust()
+            self.wake()
+
+    def adjust(self):
+        """Adjust the limit from the latencies measured during the last interval."""
+        now = time.monotonic()
+        if now - self.adjusted_at < self.interval or not self.holds:
+            return
+        wait = sum(self.waits) / len(self.waits) if self.waits else 0
+        hold = sum(self.holds) / len(self.holds)
+        self.waits, self.holds = [], []
+        self.adjusted_at = now
+        if self.min_hold is None or hold < self.min_hold:
+            self.min_hold = hold
+        if not self.adaptive:
+            return
+
+        if (
+            hold > self.min_hold * self.latency_tolerance
+            and self.limit > self.min_limit
+        ):
+            self.limit = max(self.min_limit, int(self.limit * 0.8))
+            metrics.inc("pool_limit_decreases")
+        elif wait > self.target_acquire_wait and self.limit < self.pool.get_max_size():
+            self.limit += 1
+            metrics.inc("pool_limit_increases")
+        # Let the lowest latency follow slowly a database which got slower for good
+        self.min_hold *= 1.05
+
+    def stats(self) -> dict:
+        return {
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "max_size": self.pool.get_max_size(),
+            "in_use": self.in_use,
+            "limit": self.limit,
+            "waiting": len(self.waiters),
+        }
+
+
+async def init_pgbouncer_connection(conn: asyncpg.BuildPgConnection):
+    """Initialize a connection without session state (no search_path or pg_temp functions as tipg does)."""
+    await conn.set_type_codec(
+        "json", encoder=orjson.dumps, decoder=orjson.loads, schema="pg_catalog"
+    )
+    await conn.set_type_codec(
+        "jsonb", encoder=orjson.dumps, decoder=orjson.loads, schema="pg_catalog"
+    )
+
+
+async def connect(
+    app: FastAPI,
+    settings: PostgresSettings,
+    schemas: Optional[List[str]] = None,
+    user_sql_files: Optional[list] = None,
+):
+    """Create the connection pool of the app, behind PgBouncer in transaction pooling if configured."""
+    if geoapi_settings.pgbouncer:
+        # Transaction pooling: no prepared statement cache and no session state
+        app.state.pool = await asyncpg.create_pool_b(
+            str(settings.database_url),
+            min_size=settings.db_min_conn_size,
+            max_size=settings.db_max_conn_size,
+            max_queries=settings.db_max_queries,
+            max_inactive_connection_lifetime=settings.db_max_inactive_conn_lifetime,
+            statement_cache_size=0,
+            init=init_pgbouncer_connection,
+        )
+    else:
+        await connect_to_db(
+            app, settings=settings, schemas=schemas, user_sql_files=user_sql_files
+        )
+
+    app.state.pool = AdaptivePool(
+        app.state.pool,
+        adaptive=geoapi_settings.db_pool_adaptive,
+        min_limit=geoapi_settings.db_pool_min_limit,
+        target_acquire_wait=geoapi_settings.db_pool_target_acquire_wait,
+        latency_tolerance=geoapi_settings.db_pool_latency_tolerance,
+    )
+    for name in ("size", "idle", "in_use", "limit", "waiting"):
+        metrics.register_gauge(
+            f"pool_{name}", lambda name=name: app.state.pool.stats()[name]
+        )
+
+
+async def warm_up(pool: AdaptivePool, connections: int):
+    """Open connections (up to the pool size) before the first requests."""
+
+    async def open_connection():
+        async with pool.acquire() as conn:
+            await conn.execute("SELECT 1")
+
+    await asyncio.gather(
+        *(open_connection() for _ in range(min(connections, pool.get_max_size())))
+    )
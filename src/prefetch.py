@@ -0,0 +1,142 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Set, Tuple
+
+from buildpg import asyncpg
+from morecantile import Tile
+from morecantile import tms as morecantile_tms
+from tipg.collections import Collection
+
+from src.cache import TileCache, TileKey
+from src.metrics import metrics
+from src.tiles import is_renderable, render_tile
+
+
+class TilePrefetcher:
+    """Warm the tile cache with the neighbours and children of the requested tiles in the background.
+
+    The prefetcher runs at low priority: it renders at most `concurrency` tiles at once, only starts a
+    render while no tile is rendered for a request and while the pool has an idle connection. The most
+    recently scheduled tiles are rendered first and the oldest are dropped when the queue is full.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.BuildPgPool,
+        cache: TileCache,
+        concurrency: int = 1,
+        queue_size: int = 256,
+        max_zoom: int = 20,
+    ):
+        self.pool = pool
+        self.cache = cache
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_zoom = max_zoom
+        self.pending: "OrderedDict[TileKey, Collection]" = OrderedDict()
+        self.rendering: Set[TileKey] = set()
+        self.available = asyncio.Event()
+        # Set while no tile is rendered for a request
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.active = 0
+        self.workers: List[asyncio.Task] = []
+
+    def start(self):
+        self.workers = [
+            asyncio.create_task(self.worker()) for _ in range(self.concurrency)
+        ]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+
+    @contextmanager
+    def foreground(self):
+        """Pause the prefetching while a tile is rendered for a request."""
+        self.active += 1
+        self.idle.clear()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if not self.active:
+                self.idle.set()
+
+    def candidates(self, key: TileKey) -> Iterator[TileKey]:
+        """Return the neighbours of a tile and its children on the next zoom level."""
+        collection_id, tms_id, z, x, y, query = key
+        matrix = morecantile_tms.get(tms_id).matrix(z)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if (dx or dy) and 0 <= y + dy < matrix.matrixHeight:
+                    nx = (x + dx) % matrix.matrixWidth
+                    yield (collection_id, tms_id, z, nx, y + dy, query)
+        if z < self.max_zoom:
+            for cx in (2 * x, 2 * x + 1):
+                for cy in (2 * y, 2 * y + 1):
+                    yield (collection_id, tms_id, z + 1, cx, cy, query)
+
+    def schedule(self, key: TileKey, collection: Collection):
+        """Queue the tiles around a served tile which are not cached yet."""
+        if not is_renderable(key[5]):
+            return
+        for candidate in self.candidates(key):
+            cached = self.cache.tiles.get(candidate)
+            if candidate in self.rendering or (
+                cached is not None and cached.stale_since is None
+            ):
+                continue
+            self.pending[candidate] = collection
+            self.pending.move_to_end(candidate)
+        while len(self.pending) > self.queue_size:
+            self.pending.popitem(last=False)
+            metrics.inc("tile_prefetch_dropped")
+        if self.pending:
+            self.available.set()
+
+    async def next(self) -> Tuple[TileKey, Collection]:
+        """Wait for a tile to prefetch and for the foreground requests to finish."""
+        while True:
+            await self.available.wait()
+            await self.idle.wait()
+            if (
+                self.pool.get_idle_size() == 0
+                and self.pool.get_size() >= self.pool.get_max_size()
+            ) or getattr(self.pool, "in_use", 0) >= getattr(
+                self.pool, "limit", self.pool.get_max_size()
+            ):
+                await asyncio.sleep(0.05)
+                continue
+            if not self.pending:
+                self.available.clear()
+                continue
+            return self.pending.popitem(last=True)
+
+    async def worker(self):
+        while True:
+            key, collection = await self.next()
+            cached = self.cache.tiles.get(key)
+            if cached is not None and cached.stale_since is None:
+                continue
+
+            self.rendering.add(key)
+            try:
+                version = self.cache.version(key[0])
+                data = await render_tile(
+                    self.pool,
+                    collection,
+                    morecantile_tms.get(key[1]),
+                    Tile(key[3], key[4], key[2]),
+                    key[5],
+                )
+                await self.cache.put(key, data, version, prefetched=True)
+                metrics.inc("tile_prefetch_rendered")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Failed to prefetch tile {key}: {e}")
+                metrics.inc("tile_prefetch_failed")
+            finally:
+                self.rendering.discard(key)
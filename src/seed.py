@@ -0,0 +1,324 @@
+"""
+Pre-render the tiles of a layer over a zoom range, either into an MBTiles archive or into the tile cache.
+
+Usage:
+    python -m src.seed user_data.<layer_id> --minzoom 0 --maxzoom 10 --output <layer>.mbtiles
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import cramjam
+from buildpg import asyncpg
+from morecantile import Tile, TileMatrixSet
+from morecantile import tms as morecantile_tms
+from tipg.collections import Collection
+from tipg.settings import MVTSettings, PostgresSettings
+
+from src.archive import (
+    MBTilesArchive,
+    archive_fingerprint,
+    outdated_path,
+    read_outdated,
+)
+from src.cache import TileCache
+from src.mvt import close_encoder_pool, start_encoder_pool
+from src.settings import geoapi_settings
+from src.tiles import render_tile
+
+mvt_settings = MVTSettings()
+
+MBTILES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS tiles (
+        zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+        PRIMARY KEY (zoom_level, tile_column, tile_row)
+    );
+    -- Layer fingerprint each tile (XYZ scheme) was rendered for, used to resume and to re-render incrementally.
+    CREATE TABLE IF NOT EXISTS goat_tile_state (
+        z INTEGER, x INTEGER, y INTEGER, fingerprint TEXT,
+        PRIMARY KEY (z, x, y)
+    );
+"""
+
+
+class MBTilesWriter:
+    """Write the seeded tiles of a layer into an MBTiles archive."""
+
+    def __init__(
+        self,
+        path: str,
+        collection: Collection,
+        tms: TileMatrixSet,
+        minzoom: int,
+        maxzoom: int,
+        fingerprint: str,
+        change: Optional[str] = None,
+    ):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(MBTILES_SCHEMA)
+        self.collection = collection
+        self.tms = tms
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+        self.fingerprint = fingerprint
+        # Feature change of the outdated marker of the archive when the seeding started
+        self.change = change
+        self.pending = 0
+        # Tiles written by this run
+        self.written = 0
+        # Tiles already rendered for the current state of the layer are skipped
+        self.rendered: Set[Tuple[int, int, int]] = {
+            tuple(row)
+            for row in self.conn.execute(
+                "SELECT z, x, y FROM goat_tile_state WHERE fingerprint = ?",
+                (self.fingerprint,),
+            )
+        }
+
+    def has(self, tile: Tile) -> bool:
+        return (tile.z, tile.x, tile.y) in self.rendered
+
+    async def write(self, tile: Tile, data: bytes):
+        # MBTiles uses the TMS scheme with the origin of the rows at the bottom
+        row = (1 << tile.z) - 1 - tile.y
+        if data:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                (tile.z, tile.x, row, bytes(cramjam.gzip.compress(data))),
+            )
+        else:
+            self.conn.execute(
+                "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (tile.z, tile.x, row),
+            )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO goat_tile_state VALUES (?, ?, ?, ?)",
+            (tile.z, tile.x, tile.y, self.fingerprint),
+        )
+        self.pending += 1
+        self.written += 1
+        if self.pending >= 100:
+            self.conn.commit()
+            self.pending = 0
+
+    def finish(self):
+        """Remove the tiles of an older state of the layer and write the metadata.
+
+        The archive is left untouched if no tile was rendered again, so that its modification time
+        only changes with its content. The outdated marker is removed if no other feature change was
+        notified during the seeding.
+        """
+        stored = self.conn.execute(
+            "SELECT value FROM metadata WHERE name = 'goat_fingerprint'"
+        ).fetchone()
+        if not self.written and stored is not None and stored[0] == self.fingerprint:
+            self.conn.close()
+            self.seeded()
+            return
+
+        for z, x, y in self.conn.execute(
+            "SELECT z, x, y FROM goat_tile_state WHERE fingerprint != ?",
+            (self.fingerprint,),
+        ).fetchall():
+            self.conn.execute(
+                "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, (1 << z) - 1 - y),
+            )
+        self.conn.execute(
+            "DELETE FROM goat_tile_state WHERE fingerprint != ?", (self.fingerprint,)
+        )
+
+        layer_name = (
+            self.collection.table
+            if mvt_settings.set_mvt_layername is True
+            else "default"
+        )
+        metadata = {
+            "name": self.collection.id,
+            "format": "pbf",
+            "bounds": ",".join(str(b) for b in self.collection.bounds),
+            "minzoom": str(self.minzoom),
+            "maxzoom": str(self.maxzoom),
+            "json": json.dumps(
+                {
+                    "vector_layers": [
+                        {
+                            "id": layer_name,
+                            "fields": {
+                                c.name: c.json_type
+                                for c in self.collection.properties
+                                if not c.is_geometry
+                            },
+                        }
+                    ]
+                }
+            ),
+            "goat_fingerprint": self.fingerprint,
+            "goat_change": self.change or "",
+            "goat_tms": self.tms.id,
+        }
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata.items()
+        )
+        self.conn.commit()
+        self.conn.close()
+        self.seeded()
+
+    def seeded(self):
+        if self.change is not None and read_outdated(self.path) == self.change:
+            os.remove(outdated_path(self.path))
+
+
+class TileCacheSink:
+    """Write the seeded tiles of a layer into the tile cache."""
+
+    def __init__(self, cache: TileCache, collection: Collection, tms: TileMatrixSet):
+        self.cache = cache
+        self.collection = collection
+        self.tms = tms
+        self.version = cache.version(collection.id)
+
+    def key(self, tile: Tile):
+        return self.cache.key(self.collection.id, self.tms.id, tile.z, tile.x, tile.y)
+
+    def has(self, tile: Tile) -> bool:
+        cached = self.cache.tiles.get(self.key(tile))
+        return cached is not None and cached.stale_since is None
+
+    async def write(self, tile: Tile, data: bytes):
+        await self.cache.put(self.key(tile), data, self.version)
+
+    def finish(self):
+        pass
+
+
+class TileSeeder:
+    """Render all tiles of a layer within its bounds over a zoom range with bounded concurrency."""
+
+    def __init__(
+        self,
+        pool: asyncpg.BuildPgPool,
+        collection: Collection,
+        tms: TileMatrixSet,
+        minzoom: int,
+        maxzoom: int,
+        concurrency: int = 4,
+    ):
+        self.pool = pool
+        self.collection = collection
+        self.tms = tms
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+        self.concurrency = concurrency
+        self.stats: Dict[str, int] = {"rendered": 0, "skipped": 0, "failed": 0}
+        self.done = False
+
+    def tiles(self) -> Iterator[Tile]:
+        """Return the tiles intersecting the bounds of the layer."""
+        west, south, east, north = self.collection.bounds
+        return self.tms.tiles(
+            west, south, east, north, list(range(self.minzoom, self.maxzoom + 1))
+        )
+
+    async def run(self, sink):
+        """Render the tiles which are not yet in the sink and write them into it."""
+        queue: asyncio.Queue[Optional[Tile]] = asyncio.Queue(
+            maxsize=self.concurrency * 2
+        )
+
+        async def worker():
+            while True:
+                tile = await queue.get()
+                if tile is None:
+                    return
+                try:
+                    data = await render_tile(self.pool, self.collection, self.tms, tile)
+                    await sink.write(tile, data)
+                    self.stats["rendered"] += 1
+                except Exception as e:
+                    print(f"Failed to render tile {tile}: {e}")
+                    self.stats["failed"] += 1
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            for tile in self.tiles():
+                if sink.has(tile):
+                    self.stats["skipped"] += 1
+                    continue
+                await queue.put(tile)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            for w in workers:
+                w.cancel()
+            raise
+
+        if self.stats["failed"] == 0:
+            sink.finish()
+        self.done = True
+        return self.stats
+
+
+async def main(args):
+    # Importing the app applies the patches of the tipg Collection (get_tile...)
+    import src.main  # noqa: F401
+    from src.catalog import LayerCatalog
+
+    layer_catalog = LayerCatalog()
+    pool = await asyncpg.create_pool_b(
+        str(PostgresSettings().database_url),
+        min_size=1,
+        max_size=args.concurrency,
+    )
+    if geoapi_settings.tile_encoder == "python":
+        start_encoder_pool(geoapi_settings.tile_encoder_processes)
+    try:
+        async with pool.acquire() as conn:
+            collection = await layer_catalog.get_collection(args.collection, conn)
+        if collection is None:
+            raise SystemExit(f"Layer {args.collection} not found.")
+        tms = morecantile_tms.get(args.tms)
+        output = args.output or f"{collection.id}.mbtiles"
+        # Taken before rendering: a change during the seeding keeps the archive outdated
+        change = read_outdated(output)
+        if change is None and os.path.exists(output):
+            # The feature change the archive was last seeded for
+            archive = MBTilesArchive(output)
+            change = archive.metadata.get("goat_change") or None
+            archive.close()
+        fingerprint = archive_fingerprint(collection, change)
+        seeder = TileSeeder(
+            pool, collection, tms, args.minzoom, args.maxzoom, args.concurrency
+        )
+        stats = await seeder.run(
+            MBTilesWriter(
+                output,
+                collection,
+                tms,
+                args.minzoom,
+                args.maxzoom,
+                fingerprint,
+                change,
+            )
+        )
+        print(f"Seeded {collection.id} into {os.path.abspath(output)}: {stats}")
+    finally:
+        close_encoder_pool()
+        await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("collection", help="Collection id, e.g. user_data.<layer_id>")
+    parser.add_argument("--minzoom", type=int, default=0)
+    parser.add_argument("--maxzoom", type=int, required=True)
+    parser.add_argument("--output", help="Path of the MBTiles archive.")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--tms", default="WebMercatorQuad")
+    asyncio.run(main(parser.parse_args()))
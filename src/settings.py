@@ -0,0 +1,195 @@
+from typing import Dict, List, Literal, Optional
+
+from pydantic import BaseModel, ValidationError, model_validator
+from pydantic_settings import BaseSettings
+
+
+class ClusteringPolicy(BaseModel):
+    """Clustering of the points of a layer with h3 cells at low zoom levels."""
+
+    enabled: bool = True
+    # Points are clustered on the zoom levels below this one.
+    min_zoom: int = 11
+    # Number of features of a tile from which it is clustered (the tile feature limit if not set).
+    min_feature_count: Optional[int] = None
+    # H3 resolution of the clusters by zoom level (the keys are the minimum zoom from which it applies).
+    h3_resolutions: Dict[int, int] = {
+        0: 3,
+        2: 4,
+        4: 5,
+        6: 6,
+        8: 7,
+        10: 8,
+    }
+    # Point representing a cluster: the first point of the cell, the centroid of its points or the
+    # point with the largest value of `representative_attribute`.
+    representative: Literal["first", "centroid", "max_attribute"] = "first"
+    representative_attribute: Optional[str] = None
+
+    def h3_resolution(self, zoom: int) -> int:
+        return GeoAPISettings.zoom_value(self.h3_resolutions, zoom)
+
+
+class ClusteringPolicyOverrides(BaseModel):
+    """Fields of the clustering policy overridden for a layer, the others are those of the default policy."""
+
+    model_config = {"extra": "forbid"}
+
+    enabled: Optional[bool] = None
+    min_zoom: Optional[int] = None
+    min_feature_count: Optional[int] = None
+    h3_resolutions: Optional[Dict[int, int]] = None
+    representative: Optional[Literal["first", "centroid", "max_attribute"]] = None
+    representative_attribute: Optional[str] = None
+
+
+class GeoAPISettings(BaseSettings):
+    """GOAT GeoAPI settings"""
+
+    # Statement timeouts in seconds for the tile queries by branch (cluster, distributed, default)
+    # and zoom level. The zoom keys are the minimum zoom from which the timeout applies,
+    # e.g. {"cluster": {"0": 30, "7": 10}, "default": {"0": 20}}.
+    tile_statement_timeouts: Dict[str, Dict[int, float]] = {}
+
+    # Cache-Control of responses carrying an ETag. They can be stored for long as they are revalidated with If-None-Match.
+    etag_cachecontrol: str = "public, no-cache"
+
+    # Maximum size in bytes of the in-memory tile cache (0 disables the cache) and the encodings
+    # the tiles are stored with, in order of preference.
+    tile_cache_max_size: int = 256 * 1024 * 1024
+    tile_cache_encodings: List[str] = ["br", "zstd", "gzip"]
+
+    # Stale-while-revalidate of the tile cache: maximum age in seconds of a tile invalidated by a layer
+    # change that is still served while it is rendered again in the background, by zoom level
+    # (the keys are the minimum zoom from which the value applies, e.g. {"0": 300, "7": 0}).
+    # Tiles are removed on invalidation where it is 0 (the default).
+    tile_max_staleness: Dict[int, float] = {}
+
+    # Number of tiles prefetched at once into the tile cache around the requested tiles (0 disables
+    # the prefetching), maximum number of queued tiles and maximum zoom of the prefetched children.
+    tile_prefetch_concurrency: int = 0
+    tile_prefetch_queue_size: int = 256
+    tile_prefetch_max_zoom: int = 20
+
+    # Maximum number of features of a tile.
+    max_features_per_tile: int = 15000
+
+    # Clustering policy of the point layers and overrides of its fields by collection id or layer id,
+    # e.g. {"user_data.<layer_id>": {"min_zoom": 9, "representative": "centroid"}}.
+    clustering: ClusteringPolicy = ClusteringPolicy()
+    clustering_layers: Dict[str, ClusteringPolicyOverrides] = {}
+
+    # Minimal size in bytes of a response to be compressed.
+    compression_minimum_size: int = 500
+
+    # Directory of the MBTiles archives written by the seeder (src/seed.py) to serve tiles from.
+    tile_archive_directory: Optional[str] = None
+
+    # Token expected in the X-Admin-Token header of the admin endpoints. They are disabled if not set.
+    admin_token: Optional[str] = None
+
+    # Connection pool: number of connections opened at startup, adaptive limit of the connections in use
+    # (between db_pool_min_limit and TIPG_DB_MAX_CONN_SIZE, lowered when the queries get slower than
+    # db_pool_latency_tolerance times their usual latency and raised when requests wait longer than
+    # db_pool_target_acquire_wait seconds for a connection).
+    db_pool_warm_up: int = 0
+    db_pool_adaptive: bool = False
+    db_pool_min_limit: int = 2
+    db_pool_target_acquire_wait: float = 0.01
+    db_pool_latency_tolerance: float = 2
+
+    # Connect through PgBouncer in transaction pooling: no prepared statement cache and no session state
+    # (the TIPG_CUSTOM_SQL_DIRECTORY functions are not registered). LISTEN does not work through
+    # transaction pooling, the catalog listener connects to `listener_database_url` (directly to Postgres).
+    pgbouncer: bool = False
+    listener_database_url: Optional[str] = None
+
+    # Index advisor (/admin/indexes): number of hottest layers (by database time of their tiles) checked
+    # for a partial GiST index and minimum estimated number of rows of a layer to propose one.
+    index_advisor_hot_layers: int = 10
+    index_advisor_min_layer_rows: int = 1000000
+
+    # Maximum number of tiles of a batch request and number of connections used to render them.
+    tile_batch_max_tiles: int = 64
+    tile_batch_concurrency: int = 4
+
+    # Render the tiles of distributed layers with one statement per Citus shard (grouping the h3_3 grids
+    # of a tile by shard) instead of one statement for all grids planned by the coordinator.
+    citus_shard_routing: bool = False
+
+    # Encoder of the vector tiles: "postgres" (ST_AsMVT) or "python", where the tile queries return the
+    # geometries as WKB and the tiles are encoded by a pool of processes of the API (src/mvt.py), spawned
+    # at startup. The python encoder is experimental: it is not benchmarked against ST_AsMVT yet, keep the
+    # default unless the database is the bottleneck of the tile requests.
+    tile_encoder: Literal["postgres", "python"] = "postgres"
+    tile_encoder_processes: Optional[int] = None
+
+    # Build the GeoJSON features of the items responses in Postgres (json_build_object, ST_AsGeoJSON) instead
+    # of the API. Only the GeoJSON output is affected, the other formats are built by tipg.
+    items_geojson_from_database: bool = True
+
+    # Maximum number of ids of a bulk items request and statement timeout in seconds of each fetch of
+    # its cursor (not set if 0).
+    items_bulk_max_ids: int = 100000
+    items_bulk_statement_timeout: float = 60
+
+    # Maximum number of cached results of the aggregate endpoint (0 disables the cache).
+    aggregate_cache_max_entries: int = 1000
+
+    # Report the instance as ready (/readyz) while the catalog is still loading. Requests for collections
+    # arriving before the catalog is loaded wait for it up to `catalog_wait_timeout` seconds (then 503).
+    serve_while_catalog_loads: bool = False
+    catalog_wait_timeout: float = 30
+
+    # Readiness (/readyz): seconds the catalog listener can be disconnected before the instance reports
+    # as not ready, and share of busy pool connections from which it does (not checked if not set).
+    readiness_listener_grace: float = 15
+    readiness_max_pool_saturation: Optional[float] = None
+
+    model_config = {"env_prefix": "GEOAPI_", "env_file": ".env", "extra": "ignore"}
+
+    @model_validator(mode="after")
+    def check_clustering_layers(self) -> "GeoAPISettings":
+        """Check the clustering policies of the layers when the settings are loaded, not when the catalog is built."""
+        for layer in self.clustering_layers:
+            try:
+                self.clustering_policy(layer)
+            except ValidationError as e:
+                raise ValueError(f"Invalid clustering policy of {layer}: {e}")
+        return self
+
+    @staticmethod
+    def zoom_value(values: Dict[int, float], zoom: int) -> Optional[float]:
+        """Return the value of the largest minimum zoom lower or equal to the zoom level."""
+        zooms = [z for z in values if z <= zoom]
+        if not zooms:
+            return None
+        return values[max(zooms)]
+
+    def tile_statement_timeout(self, branch: str, zoom: int) -> Optional[float]:
+        """Return the statement timeout for a tile query branch at the given zoom level."""
+        timeouts = self.tile_statement_timeouts.get(
+            branch, self.tile_statement_timeouts.get("default", {})
+        )
+        return self.zoom_value(timeouts, zoom)
+
+    def tile_stale_max_age(self, zoom: int) -> float:
+        """Return how long an invalidated tile of the zoom level can be served while it is rendered again."""
+        return self.zoom_value(self.tile_max_staleness, zoom) or 0
+
+    def clustering_policy(self, collection_id: str) -> ClusteringPolicy:
+        """Return the clustering policy of a layer with the overrides of its collection id or layer id."""
+        overrides = self.clustering_layers.get(
+            collection_id, self.clustering_layers.get(collection_id.split(".")[-1])
+        )
+        if overrides is None:
+            return self.clustering
+        return ClusteringPolicy(
+            **{
+                **self.clustering.model_dump(),
+                **overrides.model_dump(exclude_unset=True),
+            }
+        )
+
+
+geoapi_settings = GeoAPISettings()
@@ -0,0 +1,48 @@
+from typing import Optional
+
+from buildpg import asyncpg
+from morecantile import Tile, TileMatrixSet
+from starlette.datastructures import QueryParams
+from tipg.collections import Collection
+
+from src.exts import layer_filter
+
+# Query parameters of the tile endpoint that can be reproduced when rendering a tile outside of a request.
+RENDERABLE_QUERY_PARAMS = {"filter", "properties", "limit", "geom-column"}
+
+
+def is_renderable(query: str) -> bool:
+    """Check if a tile request with this query string can be rendered outside of a request."""
+    return set(QueryParams(query)) <= RENDERABLE_QUERY_PARAMS
+
+
+async def render_tile(
+    pool: asyncpg.BuildPgPool,
+    collection: Collection,
+    tms: TileMatrixSet,
+    tile: Tile,
+    query: str = "",
+) -> Optional[bytes]:
+    """Render a tile with get_tile outside of a request (seeding, prefetching...).
+
+    Returns None if the query string contains parameters that can not be reproduced.
+    """
+    if not is_renderable(query):
+        return None
+
+    params = QueryParams(query)
+    properties = (
+        [p.strip() for p in params["properties"].split(",")]
+        if "properties" in params
+        else None
+    )
+    data = await collection.get_tile(
+        pool=pool,
+        tms=tms,
+        tile=tile,
+        cql_filter=layer_filter(collection.id, collection, params.get("filter")),
+        properties=properties,
+        limit=int(params["limit"]) if "limit" in params else None,
+        geom=params.get("geom-column"),
+    )
+    return bytes(data) if data is not None else b""
@@ -0,0 +1,69 @@
+from buildpg import render
+from starlette.requests import Request
+from tipg.collections import Collection, Column
+
+from src.exts import _select_geojson, _where, properties_filter_query
+
+
+def collection() -> Collection:
+    columns = [
+        Column(name="layer_id", type="text", description="layer_id"),
+        Column(name="name", type="text", description="text_attr1"),
+        Column(name="size", type="integer", description="integer_attr1"),
+        Column(name="id", type="uuid", description="id"),
+    ]
+    return Collection(
+        type="Table",
+        id="user_data.744e4fd1685c495c8b02efebce875359",
+        table="point_744e4fd1685c495c8b02efebce875359",
+        schema="user_data",
+        id_column=columns[-1],
+        table_columns=columns,
+        properties=columns,
+    )
+
+
+def request(query_string: str) -> Request:
+    return Request({"type": "http", "query_string": query_string.encode()})
+
+
+def test_properties_filter_repeated():
+    properties = properties_filter_query(
+        request("name=a&limit=10&name=b&size=3&other=1"), collection()
+    )
+
+    assert properties == [("name", "a"), ("name", "b"), ("size", "3")]
+
+
+def test_where_properties_any():
+    properties = properties_filter_query(request("name=a&name=b&size=3"), collection())
+
+    q, p = render(":w", w=_where(collection(), properties=properties))
+
+    assert q == (
+        "WHERE $1 AND text_attr1 = any($2::text[]) AND integer_attr1 = $3::text::integer"
+    )
+    assert p == [True, ["a", "b"], "3"]
+
+
+def test_select_geojson_jsonb_as_text():
+    # The properties of the GeoJSON items are the ones of the other formats, jsonb as text
+    jsonb = Column(name="tags", type="jsonb", description="jsonb_attr1")
+    c = collection()
+    c.properties.append(jsonb)
+
+    q, _ = render(
+        ":s",
+        s=_select_geojson(
+            c,
+            properties=["name", "tags"],
+            geometry_column=None,
+            bbox_only=None,
+            simplify=None,
+        ),
+    )
+
+    assert q.endswith(
+        '(SELECT to_json(p) FROM (SELECT text_attr1 AS "name", jsonb_attr1::text AS "tags") p)'
+        " AS tipg_properties"
+    )
@@ -0,0 +1,202 @@
+"""The python tile encoder against the tiles ST_AsMVT writes for the same rows."""
+import struct
+from types import SimpleNamespace
+
+import pytest
+from tipg.collections import Column
+
+from src.exts import mvt_output
+from src.mvt import (
+    LAYER_FEATURES,
+    LAYER_KEYS,
+    LAYER_VALUES,
+    TILE_LAYERS,
+    close_encoder_pool,
+    encode_tile,
+    get_encoder_pool,
+    packed_varints,
+    read_fields,
+    read_varint,
+    start_encoder_pool,
+)
+from src.settings import geoapi_settings
+
+
+def point(x: int, y: int) -> bytes:
+    """WKB of a point in tile coordinates, as returned by ST_AsMVTGeom."""
+    return struct.pack("<BIdd", 1, 1, x, y)
+
+
+def decode_value(value: bytes):
+    """Decode a Value message as (name of its field, value)."""
+    ((number, _, data, _),) = read_fields(value)
+    if number == 1:
+        return "string", data.decode()
+    if number == 2:
+        return "float", struct.unpack("<f", data)[0]
+    if number == 3:
+        return "double", struct.unpack("<d", data)[0]
+    varint = read_varint(data, 0)[0]
+    if number == 5:
+        return "uint", varint
+    if number == 6:
+        return "sint", (varint >> 1) ^ -(varint & 1)
+    return "bool", bool(varint)
+
+
+def decode_layer(tile: bytes) -> dict:
+    """Decode the keys, values and feature properties of the only layer of a tile."""
+    (layer,) = [v for n, _, v, _ in read_fields(tile) if n == TILE_LAYERS]
+    keys, values, tags = [], [], []
+    for number, _, value, _ in read_fields(layer):
+        if number == LAYER_KEYS:
+            keys.append(value.decode())
+        elif number == LAYER_VALUES:
+            values.append(decode_value(value))
+        elif number == LAYER_FEATURES:
+            tags += [packed_varints(v) for n, _, v, _ in read_fields(value) if n == 2]
+    features = [
+        {keys[t[i]]: values[t[i + 1]] for i in range(0, len(t), 2)} for t in tags
+    ]
+    return {"keys": keys, "values": values, "features": features}
+
+
+def test_encode_tile_bytes():
+    # SELECT ST_AsMVT(t.*) FROM (SELECT 'POINT(1 2)'::geometry AS geom, 1 AS a) t
+    tile = encode_tile("default", ["a"], [(point(1, 2), (1,))])
+
+    assert tile.hex() == (
+        "1a22"
+        "0a0764656661756c74"
+        "120b1202000018012203090204"
+        "1a0161"
+        "22022801"
+        "288020"
+        "7802"
+    )
+
+
+def test_encode_tile_types():
+    # SELECT ST_AsMVT(t.*) FROM (
+    #     SELECT 'POINT(1 2)'::geometry AS geom, 1::integer AS a, -1::bigint AS b, 1.5::real AS c,
+    #     2.5::double precision AS d, true AS e, '2024-01-02 03:04:05+00'::timestamptz AS f,
+    #     1.50::numeric AS g, '2024-01-02'::date AS h, NULL::text AS i,
+    #     '{"k": 1, "m": "s", "n": 2.5, "o": {"x": 1}, "p": null, "q": 2.0, "r": [1]}'::jsonb AS j
+    # ) t
+    # The timestamptz, numeric and date are cast to text by the query of the python encoder.
+    keys = ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j"]
+    types = [
+        "integer",
+        "bigint",
+        "real",
+        "double precision",
+        "boolean",
+        "timestamptz",
+        "numeric",
+        "date",
+        "text",
+        "jsonb",
+    ]
+    values = (
+        1,
+        -1,
+        1.5,
+        2.5,
+        True,
+        "2024-01-02 03:04:05+00",
+        "1.50",
+        "2024-01-02",
+        None,
+        {"k": 1, "m": "s", "n": 2.5, "o": {"x": 1}, "p": None, "q": 2.0, "r": [1]},
+    )
+
+    layer = decode_layer(
+        encode_tile("default", keys, [(point(1, 2), values)], 4096, types)
+    )
+
+    # The keys of all the columns, then the keys of the jsonb members
+    assert layer["keys"] == keys + ["k", "m", "n", "q"]
+    assert layer["values"] == [
+        ("uint", 1),
+        ("sint", -1),
+        ("float", 1.5),
+        ("double", 2.5),
+        ("bool", True),
+        ("string", "2024-01-02 03:04:05+00"),
+        ("string", "1.50"),
+        ("string", "2024-01-02"),
+        ("string", "s"),
+        ("uint", 2),
+    ]
+    assert layer["features"] == [
+        {
+            "a": ("uint", 1),
+            "b": ("sint", -1),
+            "c": ("float", 1.5),
+            "d": ("double", 2.5),
+            "e": ("bool", True),
+            "f": ("string", "2024-01-02 03:04:05+00"),
+            "g": ("string", "1.50"),
+            "h": ("string", "2024-01-02"),
+            "k": ("uint", 1),
+            "m": ("string", "s"),
+            "n": ("double", 2.5),
+            "q": ("uint", 2),
+        }
+    ]
+
+
+def test_encode_tile_shared_values():
+    # SELECT ST_AsMVT(t.*) FROM (VALUES
+    #     ('POINT(1 2)'::geometry, 'x', 1), ('POINT(3 4)'::geometry, 'x', 2), (NULL, 'y', 3)
+    # ) t(geom, a, b)
+    tile = encode_tile(
+        "default",
+        ["a", "b"],
+        [(point(1, 2), ("x", 1)), (point(3, 4), ("x", 2)), (None, ("y", 3))],
+        4096,
+        ["text", "integer"],
+    )
+
+    layer = decode_layer(tile)
+    assert layer["keys"] == ["a", "b"]
+    assert layer["values"] == [("string", "x"), ("uint", 1), ("uint", 2)]
+    assert [f["b"] for f in layer["features"]] == [("uint", 1), ("uint", 2)]
+
+
+def test_encode_tile_empty():
+    # ST_AsMVT of rows without geometry is an empty bytea
+    assert encode_tile("default", ["a"], [(None, (1,))]) == b""
+
+
+def test_mvt_output_casts_to_text(monkeypatch):
+    monkeypatch.setattr(geoapi_settings, "tile_encoder", "python")
+    collection = SimpleNamespace(
+        properties=[
+            Column(name="a", type="integer"),
+            Column(name="f", type="timestamptz"),
+            Column(name="g", type="numeric"),
+            Column(name="j", type="jsonb"),
+            Column(name="geom", type="geometry"),
+        ]
+    )
+
+    assert mvt_output(collection, None) == (
+        'SELECT ST_AsBinary(t.geom) AS geom, t."a", t."f"::text, t."g"::text, t."j"'
+    )
+
+
+def test_encoder_pool_spawned():
+    with pytest.raises(RuntimeError):
+        get_encoder_pool()
+
+    pool = start_encoder_pool(1)
+    try:
+        # Not forked from the app holding the database connections
+        assert pool._mp_context.get_start_method() == "spawn"
+        assert get_encoder_pool() is pool
+        assert (
+            pool.submit(encode_tile, "default", ["a"], [(None, (1,))]).result() == b""
+        )
+    finally:
+        close_encoder_pool()
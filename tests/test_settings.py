@@ -0,0 +1,36 @@
+import pytest
+from pydantic import ValidationError
+
+from src.settings import GeoAPISettings
+
+
+def test_clustering_policy_overrides():
+    settings = GeoAPISettings(
+        clustering_layers={
+            "user_data.744e4fd1685c495c8b02efebce875359": {"min_zoom": 9},
+            "b8e3f1c2d4a5467e9f0a1b2c3d4e5f60": {"representative": "centroid"},
+        }
+    )
+
+    policy = settings.clustering_policy("user_data.744e4fd1685c495c8b02efebce875359")
+    assert policy.min_zoom == 9
+    assert policy.representative == "first"
+    policy = settings.clustering_policy("user_data.b8e3f1c2d4a5467e9f0a1b2c3d4e5f60")
+    assert policy.min_zoom == settings.clustering.min_zoom
+    assert policy.representative == "centroid"
+    assert settings.clustering_policy("user_data.other") is settings.clustering
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"min_zom": 9},
+        {"representative": "largest"},
+        {"h3_resolutions": {"0": "three"}},
+        {"enabled": None},
+    ],
+)
+def test_clustering_policy_invalid_overrides(overrides):
+    # Rejected when the settings are loaded instead of when the catalog is built
+    with pytest.raises(ValidationError):
+        GeoAPISettings(clustering_layers={"user_data.layer": overrides})
@@ -0,0 +1,177 @@
+"""Routing of the tile queries of distributed layers by Citus shard, against stand-ins of the Citus catalog."""
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+from src import exts
+from src.exts import group_h3_3_by_shard
+from src.mvt import LAYER_FEATURES, TILE_LAYERS, encode_tile, merge_tiles, read_fields
+
+RELATION = "user_data.point_744e4fd1685c495c8b02efebce875359"
+MIN_HASH = -(2**31)
+MAX_HASH = 2**31 - 1
+
+
+def pg_dist_shard(shard_count: int, first_shard_id: int = 102008):
+    """Rows of pg_dist_shard for a hash distributed table, split in ranges of equal size like Citus does."""
+    step = 2**32 // shard_count
+    rows = []
+    for i in range(shard_count):
+        minvalue = MIN_HASH + i * step
+        maxvalue = MAX_HASH if i == shard_count - 1 else minvalue + step - 1
+        rows.append(
+            {
+                "logicalrelid": RELATION,
+                "shardid": first_shard_id + i,
+                "shardstorage": "t",
+                "shardminvalue": str(minvalue),
+                "shardmaxvalue": str(maxvalue),
+            }
+        )
+    # Not in the order of the hash ranges, the catalog query sorts them
+    return rows[::-1]
+
+
+def pg_dist_placement(shards, worker_groups: int):
+    """Rows of pg_dist_placement placing the shards round robin on the worker groups."""
+    return [
+        {
+            "placementid": i + 1,
+            "shardid": shard["shardid"],
+            "groupid": i % worker_groups + 1,
+        }
+        for i, shard in enumerate(sorted(shards, key=lambda s: s["shardid"]))
+    ]
+
+
+def catalog_shards(shards):
+    """Shards of a layer as built by the catalog query from pg_dist_shard."""
+    return [
+        (shard["shardid"], int(shard["shardminvalue"]), int(shard["shardmaxvalue"]))
+        for shard in sorted(shards, key=lambda s: int(s["shardminvalue"]))
+        if shard["logicalrelid"] == RELATION
+    ]
+
+
+@pytest.fixture
+def h3_3_hashes(monkeypatch):
+    # hashint4 of the h3_3 grids, as returned by the query of the grids of the tiles
+    hashes = {
+        590426: MIN_HASH,
+        590427: -1500000000,
+        590428: -1,
+        590429: 0,
+        590430: 1073741823,
+        590431: 1073741824,
+        590432: MAX_HASH,
+    }
+    monkeypatch.setattr(exts, "h3_3_hashes", hashes)
+    return hashes
+
+
+def shard_of(shards, h3_3_hash):
+    return next(
+        shard["shardid"]
+        for shard in shards
+        if int(shard["shardminvalue"]) <= h3_3_hash <= int(shard["shardmaxvalue"])
+    )
+
+
+def test_group_h3_3_by_shard(h3_3_hashes):
+    shards = pg_dist_shard(4)
+    collection = SimpleNamespace(shards=catalog_shards(shards))
+
+    groups = group_h3_3_by_shard(collection, list(h3_3_hashes))
+
+    assert groups == {
+        102008: [590426, 590427],
+        102009: [590428],
+        102010: [590429, 590430],
+        102011: [590431, 590432],
+    }
+    for shard_id, grids in groups.items():
+        assert all(shard_of(shards, h3_3_hashes[g]) == shard_id for g in grids)
+
+
+def test_group_h3_3_by_shard_placement(h3_3_hashes):
+    shards = pg_dist_shard(32)
+    placements = {
+        p["shardid"]: p["groupid"] for p in pg_dist_placement(shards, worker_groups=2)
+    }
+    collection = SimpleNamespace(shards=catalog_shards(shards))
+
+    groups = group_h3_3_by_shard(collection, list(h3_3_hashes))
+
+    assert sorted(g for grids in groups.values() for g in grids) == sorted(h3_3_hashes)
+    # Each group is one statement Citus can route to the worker of the shard
+    assert {placements[shard_id] for shard_id in groups} == {1, 2}
+    for shard_id, grids in groups.items():
+        assert all(shard_of(shards, h3_3_hashes[g]) == shard_id for g in grids)
+
+
+def test_group_h3_3_by_shard_unknown(h3_3_hashes):
+    collection = SimpleNamespace(shards=catalog_shards(pg_dist_shard(4)))
+
+    # Hash of the grid not known yet
+    assert group_h3_3_by_shard(collection, [590426, 123]) is None
+    # Not a distributed layer, or the shards could not be read
+    assert group_h3_3_by_shard(SimpleNamespace(shards=[]), [590426]) is None
+
+
+def test_group_h3_3_by_shard_outside_ranges(h3_3_hashes):
+    # The hash of the grid is in none of the ranges, e.g. the shards changed since the catalog was read
+    shards = catalog_shards(pg_dist_shard(4))[:-1]
+    collection = SimpleNamespace(shards=shards)
+
+    assert group_h3_3_by_shard(collection, [590426, 590432]) is None
+
+
+def point(x: int, y: int) -> bytes:
+    """WKB of a point in tile coordinates."""
+    return struct.pack("<BIdd", 1, 1, x, y)
+
+
+def layers(tile: bytes):
+    return [value for number, _, value, _ in read_fields(tile) if number == TILE_LAYERS]
+
+
+def features(layer: bytes) -> int:
+    return sum(1 for number, _, _, _ in read_fields(layer) if number == LAYER_FEATURES)
+
+
+def test_merge_shard_tiles(h3_3_hashes):
+    collection = SimpleNamespace(shards=catalog_shards(pg_dist_shard(4)))
+    groups = group_h3_3_by_shard(collection, list(h3_3_hashes))
+
+    # One tile per shard query, with a feature per h3_3 grid
+    keys = ["name", "h3_3"]
+    tiles = [
+        encode_tile(
+            "default",
+            keys,
+            [
+                (point(i * 10, i * 20), (f"grid {grid}", grid))
+                for i, grid in enumerate(grids)
+            ],
+        )
+        for grids in groups.values()
+    ]
+    expected = encode_tile(
+        "default",
+        keys,
+        [
+            (point(i * 10, i * 20), (f"grid {grid}", grid))
+            for grids in groups.values()
+            for i, grid in enumerate(grids)
+        ],
+    )
+
+    merged = merge_tiles(tiles + [b""])
+
+    assert len(layers(merged)) == 1
+    assert features(layers(merged)[0]) == len(h3_3_hashes)
+    # The same features, keys and values as one tile of all the rows
+    assert sorted(read_fields(layers(merged)[0]), key=lambda f: f[3]) == sorted(
+        read_fields(layers(expected)[0]), key=lambda f: f[3]
+    )